@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+"""Benchmarks for the MultiFileField lifecycle.
+
+Runs offline against an in-memory sqlite database, configured the same
+way as `python setup.py test`.  Every case is timed over a number of
+repeats and reports the best and median wall time along with the peak
+memory traced by tracemalloc.  Python 2 has no tracemalloc, and the
+process' peak RSS only ever grows over the earlier cases, so there the
+peak is left out.
+
+    python benchmarks/bench.py
+    python benchmarks/bench.py --rows 10 1000 100000 --files 50 --file-size 65536
+    python benchmarks/bench.py --only render process --json > before.json
+"""
+
+import os, sys, json, shutil, argparse, tempfile
+
+from timeit import default_timer
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.abspath(__file__), os.pardir, os.pardir)))
+
+
+def configure(media_root):
+    from django.conf import settings
+
+    settings.configure(
+        DATABASES = {
+            'default': {
+                'NAME': ':memory:',
+                'ENGINE': 'django.db.backends.sqlite3'
+            }
+        },
+        INSTALLED_APPS = (
+            'django.contrib.contenttypes',
+            'floppyforms',
+            'multifilefield',
+        ),
+        TEMPLATES = [{
+            'BACKEND': 'django.template.backends.django.DjangoTemplates',
+            'APP_DIRS': True,
+        }],
+        MEDIA_ROOT = media_root,
+        MULTIFILEFIELD_STAGING_ROOT = os.path.join(media_root, 'staging'),
+    )
+
+    import django
+    from django.core.management import call_command
+
+    django.setup()
+    call_command('migrate', run_syncdb=True, verbosity=0)
+
+
+
+def make_memory_storage():
+    from django.core.files.base import ContentFile
+    from django.core.files.storage import Storage
+
+    class MemoryStorage(Storage):
+        """Keeps file contents in a dict, to tell the package's own cost
+        apart from the file system's."""
+
+        def __init__(self):
+            self.files = {}
+
+        def _save(self, name, content):
+            self.files[name] = b''.join(content.chunks())
+            return name
+
+        def _open(self, name, mode='rb'):
+            return ContentFile(self.files[name], name=name)
+
+        def exists(self, name):
+            return name in self.files
+
+        def delete(self, name):
+            self.files.pop(name, None)
+
+        def size(self, name):
+            return len(self.files[name])
+
+        def url(self, name):
+            return '/memory/%s' % name
+
+        def path(self, name):
+            raise NotImplementedError
+
+    return MemoryStorage()
+
+
+
+class Measure(object):
+    """Times a callable and records its peak memory, None without
+    tracemalloc."""
+
+    def __init__(self, repeat):
+        self.repeat = repeat
+
+
+    def __call__(self, func, setup=None):
+        timings = []
+        peak = 0 if tracemalloc is not None else None
+
+        for i in range(self.repeat):
+            args = setup() if setup else ()
+
+            if tracemalloc is not None:
+                tracemalloc.start()
+
+            start = default_timer()
+            func(*args)
+            timings.append(default_timer() - start)
+
+            if tracemalloc is not None:
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+
+        timings.sort()
+        return {
+            'best': timings[0],
+            'median': timings[len(timings) // 2],
+            'peak_memory': peak}
+
+
+
+def make_uploads(count, size, prefix='bench'):
+    from django.core.files.uploadedfile import SimpleUploadedFile
+
+    return [SimpleUploadedFile('%s_%s.jpeg' % (prefix, i), os.urandom(size), content_type='image/jpeg')
+        for i in range(count)]
+
+
+def make_rows(count, size, storage):
+    from multifilefield.models import UploadedFile
+
+    UploadedFile.objects.all().delete()
+    rows = []
+    for i in range(count):
+        name = 'row_%s.jpeg' % i
+        if i < 100:
+            # Only the rows a case may delete need their file.
+            name = storage.save(name, make_uploads(1, size, 'row')[0])
+        rows.append(UploadedFile(upload=name, filename=name, size=size, content_type='image/jpeg'))
+    UploadedFile.objects.bulk_create(rows, batch_size=500)
+
+    return list(UploadedFile.objects.order_by('pk').values_list('pk', flat=True)[:100])
+
+
+
+def bench_construct(measure, rows, options):
+    from multifilefield.fields import MultiFileField
+    from multifilefield.models import UploadedFile
+
+    def construct():
+        field = MultiFileField(queryset=UploadedFile.objects.all(), filefield_name='upload')
+        field.validate(([], []))
+
+    return measure(construct)
+
+
+def bench_copy(measure, rows, options):
+    from django import forms
+
+    from multifilefield.fields import MultiFileField
+    from multifilefield.models import UploadedFile
+
+    class BenchForm(forms.Form):
+        uploads = MultiFileField(queryset=UploadedFile.objects.all(), filefield_name='upload')
+
+    # Load the choices of a form, as rendering its clear widget would, so
+    # any loaded state a copy would drag along is there.
+    list(BenchForm().fields['uploads'].choices)
+
+    def construct():
+        for i in range(options.forms):
+            BenchForm()
+
+    return measure(construct)
+
+
+def bench_clean(measure, rows, options):
+    from multifilefield.fields import MultiFileField
+    from multifilefield.models import UploadedFile
+
+    field = MultiFileField(
+        queryset = UploadedFile.objects.all(),
+        filefield_name = 'upload',
+        max_num_files = options.files,
+        max_file_size = None)
+
+    def setup():
+        return (make_uploads(options.files, options.file_size),)
+
+    return measure(lambda uploads: field.clean([uploads, []]), setup)
+
+
+def bench_render(measure, rows, options):
+    from multifilefield.fields import MultiFileField
+    from multifilefield.models import UploadedFile
+
+    # The subwidgets are rendered one by one, as MultiFileWidget would,
+    # since Django's own MultiWidget can't render floppyforms widgets on
+    # every supported version.
+    def render():
+        field = MultiFileField(queryset=UploadedFile.objects.all(), filefield_name='upload')
+        for (i, widget) in enumerate(field.widget.widgets):
+            widget.render('uploads_%s' % i, None, {'id': 'id_uploads_%s' % i})
+
+    return measure(render)
+
+
+def bench_process(measure, rows, options, storage):
+    from django import forms
+    from django.utils.datastructures import MultiValueDict
+
+    from multifilefield.fields import MultiFileField
+    from multifilefield.mixins import MultiFileFieldMixin
+    from multifilefield.models import UploadedFile
+
+    class BenchForm(MultiFileFieldMixin, forms.Form):
+        uploads = MultiFileField(
+            storage = storage,
+            queryset = UploadedFile.objects.all(),
+            filefield_name = 'upload',
+            max_num_files = options.files,
+            max_file_size = None)
+
+    def setup():
+        ids = make_rows(rows, options.file_size, storage)[:options.files]
+        data = MultiValueDict({'uploads_1': [str(pk) for pk in ids]})
+        files = MultiValueDict({'uploads_0': make_uploads(options.files, options.file_size)})
+        return (data, files)
+
+    def process(data, files):
+        form = BenchForm(data, files)
+        form.process_files_for('uploads')
+
+    return measure(process, setup)
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the MultiFileField lifecycle.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10, 1000, 100000],
+        help='Sizes of the UploadedFile table.')
+    parser.add_argument('--files', type=int, default=20,
+        help='Files uploaded (and cleared) by clean and process.')
+    parser.add_argument('--file-size', type=int, default=16 * 1024,
+        help='Size of the synthetic files in bytes.')
+    parser.add_argument('--forms', type=int, default=100,
+        help='Forms instantiated by copy.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', nargs='+', default=None,
+        choices=['construct', 'copy', 'clean', 'render', 'process'])
+    parser.add_argument('--json', action='store_true', default=False,
+        help='Print the results as json, to compare runs between releases.')
+    options = parser.parse_args()
+
+    media_root = tempfile.mkdtemp(prefix='multifilefield-bench-')
+    try:
+        configure(media_root)
+
+        from django.core.files.storage import FileSystemStorage
+
+        storages = [
+            ('filesystem', FileSystemStorage(location=os.path.join(media_root, 'files'))),
+            ('memory', make_memory_storage())]
+
+        measure = Measure(options.repeat)
+        only = set(options.only or ['construct', 'copy', 'clean', 'render', 'process'])
+        results = []
+
+        for rows in options.rows:
+            make_rows(rows, options.file_size, storages[1][1])
+
+            cases = [
+                ('construct', lambda: bench_construct(measure, rows, options)),
+                ('copy', lambda: bench_copy(measure, rows, options)),
+                ('clean', lambda: bench_clean(measure, rows, options)),
+                ('render', lambda: bench_render(measure, rows, options))]
+            for (storage_name, storage) in storages:
+                cases.append(('process', lambda storage=storage: bench_process(measure, rows, options, storage),
+                    storage_name))
+
+            for case in cases:
+                if case[0] not in only:
+                    continue
+                result = case[1]()
+                result.update({
+                    'case': case[0] if len(case) == 2 else '%s[%s]' % (case[0], case[2]),
+                    'rows': rows})
+                results.append(result)
+
+                if not options.json:
+                    peak = result['peak_memory']
+                    sys.stdout.write('%-22s rows=%-7s best=%9.2fms median=%9.2fms peak=%10s\n' % (
+                        result['case'], rows, result['best'] * 1000, result['median'] * 1000,
+                        '%.1fKB' % (peak / 1024.0) if peak is not None else 'n/a'))
+                    sys.stdout.flush()
+
+        if options.json:
+            sys.stdout.write(json.dumps({
+                'files': options.files,
+                'forms': options.forms,
+                'file_size': options.file_size,
+                'repeat': options.repeat,
+                'results': results}, indent=2))
+            sys.stdout.write('\n')
+    finally:
+        shutil.rmtree(media_root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+""" Coroutines for processing a MultiFileField without blocking the event
+    loop, for projects served over ASGI.  Python 3 only; the field and
+    mixin import this module when their a-prefixed methods are called.
+
+    Storage calls for the files of a request run concurrently.  Storages
+    that provide asave/adelete coroutines are awaited directly, anything
+    else runs in a thread, at most MULTIFILEFIELD_ASYNC_CONCURRENCY
+    (default 4) at a time per event loop so one big request can't take
+    every thread.  Database work runs on the one thread Django's sync
+    code shares, so connections aren't opened per thread and left behind;
+    the Django versions this package supports have no async ORM.
+    """
+
+import asyncio, functools, threading, weakref
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import transaction
+
+from .caching import bump_version
+from .fields import MultiFileField
+from .signals import timed
+
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:
+    sync_to_async = None
+
+_semaphores = weakref.WeakKeyDictionary()
+_db_executor = None
+_db_executor_lock = threading.Lock()
+
+
+
+def get_semaphore():
+    loop = asyncio.get_event_loop()
+    semaphore = _semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _semaphores[loop] = asyncio.Semaphore(
+            getattr(settings, 'MULTIFILEFIELD_ASYNC_CONCURRENCY', 4))
+    return semaphore
+
+
+def get_db_executor():
+    global _db_executor
+
+    with _db_executor_lock:
+        if _db_executor is None:
+            _db_executor = ThreadPoolExecutor(max_workers=1)
+    return _db_executor
+
+
+async def run_sync(func, *args, **kwargs):
+    """Runs code that touches the database in a single shared thread."""
+
+    if sync_to_async is not None:
+        return await sync_to_async(func, thread_sensitive=True)(*args, **kwargs)
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(get_db_executor(), functools.partial(func, *args, **kwargs))
+
+
+async def run_io(func, *args, **kwargs):
+    """Runs blocking storage calls in a thread, bounded by the semaphore."""
+
+    async with get_semaphore():
+        if sync_to_async is not None:
+            return await sync_to_async(func, thread_sensitive=False)(*args, **kwargs)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+async def save_file(field, file_obj):
+    if field.deduplicate:
+        return await run_io(field.save_file, file_obj)
+
+    # save_files has looked the owner's content type up, so naming the
+    # file, which hashes it too, needs no database.
+    name = await run_io(field.get_save_name, file_obj)
+
+    asave = getattr(field.storage, 'asave', None)
+    with timed(field, 'storage_save', [file_obj]):
+        if asave is not None:
+            return await asave(name, file_obj)
+        return await run_io(field.storage.save, name, file_obj)
+
+
+async def delete_names(field, names):
+    adelete = getattr(field.storage, 'adelete', None)
+    with timed(field, 'storage_delete', names):
+        if adelete is not None:
+            await asyncio.gather(*[adelete(name) for name in names])
+        else:
+            await asyncio.gather(*[run_io(field.storage.delete, name) for name in names])
+
+
+async def delete_storage_files(field, file_names):
+    names = await run_sync(field.get_deletable_names, file_names)
+    if names:
+        await delete_names(field, names)
+    return file_names
+
+
+async def save_files(field, files):
+    """Saves files concurrently, returning their names in the order
+    given.  As with MultiFileField.save_files every save finishes before
+    the first failure is raised and the saved files are removed again."""
+
+    await run_sync(field.get_owner_type)
+    results = await asyncio.gather(*[save_file(field, file_obj) for file_obj in files],
+        return_exceptions=True)
+
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        await delete_storage_files(field, [r for r in results if not isinstance(r, BaseException)])
+        raise errors[0]
+
+    return results
+
+
+def create_rows(field, files, filenames):
+    with transaction.atomic(using=field.queryset.db):
+        if field.bulk_upload:
+            uploaded_files = field.bulk_create_files_queryset(files, filenames)
+        else:
+            uploaded_files = [field.create_file_queryset(file_obj, filename)
+                for (file_obj, filename) in zip(files, filenames)]
+
+        if field.quota_key:
+            field.update_quota(len(uploaded_files), sum(f.size or 0 for f in files))
+
+    if field.bulk_upload:
+        bump_version()
+    return uploaded_files
+
+
+def delete_rows(field, file_ids):
+    with transaction.atomic(using=field.queryset.db):
+        uploaded_files = field.delete_rows(file_ids)
+        if field.quota_key:
+            field.release_quota(uploaded_files)
+    return uploaded_files
+
+
+async def aupload_files(field, files):
+    if field.deduplicate and field.queryset is not None:
+        # Shared files are written under the rows' locks, see lock_checksums.
+        return await run_sync(field.upload_files, files)
+
+    with timed(field, 'upload', files):
+        filenames = await save_files(field, files)
+
+        try:
+            if field.queryset is None:
+                manifest = await run_io(field.get_manifest)
+                for filename in filenames:
+                    await run_io(manifest.add, filename)
+                return files
+
+            return await run_sync(create_rows, field, files, filenames)
+        except BaseException:
+            await delete_storage_files(field, filenames)
+            raise
+
+
+async def adelete_files(field, file_ids):
+    if field.deduplicate and field.queryset is not None:
+        return await run_sync(field.delete_files, file_ids)
+
+    with timed(field, 'delete') as timer:
+        if field.queryset is None:
+            files = await run_io(field.delete_files, file_ids)
+            timer.num_files = len(files)
+            return files
+
+        uploaded_files = await run_sync(delete_rows, field, file_ids)
+        if uploaded_files:
+            await delete_storage_files(field, [getattr(f, field.filefield_name).name for f in uploaded_files])
+
+        timer.num_files = len(uploaded_files)
+        return uploaded_files
+
+
+async def aprocess_files_for(form, fieldname, defer=False):
+    from .mixins import FormNotValidException, NoStorageException
+
+    # Validating may query the choices, so it runs in a thread too.
+    if not await run_sync(form.is_valid):
+        raise FormNotValidException
+
+    field = form.fields[fieldname]
+    if not field.storage:
+        raise NoStorageException
+
+    if defer:
+        return await run_sync(form.process_files_for, fieldname, defer=True)
+
+    with timed(form, 'process'):
+        field_data = form.cleaned_data.pop(fieldname, None)
+
+        processed_data = None
+        if field_data and isinstance(field_data, tuple):
+            added = field_data[0]
+            removed = field_data[1]
+
+            if removed:
+                await field.adelete_files(removed)
+
+            if added:
+                await field.aupload_files(added)
+                await run_sync(field.release_chunked_uploads, added)
+
+            # Fields without a queryset list their files from the manifest.
+            form.cleaned_data[fieldname] = processed_data = await run_io(field.get_processed)
+
+        return processed_data
+
+
+async def aprocess_files(form, defer=False):
+    from .mixins import FormNotValidException
+
+    if not await run_sync(form.is_valid):
+        raise FormNotValidException
+
+    fieldnames = [name for (name, field) in form.fields.items() if isinstance(field, MultiFileField)]
+    await asyncio.gather(*[aprocess_files_for(form, name, defer=defer) for name in fieldnames])
+    return form.cleaned_data
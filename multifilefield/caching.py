@@ -0,0 +1,46 @@
+import time, hashlib
+
+from django.core.cache import cache
+from django.utils.encoding import force_bytes
+
+
+VERSION_KEY = 'multifilefield:version'
+
+
+
+def new_version():
+    # Restart from the clock if the stamp was evicted, so fragments
+    # cached under an earlier stamp can't be served again.
+    return int(time.time() * 1000000)
+
+
+def get_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, new_version(), None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def bump_version(*args, **kwargs):
+    """Invalidates every cached fragment.  Connected to UploadedFile's
+    post_save and post_delete, and called for bulk changes that don't
+    send them."""
+
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, new_version(), None)
+
+
+def make_key(*parts):
+    digest = hashlib.md5(force_bytes('|'.join(repr(part) for part in parts))).hexdigest()
+    return 'multifilefield:fragment:%s' % digest
+
+
+def get_fragment(key):
+    return cache.get(key)
+
+
+def set_fragment(key, html, timeout):
+    cache.set(key, html, timeout)
@@ -1,9 +1,25 @@
-import os, math, floppyforms as forms
+import os, sys, copy, math, six, hashlib, floppyforms as forms
 
+from multiprocessing.pool import ThreadPool
+from django.db import transaction
+from django.db.models import Sum
 from django.core.exceptions import ValidationError
 from django.core.files import File
 from django.core.files.storage import default_storage
-
+from django.contrib.contenttypes.models import ContentType
+
+try:
+    from django.core.exceptions import EmptyResultSet
+except ImportError:
+    from django.db.models.sql.datastructures import EmptyResultSet
+
+from .caching import bump_version
+from .manifest import FileManifest, StoredFile
+from .thumbnails import thumbnail_name
+from .signals import timed
+from .sniffing import sniff_file, matches
+from .models import UploadedFile, ChunkedUpload, FileQuota, get_fanout, get_owner_dir, guess_content_type, shard_name
+from .staging import StagedUploadedFile, unstage_file
 from .widgets import MultiFileWidget, AddFilesWidget, ClearFilesWidget
 
 
@@ -15,6 +31,81 @@ class NoFileFieldNameException(Exception):
 
 
 
+class FileChoices(object):
+    """Lazy, memoized (id, file) choices for the clear files field.
+
+    Nothing is fetched until the choices are iterated (ie: when the
+    ClearFilesWidget renders or a cleared id is validated), and then only
+    the id and file columns are selected, along with the uploaded name
+    of models that keep one.  count() uses a COUNT query unless the
+    choices have already been loaded."""
+
+    def __init__(self, queryset=None, filefield_name=None, files=None):
+        self.queryset = queryset
+        self.filefield_name = filefield_name
+        self.files = files
+        self._choices = None
+
+
+    def __deepcopy__(self, memo):
+        # A form's copy of the field gets choices of its own, unloaded, so
+        # the files listed are those of the request that renders them.
+        return FileChoices(
+            queryset = self.queryset.all() if self.queryset is not None else None,
+            filefield_name = self.filefield_name,
+            files = self.files)
+
+
+    def load(self):
+        if self._choices is None:
+            if self.queryset is not None:
+                field = self.queryset.model._meta.get_field(self.filefield_name)
+                self._choices = []
+                for row in self.queryset.values_list('id', self.filefield_name, *self.get_extra_fields()):
+                    file_obj = field.attr_class(None, field, row[1])
+                    if len(row) > 2:
+                        # Deduplicated files are stored under their checksum.
+                        file_obj.filename = row[2]
+                    self._choices.append((row[0], file_obj))
+            elif self.files:
+                self._choices = [(file_obj.name.split('/')[-1], file_obj) for file_obj in self.files]
+            else:
+                self._choices = []
+
+        return self._choices
+
+
+    def get_extra_fields(self):
+        names = [f.name for f in self.queryset.model._meta.get_fields()]
+        return ['filename'] if 'filename' in names else []
+
+
+    def cache_key(self):
+        """Identifies the choices without loading them."""
+
+        if self.queryset is not None:
+            try:
+                return '%s:%s' % (self.queryset.query, self.filefield_name)
+            except EmptyResultSet:
+                return None
+        return ':'.join(file_obj.name for file_obj in self.files or [])
+
+
+    def count(self):
+        if self._choices is None and self.queryset is not None:
+            return self.queryset.count()
+        return len(self.load())
+
+
+    def __iter__(self):
+        return iter(self.load())
+
+
+    def __len__(self):
+        return len(self.load())
+
+
+
 class ClearFilesField(forms.MultipleChoiceField):
     """This field is a modified multiplechoicefield that displays
     a list of uploaded files allowing the user to choose which
@@ -26,6 +117,18 @@ class ClearFilesField(forms.MultipleChoiceField):
         super(ClearFilesField, self).__init__(*args, **kwargs)
 
 
+    def _get_choices(self):
+        return self._choices
+
+
+    def _set_choices(self, value):
+        # Unlike ChoiceField, don't call list() on the choices so
+        # FileChoices stays lazy until the widget renders.
+        self._choices = self.widget.choices = value
+
+    choices = property(_get_choices, _set_choices)
+
+
 
 class AddFilesField(forms.FileField):
     """This field is a modified file field that handles
@@ -38,6 +141,8 @@ class AddFilesField(forms.FileField):
         'min_num': 'No less than %(min_num)s files uploaded at a time, please (received %(num_files)s).',
         'max_num': 'No more than %(max_num)s files uploaded at a time, please (received %(num_files)s).',
         'file_size': 'File %(uploaded_file_name)s exceeds maximum upload size of %(max_size)s.',
+        'invalid_token': 'Upload %(token)s is unknown or incomplete.',
+        'file_type': 'File %(uploaded_file_name)s is of a type that is not allowed (%(content_type)s).',
     }
 
 
@@ -45,19 +150,43 @@ class AddFilesField(forms.FileField):
         self.min_num        = kwargs.pop('min_num', 0)
         self.max_num        = kwargs.pop('max_num', None)
         self.max_file_size  = kwargs.pop('max_file_size', None)
+        self.allowed_types  = kwargs.pop('allowed_types', None)
+        self.denied_types   = kwargs.pop('denied_types', None)
 
         super(AddFilesField, self).__init__(*args, **kwargs)
 
 
     def to_python(self, data):
+        tokens = [item for item in data if isinstance(item, six.string_types)]
+        staged = self.resolve_tokens(tokens) if tokens else {}
+
         ret = []
         for item in data:
+            if isinstance(item, six.string_types):
+                item = staged[item]
             i = super(AddFilesField, self).to_python(item)
             if i:
                 ret.append(i)
         return ret
 
 
+    def resolve_tokens(self, tokens):
+        """Turns the tokens of completed chunked uploads into files."""
+
+        staged = {}
+        for upload in ChunkedUpload.objects.filter(token__in = tokens):
+            if upload.complete:
+                file_obj = StagedUploadedFile(upload.path, upload.name, upload.content_type)
+                file_obj.token = upload.token
+                staged[upload.token] = file_obj
+
+        for token in tokens:
+            if token not in staged:
+                raise ValidationError(self.error_messages['invalid_token'] % {'token': token})
+
+        return staged
+
+
     def clean(self, data, initial=None):
         return super(AddFilesField, self).clean(data, initial)
 
@@ -74,6 +203,11 @@ class AddFilesField(forms.FileField):
 
 
     def validate(self, data):
+        with timed(self, 'validate', data):
+            self.validate_files(data)
+
+
+    def validate_files(self, data):
         super(AddFilesField, self).validate(data)
 
         uploaded_files = data
@@ -92,13 +226,31 @@ class AddFilesField(forms.FileField):
                 'max_num': self.max_num,
                 'num_files': num_files})
 
-        if self.max_file_size:
+        if self.max_file_size or self.allowed_types or self.denied_types:
             for uploaded_file in uploaded_files:
-                if uploaded_file.size > self.max_file_size:
+                if self.max_file_size and uploaded_file.size > self.max_file_size:
                     raise ValidationError(self.error_messages['file_size'] % {
                         'uploaded_file_name': uploaded_file.name,
                         'max_size': self.humanize(self.max_file_size)})
 
+                self.validate_type(uploaded_file)
+
+
+    def validate_type(self, uploaded_file):
+        """Checks the type the file's first bytes identify, rather than the
+        name or the content type the browser sent."""
+
+        if not (self.allowed_types or self.denied_types) or uploaded_file.file is None:
+            # Files rejected while streaming have no content to sniff.
+            return
+
+        content_type = sniff_file(uploaded_file)
+        allowed = not self.allowed_types or matches(content_type, self.allowed_types)
+        if not allowed or (self.denied_types and matches(content_type, self.denied_types)):
+            raise ValidationError(self.error_messages['file_type'] % {
+                'uploaded_file_name': uploaded_file.name,
+                'content_type': content_type})
+
 
 
 class MultiFileField(forms.MultiValueField):
@@ -112,12 +264,14 @@ class MultiFileField(forms.MultiValueField):
     the user can both upload and clear.
     """
 
-    def __init__(self, *args, **kwargs):
-        default_error_messages = {
-            'total_num': 'No more than %(total_num)s files in total, please (tried %(attempt_num)s).',
-            'required': 'At least one file must be uploaded.'
-        }
+    default_error_messages = {
+        'total_num': 'No more than %(total_num)s files in total, please (tried %(attempt_num)s).',
+        'total_size': 'No more than %(total_size)s in total, please (tried %(attempt_size)s).',
+        'required': 'At least one file must be uploaded.'
+    }
 
+
+    def __init__(self, *args, **kwargs):
         label               = kwargs.pop('label', 'Uploads')
         add_label           = kwargs.pop('add_label', 'Attach files:')
         add_help_text       = kwargs.pop('add_help_text', 'Hold shift to select multiple files.  To upload selected files submit form.')
@@ -125,17 +279,32 @@ class MultiFileField(forms.MultiValueField):
         clear_help_text     = kwargs.pop('clear_help_text', 'To clear attached files click their associated checkbox and submit form.')
 
         max_file_size   = kwargs.pop('max_file_size', 1024*1024*5)
+        allowed_types   = kwargs.pop('allowed_types', None)
+        denied_types    = kwargs.pop('denied_types', None)
         max_num_files   = kwargs.pop('max_num_files', 5)
         min_num_files   = kwargs.pop('min_num_files', 0)
 
         self._required      = kwargs.pop('required', False)
         self.max_num_total  = kwargs.pop('max_num_total', None)
+        self.max_total_size = kwargs.pop('max_total_size', None)
+        self.quota_key      = kwargs.pop('quota_key', None)
+        self.owner          = kwargs.pop('owner', None)
         self.files          = kwargs.pop('files', None)
         self.queryset       = kwargs.pop('queryset', None)
         self.filefield_name = kwargs.pop('filefield_name', None)
         self.storage        = kwargs.pop('storage', default_storage)
-
-        if self.queryset and not self.filefield_name:
+        self.bulk_upload    = kwargs.pop('bulk_upload', False)
+        self.upload_concurrency = kwargs.pop('upload_concurrency', None)
+        self.deduplicate    = kwargs.pop('deduplicate', False)
+        self.thumbnail_size = kwargs.pop('thumbnail_size', None)
+        render_cache_timeout = kwargs.pop('render_cache_timeout', None)
+        self.manifest       = None
+
+        if self.owner is not None and self.queryset is None:
+            self.queryset = UploadedFile.objects.owned_by(self.owner)
+            self.filefield_name = self.filefield_name or 'upload'
+
+        if self.queryset is not None and not self.filefield_name:
             raise NoFileFieldNameException
 
 
@@ -148,6 +317,8 @@ class MultiFileField(forms.MultiValueField):
             max_num = max_num_files,
             min_num = min_num_files,
             max_file_size = max_file_size,
+            allowed_types = allowed_types,
+            denied_types = denied_types,
             required = False)
 
 
@@ -155,6 +326,10 @@ class MultiFileField(forms.MultiValueField):
             label = clear_label,
             help_text = clear_help_text,
             choices = choices,
+            widget = ClearFilesWidget(
+                thumbnail_size = self.thumbnail_size,
+                storage = self.storage,
+                cache_timeout = render_cache_timeout),
             required = False)
 
 
@@ -170,19 +345,45 @@ class MultiFileField(forms.MultiValueField):
             required = False)
 
 
+    def __deepcopy__(self, memo):
+        """Django copies the declared fields for every form instance.
+        Only what a form may change is copied: the subfields, the widgets
+        and their attrs, and the choices, which are rebound unloaded.  The
+        files, storage and the rest of the configuration are shared."""
+
+        result = copy.copy(self)
+        memo[id(self)] = result
+        result.validators = self.validators[:]
+        result.choices = copy.deepcopy(self.choices, memo)
+        result.queryset = result.choices.queryset
+
+        fields = []
+        for field in self.fields:
+            field = copy.copy(field)
+            field.validators = field.validators[:]
+            field.widget = copy.copy(field.widget)
+            field.widget.attrs = field.widget.attrs.copy()
+            fields.append(field)
+
+        result.fields = tuple(fields)
+        # Sets the clear widget's choices too.
+        result.fields[1].choices = result.choices
+
+        result.widget = copy.copy(self.widget)
+        result.widget.attrs = self.widget.attrs.copy()
+        result.widget.widgets = [field.widget for field in result.fields]
+
+        return result
+
+
     def make_choices_from_arguments(self):
-        choices = []
-        if self.queryset:
-            for file_obj in self.queryset:
-                choices.append((file_obj.id, getattr(file_obj, self.filefield_name)))
-        elif self.files:
+        if self.queryset is None and self.files:
             assert all([isinstance(file_obj, File) for file_obj in self.files]), ASSERT_FILE_CHOICES
-            choices = [(file_obj.name.split('/')[-1], file_obj) for file_obj in self.files]
-        else:
-            # raise NoFilesOrQuerySetException
-            pass
 
-        return choices
+        return FileChoices(
+            queryset = self.queryset,
+            filefield_name = self.filefield_name,
+            files = self.files)
 
 
     def clean(self, *args, **kwargs):
@@ -209,13 +410,18 @@ class MultiFileField(forms.MultiValueField):
 
 
     def validate(self, data_list):
-        files_total = len(self.choices)
+        """With a quota_key the totals come from its FileQuota row, a
+        single indexed read, rather than from counting the choices."""
 
+        files_to_upload = files_to_delete = None
         if data_list:
             files_to_upload = data_list[0]
             files_to_delete = data_list[1]
-            files_total += len(files_to_upload) if files_to_upload else 0
-            files_total -= len(files_to_delete) if files_to_delete else 0
+
+        quota = self.get_quota()
+        files_total = quota.num_files if quota else self.choices.count()
+        files_total += len(files_to_upload) if files_to_upload else 0
+        files_total -= len(files_to_delete) if files_to_delete else 0
 
         if self._required:
             if files_total == 0:
@@ -224,65 +430,425 @@ class MultiFileField(forms.MultiValueField):
         if self.max_num_total:
             if files_total > self.max_num_total:
                 raise ValidationError(self.error_messages['total_num'] % {
-                    'total_num': max_num_total,
+                    'total_num': self.max_num_total,
                     'attempt_num': files_total})
 
+        if self.max_total_size:
+            size_total = quota.total_size if quota else self.get_total_size()
+            size_total += sum(f.size or 0 for f in files_to_upload or [])
+            if files_to_delete:
+                size_total -= self.get_total_size(files_to_delete)
+
+            if size_total > self.max_total_size:
+                humanize = self.fields[0].humanize
+                raise ValidationError(self.error_messages['total_size'] % {
+                    'total_size': humanize(self.max_total_size),
+                    'attempt_size': humanize(max(size_total, 1))})
+
+
+    def get_quota(self):
+        """The FileQuota of the field's quota_key, unsaved and empty when
+        nothing has been stored under it yet."""
+
+        if not self.quota_key or self.queryset is None:
+            return None
+
+        quota = FileQuota.objects.using(self.queryset.db).filter(key = self.quota_key).first()
+        return quota or FileQuota(key = self.quota_key)
+
+
+    def get_total_size(self, file_ids=None):
+        if self.queryset is None:
+            files = self.files or []
+            if file_ids is not None:
+                file_ids = set(file_ids)
+                files = [f for f in files if f.name.split('/')[-1] in file_ids]
+            return sum(f.size for f in files)
+
+        queryset = self.queryset
+        if file_ids is not None:
+            queryset = queryset.filter(id__in = [int(i) for i in file_ids if str(i).isdigit()])
+        return queryset.aggregate(total = Sum('size'))['total'] or 0
+
+
+    def update_quota(self, num_files, total_size):
+        if num_files or total_size:
+            FileQuota.add(self.quota_key, num_files, total_size, using = self.queryset.db)
+
+
+    def release_quota(self, uploaded_files):
+        """Takes deleted rows off the quota.  Rows stored under another key,
+        or before the field had one, were never counted."""
+
+        counted = [f for f in uploaded_files if getattr(f, 'quota_key', self.quota_key) == self.quota_key]
+        self.update_quota(-len(counted), -sum(getattr(f, 'size', None) or 0 for f in counted))
+
+
+    def get_manifest(self):
+        """The index of the file names in the storage location, used in
+        place of listing the directory when the field is given files."""
+
+        if self.manifest is None:
+            self.manifest = FileManifest(self.storage.location, depth=get_fanout())
+        return self.manifest
+
 
     def get_files(self):
-        files = []
-        for filename in os.listdir(self.storage.location):
-            pth = os.path.join(self.storage.location, filename)
-            with open(pth) as f:
-                files.append(File(f))
+        return [StoredFile(self.storage, name) for name in self.get_manifest().names()]
 
-        return files
+
+    def get_zip_response(self, filename='files.zip', compress=False):
+        """Streams the files of the field's queryset as one zip archive."""
+
+        from .views import zip_response
+
+        if self.queryset is None:
+            raise NotImplementedError
+
+        return zip_response(self.queryset, self.filefield_name, filename, compress, self.storage)
 
 
     def get_processed(self):
-        if self.queryset:
+        if self.queryset is not None:
             return self.queryset.all()
         elif self.files:
             return self.get_files()
 
 
     def delete_file_fs(self, file_name):
+        # The clear field offers basenames, which may live in a shard.
+        name = self.get_manifest().resolve(file_name)
         try:
-            self.storage.delete(file_name)
-        except ValueError, e:
+            self.storage.delete(name)
+        except ValueError:
             pass
 
+        self.get_manifest().discard(name)
+
         return file_name
 
 
+    def get_checksum(self, file_obj):
+        """The sha256 of the file's content, computed once while streaming
+        its chunks and remembered on the file object."""
+
+        checksum = getattr(file_obj, 'checksum', None)
+        if checksum is None:
+            sha = hashlib.sha256()
+            for chunk in file_obj.chunks():
+                sha.update(chunk)
+            file_obj.seek(0)
+            file_obj.checksum = checksum = sha.hexdigest()
+
+        return checksum
+
+
+    def save_file(self, file_obj):
+        if self.deduplicate:
+            return self.save_file_deduplicated(file_obj)
+
+        relpath = self.get_save_name(file_obj)
+        with timed(self, 'storage_save', [file_obj]):
+            filename = self.storage.save(relpath, file_obj)
+
+        return filename
+
+
+    def get_owner_type(self):
+        """The owner's content type, kept with the owner it was looked up
+        for so threads that name files don't query for it."""
+
+        if self.owner is None:
+            return None
+
+        owner, owner_type = getattr(self, '_owner_type', (None, None))
+        if owner is not self.owner:
+            owner_type = ContentType.objects.get_for_model(self.owner)
+            self._owner_type = (self.owner, owner_type)
+        return owner_type
+
+
+    def get_save_name(self, file_obj):
+        """The name to save a file under, before the storage makes it
+        unique."""
+
+        if self.queryset is not None:
+            # Hash before the storage possibly moves a temporary file away.
+            self.get_checksum(file_obj)
+
+        relpath = self.storage.get_valid_name(os.path.basename(file_obj.name))
+        if self.owner is not None:
+            relpath = os.path.join(get_owner_dir(self.get_owner_type().pk, self.owner.pk), relpath)
+
+        return os.path.normpath(shard_name(relpath))
+
+
+    def save_file_deduplicated(self, file_obj):
+        """Stores the file once under its checksum.  Content that is
+        already in storage is not written again."""
+
+        ext = os.path.splitext(file_obj.name)[1].lower()
+        relpath = shard_name(self.storage.get_valid_name('%s%s' % (self.get_checksum(file_obj), ext)))
+
+        with timed(self, 'storage_save', [file_obj]) as timer:
+            if self.storage.exists(relpath):
+                timer.num_bytes = 0
+            else:
+                filename = self.storage.save(relpath, file_obj)
+                if filename != relpath:
+                    # Someone else stored the same content in the meantime.
+                    self.storage.delete(filename)
+
+        return relpath
+
+
+    def save_files(self, files):
+        """Saves files to storage and returns their names in the order given.
+        If a save fails the files that were saved are removed again.
+
+        With upload_concurrency the saves run on a thread pool of at most
+        that many threads.  Every save is allowed to finish before the error
+        of the first failed file (in the order given) is raised."""
+
+        if not self.upload_concurrency or len(files) < 2:
+            filenames = []
+            try:
+                for file_obj in files:
+                    filenames.append(self.save_file(file_obj))
+            except Exception:
+                exc_info = sys.exc_info()
+                self.delete_storage_files(filenames)
+                six.reraise(*exc_info)
+
+            return filenames
+
+        # Looked up here, the pool threads have no connection of their own.
+        self.get_owner_type()
+
+        pool = ThreadPool(min(self.upload_concurrency, len(files)))
+        try:
+            results = [pool.apply_async(self.save_file, (file_obj,)) for file_obj in files]
+            pool.close()
+            pool.join()
+        finally:
+            pool.terminate()
+
+        filenames = []
+        errors = []
+        for result in results:
+            try:
+                filenames.append(result.get())
+            except Exception:
+                errors.append(sys.exc_info())
+
+        if errors:
+            self.delete_storage_files(filenames)
+            six.reraise(*errors[0])
+
+        return filenames
+
+
     def upload_file_fs(self, file_obj):
-        relpath = os.path.normpath(self.storage.get_valid_name(os.path.basename(file_obj.name)))
-        filename = self.storage.save(relpath, file_obj)
+        filename = self.save_file(file_obj)
+        self.get_manifest().add(filename)
 
         return file_obj
 
 
+    def get_unreferenced(self, file_names):
+        """Filters out deduplicated files still referenced by a row.
+        Their names start with the checksum, so the rows are found through
+        the indexed checksum column."""
+
+        checksums = set(os.path.splitext(os.path.basename(name))[0] for name in file_names)
+        referenced = set(self.queryset.model._default_manager
+            .filter(checksum__in = checksums)
+            .values_list(self.filefield_name, flat = True))
+
+        return [name for name in file_names if name not in referenced]
+
+
+    def get_deletable_names(self, file_names):
+        """The names to remove from storage for files that were deleted:
+        deduplicated files nothing else refers to, and their thumbnails."""
+
+        if self.deduplicate and self.queryset is not None:
+            file_names = self.get_unreferenced(file_names)
+
+        names = list(file_names)
+        if self.thumbnail_size:
+            names += [thumbnail_name(name, self.thumbnail_size) for name in file_names]
+
+        return names
+
+
+    def delete_storage_files(self, file_names):
+        """Hands a batch of file names to the storage.  Storages that
+        provide a delete_many method get the whole batch at once."""
+
+        names = self.get_deletable_names(file_names)
+
+        with timed(self, 'storage_delete', names):
+            if hasattr(self.storage, 'delete_many'):
+                self.storage.delete_many(names)
+            else:
+                for name in names:
+                    self.storage.delete(name)
+
+        return file_names
+
+
     def delete_file_queryset(self, file_id):
-        try:
-            uploaded_file = self.queryset.get(id = int(file_id))
-            self.storage.delete(uploaded_file.basename)
-            uploaded_file.delete()
-        except ValueError, e:
-            pass
+        uploaded_files = self.delete_files_queryset([file_id])
+        return uploaded_files[0] if uploaded_files else None
 
-        return uploaded_file
+
+    def delete_files_queryset(self, file_ids):
+        """Fetches every file to delete with a single id__in query, so
+        invalid or foreign ids are simply not found, deletes the rows in
+        one statement and then removes the files from storage."""
+
+        uploaded_files = self.delete_rows(file_ids)
+        if uploaded_files:
+            self.delete_storage_files([getattr(f, self.filefield_name).name for f in uploaded_files])
+
+        return uploaded_files
+
+
+    def get_file_ids(self, file_ids):
+        ids = []
+        for file_id in file_ids:
+            try:
+                ids.append(int(file_id))
+            except (TypeError, ValueError):
+                pass
+
+        return ids
+
+
+    def delete_rows(self, file_ids):
+        ids = self.get_file_ids(file_ids)
+        if not ids:
+            return []
+
+        with timed(self, 'orm_delete') as timer:
+            uploaded_files = list(self.queryset.filter(id__in = ids))
+            if uploaded_files:
+                model = self.queryset.model
+                model._default_manager.filter(id__in = [f.id for f in uploaded_files]).delete()
+            timer.num_files = len(uploaded_files)
+
+        return uploaded_files
+
+
+    def get_file_fields(self, file_obj, filename):
+        """The values of the new row.  The metadata columns are filled in
+        from the upload, for models that have them."""
+
+        fields = {
+            'upload': filename,
+            # Deduplicated files are stored under their checksum, the name
+            # they were uploaded with is what they are downloaded as.
+            'filename': os.path.basename(file_obj.name or filename),
+            'size': file_obj.size,
+            'content_type': getattr(file_obj, 'content_type', None) or guess_content_type(file_obj.name),
+            'quota_key': self.quota_key or '',
+        }
+
+        if self.owner is not None:
+            fields['owner_type'] = self.get_owner_type()
+            fields['owner_id'] = self.owner.pk
+
+        names = set(field.name for field in self.queryset.model._meta.fields)
+        if 'checksum' in names:
+            fields['checksum'] = self.get_checksum(file_obj)
+
+        return dict((name, value) for (name, value) in fields.items() if name == 'upload' or name in names)
+
+
+    def create_file_queryset(self, file_obj, filename):
+        with timed(self, 'orm_insert', [file_obj]):
+            return self.queryset.create(**self.get_file_fields(file_obj, filename))
 
 
     def upload_file_queryset(self, file_obj):
-        relpath = os.path.normpath(self.storage.get_valid_name(os.path.basename(file_obj.name)))
-        filename = self.storage.save(relpath, file_obj)
-        uploaded_file = self.queryset.create(upload = filename)
+        filename = self.save_file(file_obj)
+        uploaded_file = self.create_file_queryset(file_obj, filename)
 
         return uploaded_file
 
 
+    def upload_files_queryset(self, files):
+        """Saves every file to storage and then inserts all the rows with
+        a single bulk_create inside one transaction.  If anything fails the
+        files already written to storage are removed again.
+
+        The created objects are returned; their ids are only set on
+        backends that return primary keys from bulk inserts."""
+
+        filenames = []
+
+        try:
+            with transaction.atomic(using = self.queryset.db):
+                filenames = self.save_files(files)
+                uploaded_files = self.bulk_create_files_queryset(files, filenames)
+
+            # bulk_create doesn't send post_save.
+            bump_version()
+        except Exception:
+            exc_info = sys.exc_info()
+            self.delete_storage_files(filenames)
+            six.reraise(*exc_info)
+
+        return uploaded_files
+
+
+    def bulk_create_files_queryset(self, files, filenames):
+        model = self.queryset.model
+        uploaded_files = [model(**self.get_file_fields(file_obj, filename))
+            for (file_obj, filename) in zip(files, filenames)]
+
+        with timed(self, 'orm_insert', files):
+            return self.queryset.bulk_create(uploaded_files)
+
+
+    def is_transactional(self):
+        """Quota counters only move along with the rows, and shared
+        deduplicated files are only written or removed while the rows that
+        refer to them are locked."""
+
+        return self.queryset is not None and bool(self.quota_key or self.deduplicate)
+
+
+    def lock_checksums(self, files):
+        """Locks the rows sharing the stored files of files until the
+        transaction ends.  A delete that would remove one of those files
+        waits for the upload to commit, and an upload that finds a file
+        about to be removed waits until it is gone and stores it again."""
+
+        checksums = set(self.get_checksum(file_obj) for file_obj in files)
+        list(self.queryset.model._default_manager.select_for_update()
+            .filter(checksum__in = checksums)
+            .values_list('id', flat = True))
+
+
     def delete_files(self, file_ids):
-        if self.queryset:
-            mth = self.delete_file_queryset
+        with timed(self, 'delete') as timer:
+            if self.is_transactional():
+                # Storage files are removed before the rows' deletion commits.
+                with transaction.atomic(using = self.queryset.db):
+                    files = self.clear_files(file_ids)
+                    if self.quota_key:
+                        self.release_quota(files)
+            else:
+                files = self.clear_files(file_ids)
+            timer.num_files = len(files)
+        return files
+
+
+    def clear_files(self, file_ids):
+        if self.queryset is not None:
+            return self.delete_files_queryset(file_ids)
         elif self.files:
             mth = self.delete_file_fs
         else:
@@ -292,10 +858,69 @@ class MultiFileField(forms.MultiValueField):
         return files
 
 
+    def release_chunked_uploads(self, files):
+        """Forgets the chunked uploads among files once they have been
+        stored, removing whatever is left of their staging files."""
+
+        tokens = []
+        for file_obj in files:
+            if getattr(file_obj, 'token', None):
+                tokens.append(file_obj.token)
+                file_obj.close()
+                unstage_file(file_obj.path)
+
+        if tokens:
+            ChunkedUpload.objects.filter(token__in = tokens).delete()
+
+        return tokens
+
+
+    def aupload_files(self, files):
+        """A coroutine doing what upload_files does without blocking the
+        event loop.  Python 3 only, see multifilefield.aio."""
+
+        from .aio import aupload_files
+        return aupload_files(self, files)
+
+
+    def adelete_files(self, file_ids):
+        """A coroutine doing what delete_files does without blocking the
+        event loop.  Python 3 only, see multifilefield.aio."""
+
+        from .aio import adelete_files
+        return adelete_files(self, file_ids)
+
+
     def upload_files(self, files):
-        if self.queryset:
+        with timed(self, 'upload', files):
+            if self.is_transactional():
+                with transaction.atomic(using = self.queryset.db):
+                    if self.deduplicate:
+                        self.lock_checksums(files)
+                    uploaded_files = self.store_files(files)
+                    if self.quota_key:
+                        self.update_quota(len(uploaded_files), sum(f.size or 0 for f in files))
+                return uploaded_files
+            return self.store_files(files)
+
+
+    def store_files(self, files):
+        if self.queryset is not None:
+            if self.bulk_upload:
+                return self.upload_files_queryset(files)
+            if self.upload_concurrency:
+                # Only the storage writes go to the pool, rows are
+                # created here on the request thread.
+                filenames = self.save_files(files)
+                return [self.create_file_queryset(file_obj, filename)
+                    for (file_obj, filename) in zip(files, filenames)]
             mth = self.upload_file_queryset
         elif self.files:
+            if self.upload_concurrency:
+                manifest = self.get_manifest()
+                for filename in self.save_files(files):
+                    manifest.add(filename)
+                return files
             mth = self.upload_file_fs
         else:
             raise NotImplementedError
@@ -0,0 +1,137 @@
+from functools import wraps
+
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+
+from .fields import MultiFileField
+
+
+
+class RejectedUploadedFile(UploadedFile):
+    """Stands in for a file whose content was discarded while streaming.
+    It keeps the name and the number of bytes received, so the field's
+    validation reports it just as it would the complete file."""
+
+    def __init__(self, name, content_type, size):
+        super(RejectedUploadedFile, self).__init__(None, name, content_type, size)
+
+
+    def chunks(self, chunk_size=None):
+        return iter(())
+
+
+    def open(self, mode=None):
+        return self
+
+
+    def close(self):
+        pass
+
+
+
+class LimitedUploadHandler(FileUploadHandler):
+    """An upload handler that enforces a MultiFileField's max_file_size and
+    max_num_files while the request is streamed in.
+
+    Once a file goes over the size limit, or a field receives more files
+    than allowed, the rest of that file is discarded instead of being
+    passed on to the memory or temporary file handlers.  A
+    RejectedUploadedFile is left in its place so the field raises its
+    usual validation error.  With abort=True the upload is stopped and
+    the connection reset instead, which saves the bandwidth but means
+    the form can't be redisplayed.
+
+    limits maps an input name (ie: 'uploads_0') to a (max_file_size,
+    max_num_files) tuple; for_form builds it from a form class."""
+
+    def __init__(self, request=None, limits=None, abort=False):
+        super(LimitedUploadHandler, self).__init__(request)
+
+        self.limits = limits or {}
+        self.abort = abort
+        self.counts = {}
+        self.received = 0
+        self.rejected = False
+
+
+    @classmethod
+    def for_form(cls, form_class, request=None, prefix=None, **kwargs):
+        limits = {}
+        for (name, field) in form_class.base_fields.items():
+            if isinstance(field, MultiFileField):
+                add_files = field.fields[0]
+                html_name = '%s-%s' % (prefix, name) if prefix else name
+                limits['%s_0' % html_name] = (add_files.max_file_size, add_files.max_num)
+
+        return cls(request, limits, **kwargs)
+
+
+    def reject(self):
+        if self.abort:
+            raise StopUpload(connection_reset = True)
+        self.rejected = True
+
+
+    def new_file(self, field_name, *args, **kwargs):
+        super(LimitedUploadHandler, self).new_file(field_name, *args, **kwargs)
+
+        self.received = 0
+        self.rejected = False
+
+        if field_name in self.limits:
+            max_file_size, max_num = self.limits[field_name]
+            self.counts[field_name] = count = self.counts.get(field_name, 0) + 1
+
+            if max_num and count > max_num:
+                self.reject()
+            elif max_file_size and self.content_length and self.content_length > max_file_size:
+                self.reject()
+
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.field_name not in self.limits:
+            return raw_data
+
+        self.received += len(raw_data)
+
+        max_file_size = self.limits[self.field_name][0]
+        if not self.rejected and max_file_size and self.received > max_file_size:
+            self.reject()
+
+        if self.rejected:
+            return None
+        return raw_data
+
+
+    def file_complete(self, file_size):
+        if self.field_name in self.limits and self.rejected:
+            return RejectedUploadedFile(self.file_name, self.content_type, self.received)
+        return None
+
+
+
+def limit_uploads(form_class, prefix=None, **kwargs):
+    """ A view decorator that installs form_class's LimitedUploadHandler
+        before the request body is read.
+
+        CsrfViewMiddleware reads request.POST before the view is called,
+        after which the upload handlers can't be changed.  So the view is
+        exempted from the middleware and checked by csrf_protect once the
+        handler is in place instead.
+
+        @limit_uploads(MyForm)
+        def my_view(request):
+            ...
+        """
+
+    def decorator(view):
+        protected_view = csrf_protect(view)
+
+        @wraps(view)
+        def limited_view(request, *args, **view_kwargs):
+            request.upload_handlers.insert(0, LimitedUploadHandler.for_form(form_class, request, prefix, **kwargs))
+            return protected_view(request, *args, **view_kwargs)
+
+        return csrf_exempt(limited_view)
+    return decorator
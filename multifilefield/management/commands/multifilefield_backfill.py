@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from multifilefield.models import UploadedFile
+
+
+class Command(BaseCommand):
+    help = 'Fills in the file name, size, content type and checksum of existing uploads.'
+
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+
+    def handle(self, *args, **options):
+        """Walks the rows missing metadata in primary key order, a batch at
+        a time, so the table is never loaded whole."""
+
+        batch_size = options['batch_size']
+        missing = UploadedFile.objects.filter(
+            Q(filename='') | Q(size__isnull=True) | Q(content_type='') | Q(checksum='')).order_by('pk')
+
+        last_pk = 0
+        filled = failed = 0
+        while True:
+            batch = list(missing.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                break
+
+            for uploaded_file in batch:
+                try:
+                    uploaded_file.fill_metadata()
+                except (IOError, OSError) as e:
+                    failed += 1
+                    self.stderr.write('%s: %s' % (uploaded_file.pk, e))
+                    continue
+
+                # update() leaves updated_at and the save signals alone.
+                UploadedFile.objects.filter(pk=uploaded_file.pk).update(
+                    filename = uploaded_file.filename,
+                    size = uploaded_file.size,
+                    content_type = uploaded_file.content_type,
+                    checksum = uploaded_file.checksum)
+                filled += 1
+
+            last_pk = batch[-1].pk
+
+        self.stdout.write('Filled %s files, %s failed.' % (filled, failed))
@@ -0,0 +1,69 @@
+import os, time
+
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.files import locks
+from django.core.management.base import BaseCommand
+
+from multifilefield.models import ChunkedUpload
+from multifilefield.staging import get_staging_root, unstage_file
+
+
+class Command(BaseCommand):
+    help = 'Removes chunked uploads, and their staging files, that nothing has been written to for a while.'
+
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age', type=int,
+            default=getattr(settings, 'MULTIFILEFIELD_CHUNKED_EXPIRY', 60 * 60 * 24),
+            help='Seconds since the last chunk after which an upload has expired.')
+
+
+    def handle(self, *args, **options):
+        """Uploads still being written to hold a lock on their staging
+        file and are left alone.  Completed uploads that were never
+        submitted to a form expire the same way."""
+
+        cutoff = datetime.today() - timedelta(seconds=options['max_age'])
+        removed = 0
+
+        for upload in ChunkedUpload.objects.filter(updated_at__lt=cutoff).order_by('pk'):
+            if self.remove_upload(upload):
+                removed += 1
+
+        # Staging files whose row has gone without them.
+        root = get_staging_root()
+        tokens = set(ChunkedUpload.objects.values_list('token', flat=True))
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            token, ext = os.path.splitext(name)
+            if ext == '.part' and token not in tokens and os.path.getmtime(path) < time.time() - options['max_age']:
+                unstage_file(path)
+                removed += 1
+
+        self.stdout.write('Removed %s expired uploads.' % removed)
+
+
+    def remove_upload(self, upload):
+        try:
+            f = open(upload.path, 'r+b')
+        except IOError:
+            ChunkedUpload.objects.filter(pk=upload.pk).delete()
+            return True
+
+        with f:
+            try:
+                locks.lock(f, locks.LOCK_EX | locks.LOCK_NB)
+            except (IOError, OSError):
+                return False
+
+            try:
+                # Only if no chunk has arrived since it was read.
+                if not ChunkedUpload.objects.filter(pk=upload.pk, offset=upload.offset).delete()[0]:
+                    return False
+                unstage_file(upload.path)
+            finally:
+                locks.unlock(f)
+
+        return True
@@ -0,0 +1,174 @@
+import os, errno
+
+from django.core.files.storage import FileSystemStorage
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import import_string
+
+from multifilefield.caching import bump_version
+from multifilefield.manifest import MANIFEST_NAME
+from multifilefield.models import UploadedFile, get_fanout, shard_name, is_sharded
+from multifilefield.thumbnails import THUMBNAIL_MARK, is_thumbnail
+
+
+class Command(BaseCommand):
+    help = 'Moves flat uploads into the directories of MULTIFILEFIELD_FANOUT.'
+
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true', default=False)
+        parser.add_argument('--location', default=None,
+            help='Move the files of a directory used with files instead of UploadedFile rows.')
+        parser.add_argument('--storage', default=None,
+            help='The dotted path of the storage, or storage class, the rows\' files were saved to '
+                'when it isn\'t the one of the model\'s file field.')
+
+
+    def handle(self, *args, **options):
+        self.fanout = get_fanout()
+        self.dry_run = options['dry_run']
+        self.storage = self.get_storage(options['storage'])
+        self.thumbnails = {}
+        self.moved = 0
+
+        if not self.fanout:
+            self.stderr.write('MULTIFILEFIELD_FANOUT is not set, nothing to do.')
+            return
+
+        if options['location']:
+            self.move_location(options['location'])
+        else:
+            self.move_rows(options['batch_size'])
+
+        self.stdout.write('%s %s files.' % ('Would move' if self.dry_run else 'Moved', self.moved))
+
+
+    def get_storage(self, path):
+        if not path:
+            return None
+
+        storage = import_string(path)
+        return storage() if isinstance(storage, type) else storage
+
+
+    def get_thumbnails(self, src):
+        """The names of the thumbnails stored next to a file, from one
+        listing of each directory."""
+
+        dirname, basename = os.path.split(src)
+        if dirname not in self.thumbnails:
+            found = self.thumbnails[dirname] = {}
+            for name in os.listdir(dirname):
+                if is_thumbnail(name):
+                    found.setdefault(name.rsplit(THUMBNAIL_MARK, 1)[0], []).append(name)
+
+        return self.thumbnails[dirname].get(os.path.splitext(basename)[0], [])
+
+
+    def move(self, src, dest):
+        """Moves a file along with its thumbnails, which keep their names
+        next to it."""
+
+        for name in self.get_thumbnails(src):
+            self.link(os.path.join(os.path.dirname(src), name), os.path.join(os.path.dirname(dest), name))
+
+        self.link(src, dest)
+
+
+    def remove(self, src):
+        for name in self.get_thumbnails(src):
+            self.unlink(os.path.join(os.path.dirname(src), name))
+
+        self.unlink(src)
+
+
+    def link(self, src, dest):
+        """Makes the file available under its new path while the old one
+        still works, so requests served during the move find it either way."""
+
+        if self.dry_run:
+            return
+
+        dirname = os.path.dirname(dest)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        try:
+            os.link(src, dest)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+
+    def unlink(self, path):
+        if self.dry_run:
+            return
+
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+    def move_rows(self, batch_size):
+        """Walks UploadedFile in primary key batches.  Every file is linked
+        into its shard, the rows are pointed at it and only then is the old
+        name removed."""
+
+        last_pk = 0
+        moved = set()
+        while True:
+            batch = list(UploadedFile.objects.filter(pk__gt=last_pk).order_by('pk')[:batch_size])
+            if not batch:
+                break
+
+            for uploaded_file in batch:
+                name = uploaded_file.upload.name
+                if not name or is_sharded(name, self.fanout):
+                    continue
+
+                new_name = shard_name(name, self.fanout)
+                storage = self.storage or uploaded_file.upload.storage
+                src, dest = storage.path(name), storage.path(new_name)
+                if name in moved or (not os.path.exists(src) and os.path.exists(dest)):
+                    # A deduplicated file an earlier row already moved.
+                    continue
+                if not os.path.exists(src):
+                    self.stderr.write('%s: %s is missing' % (uploaded_file.pk, name))
+                    continue
+
+                self.move(src, dest)
+                if not self.dry_run:
+                    # Every row sharing the file moves with it.
+                    UploadedFile.objects.filter(upload=name).update(upload=new_name)
+                self.remove(src)
+                moved.add(name)
+                self.moved += 1
+
+            # update() doesn't send post_save, cached clear lists would
+            # still link to the old names.
+            if not self.dry_run:
+                bump_version()
+            last_pk = batch[-1].pk
+
+
+    def move_location(self, location):
+        """Moves the top level files of a directory, thumbnails along
+        with their originals, then drops its manifest so it is rebuilt
+        from the new layout."""
+
+        storage = FileSystemStorage(location=location)
+        for name in sorted(os.listdir(location)):
+            src = os.path.join(location, name)
+            if name.startswith(MANIFEST_NAME) or is_thumbnail(name) or not os.path.isfile(src):
+                continue
+
+            self.move(src, storage.path(shard_name(name, self.fanout)))
+            self.remove(src)
+            self.moved += 1
+
+        self.unlink(os.path.join(location, MANIFEST_NAME))
@@ -0,0 +1,227 @@
+import os, json, time, errno
+
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+from multifilefield.manifest import MANIFEST_NAME, FileManifest
+from multifilefield.models import UploadedFile, get_fanout
+from multifilefield.thumbnails import is_thumbnail
+
+
+class Command(BaseCommand):
+    help = ('Reports stored files without an UploadedFile row and rows without a file.  '
+        'Nothing is deleted without --delete.')
+
+
+    def add_arguments(self, parser):
+        parser.add_argument('--location', default=None,
+            help='The directory to reconcile, MULTIFILEFIELD_ROOT by default.')
+        parser.add_argument('--storage', default=None,
+            help='The dotted path of the storage, or storage class, the rows\' files were saved to '
+                'when it isn\'t the one of the model\'s file field.')
+        parser.add_argument('--min-age', type=int, default=24 * 60 * 60,
+            help='Only delete files older than this many seconds, so uploads in flight are left alone.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--checkpoint', default=None,
+            help='A file to record progress in, so an interrupted run resumes where it stopped.')
+        parser.add_argument('--delete', action='store_true', default=False,
+            help='Delete the orphaned files.  Without it they are only listed.')
+        parser.add_argument('--delete-missing-rows', action='store_true', default=False,
+            help='With --delete, also delete rows whose file is gone.')
+
+
+    def handle(self, *args, **options):
+        """Walks the directory in sorted order and the table in primary key
+        order, a batch at a time, so neither side is ever loaded whole.
+        Each batch of files is checked against the rows with one upload__in
+        query and each batch of rows against the file system.
+
+        Files listed in the manifest of a directory kept by a field with
+        files, thumbnails and the staging area are never orphans.  Rows
+        are only judged when their storage puts the file in the directory."""
+
+        location = options['location'] or getattr(settings, 'MULTIFILEFIELD_ROOT', None)
+        if not location:
+            # MEDIA_ROOT holds the files of other apps too.
+            raise CommandError('Pass --location or set MULTIFILEFIELD_ROOT.')
+
+        self.location = os.path.abspath(location)
+        self.storage = self.get_storage(options['storage'])
+        self.staging_root = getattr(settings, 'MULTIFILEFIELD_STAGING_ROOT', None)
+        self.manifests = {}
+        self.batch_size = options['batch_size']
+        self.dry_run = not options['delete']
+        self.checkpoint_path = options['checkpoint']
+        self.cutoff = time.time() - options['min_age']
+        self.pool = ThreadPool(max(options['workers'], 1))
+
+        self.state = self.load_checkpoint()
+        try:
+            if self.state.get('phase', 'files') == 'files':
+                self.collect_files()
+                self.save_checkpoint(phase='rows', last=None)
+            self.collect_rows(options['delete_missing_rows'])
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+        if self.checkpoint_path and not self.dry_run and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+        self.stdout.write('%s %s orphaned files, %s rows without a file%s.' % (
+            'Would delete' if self.dry_run else 'Deleted',
+            self.state.get('files', 0),
+            self.state.get('rows', 0),
+            '' if options['delete_missing_rows'] else ' (not deleted)'))
+
+
+    def load_checkpoint(self):
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as f:
+                state = json.load(f)
+            if state.get('location') == self.location:
+                return state
+        return {'location': self.location, 'phase': 'files', 'last': None, 'files': 0, 'rows': 0}
+
+
+    def get_storage(self, path):
+        if not path:
+            return UploadedFile._meta.get_field('upload').storage
+
+        storage = import_string(path)
+        return storage() if isinstance(storage, type) else storage
+
+
+    def save_checkpoint(self, **values):
+        self.state.update(values)
+        if not self.checkpoint_path or self.dry_run:
+            return
+
+        tmp_path = '%s.tmp' % self.checkpoint_path
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f)
+        os.rename(tmp_path, self.checkpoint_path)
+
+
+    def walk(self, parts=(), after=None):
+        """Yields the path components of every file, sorted, skipping
+        everything up to and including after."""
+
+        path = os.path.join(self.location, *parts)
+        if self.staging_root and os.path.abspath(path) == os.path.abspath(self.staging_root):
+            return
+
+        names = sorted(os.listdir(path))
+        if MANIFEST_NAME in names:
+            self.manifests[parts] = set(FileManifest(path, depth=get_fanout()).names())
+
+        for name in names:
+            if name.startswith(MANIFEST_NAME):
+                continue
+
+            entry = parts + (name,)
+            if os.path.isdir(os.path.join(path, name)):
+                if after is None or entry >= tuple(after[:len(entry)]):
+                    for found in self.walk(entry, after):
+                        yield found
+            elif after is None or entry > tuple(after):
+                yield entry
+
+
+    def batches(self, iterable):
+        batch = []
+        for item in iterable:
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+    def collect_files(self):
+        for batch in self.batches(self.walk(after=self.state.get('last'))):
+            names = ['/'.join(parts) for parts in batch]
+
+            # Rows may hold names relative to the storage or absolute paths.
+            paths = dict((name, os.path.join(self.location, name)) for name in names)
+            referenced = set(UploadedFile.objects
+                .filter(upload__in = names + list(paths.values()))
+                .values_list('upload', flat = True))
+
+            orphans = [paths[name] for (parts, name) in zip(batch, names)
+                if name not in referenced and paths[name] not in referenced
+                and not self.is_listed(parts) and not is_thumbnail(name) and self.is_old(paths[name])]
+
+            if orphans and not self.dry_run:
+                self.pool.map(self.remove, orphans)
+            for path in orphans:
+                self.stdout.write(path)
+
+            self.save_checkpoint(last=list(batch[-1]), files=self.state.get('files', 0) + len(orphans))
+
+
+    def collect_rows(self, delete_rows):
+        last_pk = self.state.get('last') or 0
+        while True:
+            batch = list(UploadedFile.objects.filter(pk__gt = last_pk).order_by('pk').values_list('pk', 'upload')[:self.batch_size])
+            if not batch:
+                break
+
+            # Rows whose file the storage keeps somewhere else are left alone.
+            paths = [(pk, self.get_path(name)) for (pk, name) in batch if name]
+            paths = [(pk, path) for (pk, path) in paths if path is not None]
+            exists = self.pool.map(os.path.exists, [path for (pk, path) in paths])
+            missing = [pk for ((pk, path), found) in zip(paths, exists) if not found]
+
+            for pk in missing:
+                self.stderr.write('UploadedFile %s has no file' % pk)
+            if missing and delete_rows and not self.dry_run:
+                UploadedFile.objects.filter(pk__in = missing).delete()
+
+            last_pk = batch[-1][0]
+            self.save_checkpoint(last=last_pk, rows=self.state.get('rows', 0) + len(missing))
+
+
+    def get_path(self, name):
+        """The path the storage keeps a row's file at, or None when that
+        isn't in the directory."""
+
+        try:
+            path = os.path.abspath(name if os.path.isabs(name) else self.storage.path(name))
+        except (NotImplementedError, SuspiciousFileOperation):
+            return None
+
+        if not path.startswith(os.path.join(self.location, '')):
+            return None
+        return path
+
+
+    def is_listed(self, parts):
+        """Whether the manifest of a directory above the file lists it."""
+
+        for i in range(len(parts)):
+            listed = self.manifests.get(parts[:i])
+            if listed is not None and '/'.join(parts[i:]) in listed:
+                return True
+        return False
+
+
+    def is_old(self, path):
+        try:
+            return os.path.getmtime(path) < self.cutoff
+        except OSError:
+            return False
+
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
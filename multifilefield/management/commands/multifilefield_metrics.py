@@ -0,0 +1,39 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from multifilefield.metrics import BUCKETS, get_histograms, reset_histograms
+
+
+class Command(BaseCommand):
+    help = 'Dumps the phase timings collected by multifilefield.metrics.Aggregator.'
+
+
+    def add_arguments(self, parser):
+        parser.add_argument('--json', action='store_true', default=False)
+        parser.add_argument('--reset', action='store_true', default=False,
+            help='Clear the timings after dumping them.')
+
+
+    def handle(self, *args, **options):
+        histograms = get_histograms()
+
+        if options['json']:
+            self.stdout.write(json.dumps(dict((phase, histogram.state())
+                for (phase, histogram) in histograms.items()), indent=2, sort_keys=True))
+        else:
+            self.stdout.write('%-16s %8s %10s %10s %10s %10s %10s %12s' % (
+                'phase', 'count', 'mean ms', 'p50 ms', 'p95 ms', 'max ms', 'files', 'bytes'))
+            for phase in sorted(histograms):
+                h = histograms[phase]
+                self.stdout.write('%-16s %8d %10.1f %10s %10s %10.1f %10d %12d' % (
+                    phase, h.count, h.total / h.count if h.count else 0,
+                    self.bound(h.percentile(0.5)), self.bound(h.percentile(0.95)),
+                    h.max, h.files, h.bytes))
+
+        if options['reset']:
+            reset_histograms()
+
+
+    def bound(self, value):
+        return '<=%s' % value if value is not None else '>%s' % BUCKETS[-1]
@@ -0,0 +1,62 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Sum
+
+from multifilefield.models import UploadedFile, FileQuota
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the FileQuota counters from the UploadedFile rows.'
+
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+
+    def handle(self, *args, **options):
+        """Walks the quota keys in order, a batch at a time, and sets each
+        counter from an aggregate over its rows.  Uploads running at the
+        same time may be counted twice or not at all, so run it again
+        once things are quiet if it matters."""
+
+        batch_size = options['batch_size']
+        repaired = 0
+
+        totals = (UploadedFile.objects.exclude(quota_key='')
+            .values('quota_key')
+            .annotate(num_files=Count('id'), total_size=Sum('size'))
+            .order_by('quota_key'))
+
+        last_key = ''
+        while True:
+            batch = list(totals.filter(quota_key__gt=last_key)[:batch_size])
+            if not batch:
+                break
+
+            for row in batch:
+                self.set_totals(row['quota_key'], row['num_files'], row['total_size'] or 0)
+                repaired += 1
+            last_key = batch[-1]['quota_key']
+
+        # Keys left without any files.
+        last_key = ''
+        while True:
+            keys = list(FileQuota.objects.filter(key__gt=last_key).order_by('key').values_list('key', flat=True)[:batch_size])
+            if not keys:
+                break
+
+            used = set(UploadedFile.objects.filter(quota_key__in=keys).values_list('quota_key', flat=True).distinct())
+            for key in keys:
+                if key not in used:
+                    self.set_totals(key, 0, 0)
+                    repaired += 1
+            last_key = keys[-1]
+
+        self.stdout.write('Repaired %s quotas.' % repaired)
+
+
+    def set_totals(self, key, num_files, total_size):
+        values = {'num_files': num_files, 'total_size': total_size, 'updated_at': datetime.today()}
+        if not FileQuota.objects.filter(key=key).update(**values):
+            FileQuota.objects.create(key=key, **values)
@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from multifilefield.tasks import run_pending, requeue_stale
+
+
+class Command(BaseCommand):
+    help = 'Runs deferred FileTasks, including those left behind by a process that went away.'
+
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', default=False,
+            help='Run what is pending and exit, instead of polling.')
+        parser.add_argument('--sleep', type=float, default=5,
+            help='Seconds to wait between polls when there is nothing to do.')
+        parser.add_argument('--max-attempts', type=int, default=3)
+        parser.add_argument('--batch-size', type=int, default=100)
+
+
+    def handle(self, *args, **options):
+        """Each task is claimed with a conditional update, so any number
+        of workers, and the in-process pool, can run side by side.  A
+        running task is only taken to be lost once its heartbeat has
+        stopped for MULTIFILEFIELD_TASK_TIMEOUT seconds."""
+
+        while True:
+            requeued, failed = requeue_stale(options['max_attempts'])
+            ran = run_pending(options['batch_size'])
+
+            if ran or requeued or failed:
+                self.stdout.write('Ran %s tasks, requeued %s and failed %s stale ones.' % (ran, requeued, failed))
+
+            if options['once']:
+                break
+            if not ran:
+                # Don't hold a connection open while idle.
+                for connection in connections.all():
+                    connection.close()
+                time.sleep(options['sleep'])
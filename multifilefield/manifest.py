@@ -0,0 +1,241 @@
+import os, threading
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from django.core.files import File, locks
+from django.utils.encoding import force_text
+
+
+MANIFEST_NAME = '.multifilefield'
+COMPACT_MIN = 1000
+
+
+
+class StoredFile(File):
+    """A File for a name in a storage that is only opened when its
+    content is read.  Size and url come from the storage."""
+
+    def __init__(self, storage, name, mode='rb'):
+        self.storage = storage
+        self.name = name
+        self.mode = mode
+        self._file = None
+
+
+    def _get_file(self):
+        if self._file is None:
+            self._file = self.storage.open(self.name, self.mode)
+        return self._file
+
+
+    def _set_file(self, file):
+        self._file = file
+
+
+    def _del_file(self):
+        del self._file
+
+    file = property(_get_file, _set_file, _del_file)
+
+
+    def _get_size(self):
+        if not hasattr(self, '_size'):
+            self._size = self.storage.size(self.name)
+        return self._size
+
+    size = property(_get_size, File._set_size)
+
+
+    @property
+    def url(self):
+        return self.storage.url(self.name)
+
+
+    @property
+    def closed(self):
+        return self._file is None or self._file.closed
+
+
+    def open(self, mode=None):
+        if not self.closed:
+            self.seek(0)
+        else:
+            self.file = self.storage.open(self.name, mode or self.mode)
+        return self
+
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+
+class FileManifest(object):
+    """An append only index of the file names kept in a directory.
+
+    Every line is a name prefixed with '+' when it was added or '-' when
+    it was removed.  The index is bootstrapped with one listing of the
+    directory; after that only lines appended since the last read are
+    replayed, so listing the files doesn't touch the directory at all.
+    Once removals outnumber the live names the index is rewritten.
+
+    Processes append under a shared lock on a file next to the index and
+    rewrite it under an exclusive one, so no line goes to a file that is
+    about to be replaced.
+
+    With a depth the files are expected that many directories down, as
+    laid out by the MULTIFILEFIELD_FANOUT setting."""
+
+    def __init__(self, location, name=MANIFEST_NAME, depth=0):
+        self.location = location
+        self.manifest_name = name
+        self.depth = depth
+        self.path = os.path.join(location, name)
+        self.lock_path = '%s.lock' % self.path
+        self.lock = threading.Lock()
+
+        self._names = None
+        self._inode = None
+        self._offset = 0
+        self._lines = 0
+
+
+    def _replay(self, data):
+        for line in data.decode('utf-8').splitlines():
+            op, name = line[:1], line[1:]
+            if op == '+':
+                self._names[name] = True
+            elif op == '-':
+                self._names.pop(name, None)
+            self._lines += 1
+
+
+    def _refresh(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            self._bootstrap()
+            return
+
+        if self._names is None or stat.st_ino != self._inode or stat.st_size < self._offset:
+            self._names = OrderedDict()
+            self._inode = stat.st_ino
+            self._offset = 0
+            self._lines = 0
+
+        if stat.st_size > self._offset:
+            with open(self.path, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read()
+
+            # Only replay complete lines, a partial one is still being written.
+            end = data.rfind(b'\n') + 1
+            self._replay(data[:end])
+            self._offset += end
+
+
+    def _list(self, relpath, depth):
+        names = []
+        path = os.path.join(self.location, relpath)
+        for name in sorted(os.listdir(path)):
+            if name.startswith(self.manifest_name):
+                continue
+
+            name = os.path.join(relpath, name) if relpath else name
+            if depth and os.path.isdir(os.path.join(self.location, name)):
+                names.extend(self._list(name, depth - 1))
+            elif os.path.isfile(os.path.join(self.location, name)):
+                names.append(name)
+
+        return names
+
+
+    @contextmanager
+    def _locked(self, flags):
+        if not os.path.isdir(self.location):
+            os.makedirs(self.location)
+
+        with open(self.lock_path, 'ab') as f:
+            locks.lock(f, flags)
+            try:
+                yield
+            finally:
+                locks.unlock(f)
+
+
+    def _bootstrap(self):
+        with self._locked(locks.LOCK_EX):
+            # Another process may have written it while we waited.
+            if not os.path.exists(self.path):
+                self._write(self._list('', self.depth))
+
+        self._names = None
+        self._refresh()
+
+
+    def _write(self, names):
+        tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            for name in names:
+                f.write(('+%s\n' % force_text(name)).encode('utf-8'))
+        os.rename(tmp_path, self.path)
+
+
+    def _append(self, op, name):
+        # Our own line is replayed on the next refresh along with lines
+        # other processes may have appended in the meantime.
+        with self._locked(locks.LOCK_SH):
+            with open(self.path, 'ab') as f:
+                f.write(('%s%s\n' % (op, force_text(name))).encode('utf-8'))
+
+
+    def names(self):
+        with self.lock:
+            self._refresh()
+            return list(self._names)
+
+
+    def resolve(self, name):
+        """The listed name for a name or bare basename, or the name itself
+        when it isn't listed."""
+
+        with self.lock:
+            self._refresh()
+            if name in self._names:
+                return name
+            for listed in self._names:
+                if os.path.basename(listed) == name:
+                    return listed
+        return name
+
+
+    def add(self, name):
+        with self.lock:
+            self._refresh()
+            if name not in self._names:
+                self._append('+', name)
+                self._names[name] = True
+
+
+    def discard(self, name):
+        with self.lock:
+            self._refresh()
+            if name in self._names:
+                self._append('-', name)
+                del self._names[name]
+
+            if self._lines - len(self._names) > max(len(self._names), COMPACT_MIN):
+                self._compact()
+
+
+    def _compact(self):
+        with self._locked(locks.LOCK_EX):
+            if not os.path.exists(self.path):
+                # Removed in the meantime, the next refresh bootstraps it.
+                return
+
+            # Lines other processes appended since our last read are kept.
+            self._refresh()
+            self._write(list(self._names))
+        self._refresh()
@@ -0,0 +1,225 @@
+import atexit, bisect, threading
+
+from timeit import default_timer
+
+from django.core.cache import cache
+
+from .signals import phase_timed
+
+
+METRICS_KEY = 'multifilefield:metrics:%s:%s'
+PHASES_KEY = 'multifilefield:metrics'
+
+COUNTERS = ('count', 'files', 'bytes', 'failed', 'total_us')
+
+# Upper bounds of the duration buckets, in milliseconds.
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+
+
+
+def connect(sink):
+    """Starts sending the timings of every phase to sink."""
+
+    phase_timed.connect(sink, weak=False, dispatch_uid=id(sink))
+    return sink
+
+
+def disconnect(sink):
+    return phase_timed.disconnect(dispatch_uid=id(sink))
+
+
+
+class MetricsSink(object):
+    """Receives phase_timed.  Subclasses implement record."""
+
+    def __call__(self, sender, phase, duration, num_files, num_bytes, failed=False, **kwargs):
+        self.record(phase, duration, num_files, num_bytes, failed)
+
+
+    def record(self, phase, duration, num_files, num_bytes, failed):
+        raise NotImplementedError
+
+
+
+class StatsdSink(MetricsSink):
+    """Adapts a statsd style client, anything with timing(name, ms) and
+    incr(name, count) methods."""
+
+    def __init__(self, client, prefix='multifilefield'):
+        self.client = client
+        self.prefix = prefix
+
+
+    def record(self, phase, duration, num_files, num_bytes, failed):
+        name = '%s.%s' % (self.prefix, phase)
+        self.client.timing(name, duration * 1000)
+        self.client.incr('%s.files' % name, num_files)
+        self.client.incr('%s.bytes' % name, num_bytes)
+        if failed:
+            self.client.incr('%s.failed' % name, 1)
+
+
+
+class Histogram(object):
+    """Counts durations in the BUCKETS, plus totals of files and bytes."""
+
+    def __init__(self, state=None):
+        state = state or {}
+        self.buckets = state.get('buckets') or [0] * (len(BUCKETS) + 1)
+        self.count = state.get('count', 0)
+        self.total = state.get('total', 0.0)
+        self.max = state.get('max', 0.0)
+        self.files = state.get('files', 0)
+        self.bytes = state.get('bytes', 0)
+        self.failed = state.get('failed', 0)
+
+
+    def add(self, duration, num_files, num_bytes, failed):
+        ms = duration * 1000
+        self.buckets[bisect.bisect_left(BUCKETS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+        self.files += num_files
+        self.bytes += num_bytes
+        self.failed += 1 if failed else 0
+
+
+    def merge(self, other):
+        self.buckets = [a + b for (a, b) in zip(self.buckets, other.buckets)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        self.files += other.files
+        self.bytes += other.bytes
+        self.failed += other.failed
+
+
+    def counters(self):
+        """The totals as (name, integer) pairs, as kept in the cache."""
+
+        values = [self.count, self.files, self.bytes, self.failed, int(round(self.total * 1000))]
+        return list(zip(COUNTERS, values)) + [('bucket_%s' % i, n) for (i, n) in enumerate(self.buckets)]
+
+
+    def percentile(self, fraction):
+        """The upper bound of the bucket holding the given fraction of
+        the durations, None past the last bucket."""
+
+        seen = 0
+        for (i, n) in enumerate(self.buckets):
+            seen += n
+            if self.count and seen >= self.count * fraction:
+                return BUCKETS[i] if i < len(BUCKETS) else None
+        return None
+
+
+    def state(self):
+        return {
+            'buckets': self.buckets,
+            'count': self.count,
+            'total': self.total,
+            'max': self.max,
+            'files': self.files,
+            'bytes': self.bytes,
+            'failed': self.failed}
+
+
+
+class Aggregator(MetricsSink):
+    """Keeps a histogram per phase in process and adds it to the cache at
+    most every flush_interval seconds, and when the process exits, so the
+    multifilefield_metrics command can dump them from any process.
+
+    Every total is a counter of its own that flushes add to with
+    cache.incr, so processes flushing at the same time don't overwrite
+    each other.  That needs a cache all processes share, such as
+    memcached or redis; with the default local memory cache each process
+    only sees its own timings.  The maximum is the exception, a larger
+    one flushed at the same moment may be lost."""
+
+    def __init__(self, flush_interval=10):
+        self.flush_interval = flush_interval
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.flushed_at = default_timer()
+        atexit.register(self.flush)
+
+
+    def record(self, phase, duration, num_files, num_bytes, failed):
+        with self.lock:
+            histogram = self.histograms.get(phase)
+            if histogram is None:
+                histogram = self.histograms[phase] = Histogram()
+            histogram.add(duration, num_files, num_bytes, failed)
+
+            due = default_timer() - self.flushed_at >= self.flush_interval
+
+        if due:
+            self.flush()
+
+
+    def flush(self):
+        with self.lock:
+            histograms, self.histograms = self.histograms, {}
+            self.flushed_at = default_timer()
+
+        if not histograms:
+            return
+
+        for (phase, histogram) in histograms.items():
+            for (name, value) in histogram.counters():
+                if value:
+                    incr(METRICS_KEY % (phase, name), value)
+            set_max(METRICS_KEY % (phase, 'max_us'), int(round(histogram.max * 1000)))
+
+        # A phase lost to a concurrent flush is added back by the next one.
+        phases = set(cache.get(PHASES_KEY) or [])
+        if not phases.issuperset(histograms):
+            cache.set(PHASES_KEY, sorted(phases.union(histograms)), None)
+
+
+
+def incr(key, delta):
+    if cache.add(key, delta, None):
+        return
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        # Evicted since add.
+        cache.add(key, delta, None)
+
+
+def set_max(key, value):
+    if not cache.add(key, value, None) and (cache.get(key) or 0) < value:
+        cache.set(key, value, None)
+
+
+def get_keys(phase):
+    return [METRICS_KEY % (phase, name) for name in COUNTERS + ('max_us',)] + \
+        [METRICS_KEY % (phase, 'bucket_%s' % i) for i in range(len(BUCKETS) + 1)]
+
+
+def get_histogram(phase):
+    values = cache.get_many(get_keys(phase))
+    value = lambda name: values.get(METRICS_KEY % (phase, name)) or 0
+
+    return Histogram({
+        'buckets': [value('bucket_%s' % i) for i in range(len(BUCKETS) + 1)],
+        'count': value('count'),
+        'total': value('total_us') / 1000.0,
+        'max': value('max_us') / 1000.0,
+        'files': value('files'),
+        'bytes': value('bytes'),
+        'failed': value('failed')})
+
+
+def get_histograms():
+    return dict((phase, get_histogram(phase)) for phase in cache.get(PHASES_KEY) or [])
+
+
+def reset_histograms():
+    keys = [PHASES_KEY]
+    for phase in cache.get(PHASES_KEY) or []:
+        keys += get_keys(phase)
+    cache.delete_many(keys)
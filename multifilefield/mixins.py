@@ -1,4 +1,7 @@
 from .fields import MultiFileField
+from .handlers import LimitedUploadHandler
+from .signals import timed
+from .tasks import enqueue
 
 
 
@@ -16,25 +19,62 @@ class FormNotValidException(Exception):
 
 
 class MultiFileFieldMixin():
-    def process_files(self):
+    @classmethod
+    def limit_uploads(cls, request, prefix=None, **kwargs):
+        """ Installs an upload handler that enforces the size and number
+            limits of this form's multifilefields while the request streams
+            in.  Call it before request.POST or request.FILES is accessed,
+            which CsrfViewMiddleware does before any view is called; the
+            multifilefield.handlers.limit_uploads decorator takes care of
+            that.
+            """
+
+        handler = LimitedUploadHandler.for_form(cls, request, prefix, **kwargs)
+        request.upload_handlers.insert(0, handler)
+        return handler
+
+
+    def process_files(self, defer=False):
         """ Process files for each field that is a multifilefield.
             """
 
         if not self.is_valid():
             raise FormNotValidException
 
-        for (fieldname, field) in self.fields:
+        for (fieldname, field) in self.fields.items():
             if isinstance (field, MultiFileField):
-                self.process_files_for(fieldname)
+                self.process_files_for(fieldname, defer=defer)
         return self.cleaned_data
 
 
-    def process_files_for(self, fieldname):
+    def aprocess_files(self, defer=False):
+        """ A coroutine doing what process_files does, with the fields
+            processed concurrently.  Python 3 only, see multifilefield.aio.
+            """
+
+        from .aio import aprocess_files
+        return aprocess_files(self, defer=defer)
+
+
+    def aprocess_files_for(self, fieldname, defer=False):
+        """ A coroutine doing what process_files_for does without
+            blocking the event loop.  Python 3 only.
+            """
+
+        from .aio import aprocess_files_for
+        return aprocess_files_for(self, fieldname, defer=defer)
+
+
+    def process_files_for(self, fieldname, defer=False):
         """ Cleaned multifilefield data structure is a tuple (arg1, arg2).
             arg1 (to_add) = [file_obj] (list of uploaded file objects to add),
             arg2 (to_remove) [file_id] (list of file_ids to remove).
 
             Currently this only works with queryset argument.
+
+            With defer=True the work is only recorded and done by a
+            background worker; the FileTask to poll is returned and put
+            in cleaned_data instead of the processed files.
             """
 
 
@@ -48,18 +88,29 @@ class MultiFileFieldMixin():
         if not storage:
             raise NoStorageException
 
+        with timed(self, 'process'):
+            return self.process_field_data(fieldname, field, defer)
+
+
+    def process_field_data(self, fieldname, field, defer=False):
         field_data = self.cleaned_data.pop(fieldname, None)
 
-        original_set = []
+        processed_data = None
         if field_data and isinstance(field_data, tuple):
             added = field_data[0]
             removed = field_data[1]
 
+            if defer:
+                self.cleaned_data[fieldname] = task = enqueue(field, fieldname, added, removed, form=self)
+                field.release_chunked_uploads(added)
+                return task
+
             if removed:
                 field.delete_files(removed)
 
             if added:
                  field.upload_files(added)
+                 field.release_chunked_uploads(added)
 
             self.cleaned_data[fieldname] = processed_data = field.get_processed()
 
@@ -1,8 +1,14 @@
-import os
+import os, uuid, hashlib, mimetypes
 
 from datetime import datetime
 from django.db import models
+from django.db.models.signals import post_save, post_delete
 from django.conf import settings
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.contenttypes.models import ContentType
+
+from .caching import bump_version
+from .staging import get_staging_root
 
 
 
@@ -10,22 +16,85 @@ def get_path(basename):
     return os.path.join(getattr(settings, 'MULTIFILEFIELD_ROOT', settings.MEDIA_ROOT), basename)
 
 
+def get_fanout():
+    return getattr(settings, 'MULTIFILEFIELD_FANOUT', 0)
+
+
+def shard_name(name, fanout=None):
+    """Puts a file name fanout directories down, each named after the
+    next two hex digits of the md5 of its basename.  Two levels spread
+    files over 65536 directories."""
+
+    fanout = get_fanout() if fanout is None else fanout
+    dirname, basename = os.path.split(name)
+    digest = hashlib.md5(basename.encode('utf-8')).hexdigest()
+    parts = [digest[i * 2:i * 2 + 2] for i in range(fanout)]
+
+    return os.path.join(dirname, *(parts + [basename]))
+
+
+def is_sharded(name, fanout=None):
+    """Whether a name is in the directories shard_name puts it in.  The
+    directories are compared with the digest of the basename, as owner
+    directories such as 12/34 look just like shard directories."""
+
+    fanout = get_fanout() if fanout is None else fanout
+    if not fanout:
+        return True
+
+    dirname, basename = os.path.split(name)
+    shard_dir = os.path.dirname(shard_name(basename, fanout))
+    return dirname == shard_dir or dirname.endswith(os.sep + shard_dir)
+
+
+def guess_content_type(name):
+    return mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+
+def get_owner_dir(owner_type_id, owner_id):
+    if owner_type_id is None or owner_id is None:
+        return ''
+    return os.path.join(str(owner_type_id), str(owner_id))
+
+
 def upload_to(instance, name):
-    # This should be able to handle a foreignkey property specified in meta.
-    # ie: if specified, path would be root/foreignkey.id/basename
+    # Files with an owner go in root/owner type id/owner id/basename.
+
+    owner_dir = get_owner_dir(getattr(instance, 'owner_type_id', None), getattr(instance, 'owner_id', None))
+    return get_path(shard_name(os.path.join(owner_dir, name)))
+
 
-    return get_path(name)
+
+class UploadedFileQuerySet(models.QuerySet):
+    def owned_by(self, owner):
+        """The files of an owner, oldest first, which the (owner_type,
+        owner_id, created_at) index answers with a range scan."""
+
+        return self.filter(
+            owner_type = ContentType.objects.get_for_model(owner),
+            owner_id = owner.pk).order_by('created_at', 'id')
 
 
 
 class UploadedFile(models.Model):
     upload = models.FileField(upload_to=upload_to, max_length=400)
+    filename = models.CharField('file name', max_length=255, blank=True, db_index=True)
+    size = models.BigIntegerField('size', null=True, blank=True, db_index=True)
+    content_type = models.CharField('content type', max_length=255, blank=True, db_index=True)
+    checksum = models.CharField('checksum', max_length=64, blank=True, db_index=True)
+    quota_key = models.CharField('quota key', max_length=255, blank=True, db_index=True)
+    owner_type = models.ForeignKey(ContentType, null=True, blank=True, on_delete=models.CASCADE, related_name='+')
+    owner_id = models.PositiveIntegerField('owner id', null=True, blank=True)
+    owner = GenericForeignKey('owner_type', 'owner_id')
     created_at = models.DateTimeField('created', null=True, blank=True, default=datetime.now)
     updated_at = models.DateTimeField('updated', null=True, blank=True)
 
+    objects = UploadedFileQuerySet.as_manager()
+
     class Meta:
         verbose_name = 'Uploaded File'
         verbose_name_plural = 'Uploaded Files'
+        index_together = [('owner_type', 'owner_id', 'created_at')]
 
 
     def __unicode__(self):
@@ -34,16 +103,183 @@ class UploadedFile(models.Model):
 
     @property
     def basename(self):
-        return self.upload.url.split('/')[-1]
+        return self.filename or os.path.basename(self.upload.name)
+
+
+    def fill_metadata(self):
+        """Reads whatever metadata is missing from the stored file.  Files
+        uploaded through a MultiFileField get it at upload time instead."""
+
+        name = self.upload.name
+        self.filename = self.filename or os.path.basename(name)
+        self.content_type = self.content_type or guess_content_type(name)
+
+        if self.size is None:
+            self.size = self.upload.storage.size(name)
+
+        if not self.checksum:
+            sha = hashlib.sha256()
+            with self.upload.storage.open(name, 'rb') as f:
+                for chunk in f.chunks():
+                    sha.update(chunk)
+            self.checksum = sha.hexdigest()
 
 
     def save(self, *args, **kwargs):
         self.updated_at = datetime.today()
         if not self.id:
             self.created_at = datetime.today()
+        if not self.filename and self.upload.name:
+            self.filename = os.path.basename(self.upload.name)
 
         return super(UploadedFile, self).save(*args, **kwargs)
 
 
     def get_absolute_url(self):
-        return get_path(self.basename)
+        return get_path(self.upload.name)
+
+
+    def get_download_url(self):
+        """The url of the download view, which needs multifilefield.urls
+        to be included."""
+
+        try:
+            from django.urls import reverse
+        except ImportError:
+            from django.core.urlresolvers import reverse
+
+        return reverse('multifilefield-download', args=[self.pk])
+
+
+post_save.connect(bump_version, sender=UploadedFile, dispatch_uid='multifilefield_uploadedfile_saved')
+post_delete.connect(bump_version, sender=UploadedFile, dispatch_uid='multifilefield_uploadedfile_deleted')
+
+
+
+class FileQuota(models.Model):
+    """ Running totals of the files stored under a quota key (ie: a user
+        or an object the files belong to), so a MultiFileField with a
+        quota_key checks max_num_total and max_total_size with a single
+        row read.  Kept up to date with F expressions as files are
+        uploaded and deleted.
+        """
+
+    key = models.CharField('key', max_length=255, unique=True)
+    num_files = models.BigIntegerField('number of files', default=0)
+    total_size = models.BigIntegerField('total size', default=0)
+    updated_at = models.DateTimeField('updated', null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'File Quota'
+        verbose_name_plural = 'File Quotas'
+
+
+    def __unicode__(self):
+        return '%s (%s files, %s bytes)' % (self.key, self.num_files, self.total_size)
+
+
+    @classmethod
+    def add(cls, key, num_files, total_size, using=None):
+        """ Adjusts the totals of a key atomically, creating its row the
+            first time round."""
+
+        manager = cls._default_manager.db_manager(using)
+        values = {
+            'num_files': models.F('num_files') + num_files,
+            'total_size': models.F('total_size') + total_size,
+            'updated_at': datetime.today()}
+
+        if not manager.filter(key=key).update(**values):
+            manager.get_or_create(key=key)
+            manager.filter(key=key).update(**values)
+
+
+
+class FileTask(models.Model):
+    """ Pending storage work recorded by a deferred process_files_for.
+        The row is the queue entry as well as the status a view can poll.
+        It names the form the field belongs to, the settings the view
+        gave the field and the staged files, so a worker can rebuild the
+        work after the process that recorded it is gone.
+        """
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    status = models.CharField('status', max_length=10, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    field_name = models.CharField('field name', max_length=255)
+    form_path = models.CharField('form', max_length=255, blank=True)
+    config = models.TextField('field settings', blank=True)
+    attempts = models.PositiveIntegerField('attempts', default=0)
+    added = models.TextField('added', blank=True)
+    removed = models.TextField('removed', blank=True)
+    error = models.TextField('error', blank=True)
+    created_at = models.DateTimeField('created', null=True, blank=True, default=datetime.now)
+    updated_at = models.DateTimeField('updated', null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'File Task'
+        verbose_name_plural = 'File Tasks'
+
+
+    def __unicode__(self):
+        return '%s (%s)' % (self.field_name, self.status)
+
+
+    def save(self, *args, **kwargs):
+        self.updated_at = datetime.today()
+        return super(FileTask, self).save(*args, **kwargs)
+
+
+
+def make_token():
+    return uuid.uuid4().hex
+
+
+
+class ChunkedUpload(models.Model):
+    """ A resumable upload being received in chunks.  The chunks are
+        written straight into one staging file at their offset, so a
+        complete upload needs no reassembly.  Its token can be submitted
+        to a MultiFileField in place of the file itself.
+        """
+
+    token = models.CharField('token', max_length=32, unique=True, default=make_token)
+    name = models.CharField('name', max_length=255)
+    content_type = models.CharField('content type', max_length=255, blank=True)
+    length = models.BigIntegerField('length')
+    offset = models.BigIntegerField('offset', default=0)
+    created_at = models.DateTimeField('created', null=True, blank=True, default=datetime.now)
+    updated_at = models.DateTimeField('updated', null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Chunked Upload'
+        verbose_name_plural = 'Chunked Uploads'
+
+
+    def __unicode__(self):
+        return '%s (%s/%s)' % (self.name, self.offset, self.length)
+
+
+    @property
+    def path(self):
+        return os.path.join(get_staging_root(), '%s.part' % self.token)
+
+
+    @property
+    def complete(self):
+        return self.offset >= self.length
+
+
+    def save(self, *args, **kwargs):
+        self.updated_at = datetime.today()
+        return super(ChunkedUpload, self).save(*args, **kwargs)
@@ -0,0 +1,62 @@
+from timeit import default_timer
+
+from django.dispatch import Signal
+
+
+# Sent once a phase of file processing is done, with the seconds it took
+# and the number of files and bytes it handled.
+phase_timed = Signal(providing_args=['phase', 'duration', 'num_files', 'num_bytes', 'failed'])
+
+
+
+class Timer(object):
+    """Times a block and sends phase_timed when it exits.  The counts
+    can be corrected inside the block once they are known."""
+
+    def __init__(self, sender, phase, files=None):
+        self.sender = sender
+        self.phase = phase
+        self.num_files = len(files) if files else 0
+        self.num_bytes = sum(getattr(file_obj, 'size', None) or 0 for file_obj in files or [])
+
+
+    def __enter__(self):
+        self.start = default_timer()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, tb):
+        phase_timed.send(
+            sender = self.sender,
+            phase = self.phase,
+            duration = default_timer() - self.start,
+            num_files = self.num_files,
+            num_bytes = self.num_bytes,
+            failed = exc_type is not None)
+
+
+
+class NullTimer(object):
+    num_files = num_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+    def __setattr__(self, name, value):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+
+def timed(sender, phase, files=None):
+    """Times a phase, for use as a context manager.  Without receivers
+    connected to phase_timed nothing is measured at all."""
+
+    if not phase_timed.receivers:
+        return NULL_TIMER
+    return Timer(sender, phase, files)
@@ -0,0 +1,151 @@
+import mmap, codecs, struct, fnmatch
+
+
+HEADER_SIZE = 4096
+
+# (offset, magic bytes, content type), most specific first.
+SIGNATURES = (
+    (0, b'\xff\xd8\xff', 'image/jpeg'),
+    (0, b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (0, b'GIF87a', 'image/gif'),
+    (0, b'GIF89a', 'image/gif'),
+    (0, b'II*\x00', 'image/tiff'),
+    (0, b'MM\x00*', 'image/tiff'),
+    (0, b'\x00\x00\x01\x00', 'image/x-icon'),
+    (0, b'%PDF-', 'application/pdf'),
+    (0, b'{\\rtf', 'application/rtf'),
+    (0, b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', 'application/x-ole-storage'),
+    (0, b'PK\x03\x04', 'application/zip'),
+    (0, b'PK\x05\x06', 'application/zip'),
+    (0, b'\x1f\x8b', 'application/gzip'),
+    (0, b'BZh', 'application/x-bzip2'),
+    (0, b'\xfd7zXZ\x00', 'application/x-xz'),
+    (0, b'7z\xbc\xaf\x27\x1c', 'application/x-7z-compressed'),
+    (0, b'Rar!\x1a\x07', 'application/vnd.rar'),
+    (257, b'ustar', 'application/x-tar'),
+    (0, b'ID3', 'audio/mpeg'),
+    (0, b'OggS', 'audio/ogg'),
+    (0, b'fLaC', 'audio/flac'),
+    (0, b'\x1aE\xdf\xa3', 'video/webm'),
+    (0, b'\x7fELF', 'application/x-executable'),
+    (0, b'\xca\xfe\xba\xbe', 'application/java-vm'),
+    (0, b'\xcf\xfa\xed\xfe', 'application/x-mach-binary'),
+)
+
+# RIFF and ISO media containers name their format a few bytes in.
+RIFF_TYPES = {b'WEBP': 'image/webp', b'WAVE': 'audio/wav', b'AVI ': 'video/x-msvideo'}
+FTYP_TYPES = {b'qt  ': 'video/quicktime', b'M4A ': 'audio/mp4', b'heic': 'image/heic', b'avif': 'image/avif'}
+
+# The sizes of the DIB headers a bitmap can have.
+BMP_HEADER_SIZES = (12, 40, 52, 56, 64, 108, 124)
+
+TEXT_MARKERS = (
+    (b'<?xml', 'application/xml'),
+    (b'<svg', 'image/svg+xml'),
+    (b'<!doctype html', 'text/html'),
+    (b'<html', 'text/html'),
+)
+
+
+
+def read_header(file_obj, size=HEADER_SIZE):
+    """The first size bytes of an upload, without reading the rest of it.
+    Files on disk are mapped rather than read, in memory files are peeked
+    at and left at the position they were in."""
+
+    if hasattr(file_obj, 'temporary_file_path'):
+        try:
+            with open(file_obj.temporary_file_path(), 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    return mapped[:size]
+                finally:
+                    mapped.close()
+        except (ValueError, EnvironmentError):
+            # Empty files can't be mapped.
+            pass
+
+    position = file_obj.tell()
+    try:
+        file_obj.seek(0)
+        return file_obj.read(size)
+    finally:
+        file_obj.seek(position)
+
+
+def is_bmp(header):
+    """'BM' starts plenty of text, so the reserved bytes have to be zero
+    and the DIB header one of the known sizes as well."""
+
+    if len(header) < 18 or header[:2] != b'BM' or header[6:10] != b'\x00' * 4:
+        return False
+    return struct.unpack('<I', header[14:18])[0] in BMP_HEADER_SIZES
+
+
+def is_pe(header):
+    """An MZ stub whose e_lfanew points at a PE header."""
+
+    if len(header) < 0x40 or header[:2] != b'MZ':
+        return False
+    offset = struct.unpack('<I', header[0x3c:0x40])[0]
+    return header[offset:offset + 4] == b'PE\x00\x00'
+
+
+def is_mp3_frame(header):
+    """An MPEG-1 layer III frame header with a valid bitrate and sample
+    rate."""
+
+    if len(header) < 4 or header[:2] != b'\xff\xfb':
+        return False
+    flags = bytearray(header[2:3])[0]
+    return (flags >> 4) not in (0, 15) and (flags >> 2) & 3 != 3
+
+
+def sniff(header):
+    """The content type a file's first bytes identify it as."""
+
+    for (offset, magic, content_type) in SIGNATURES:
+        if header[offset:offset + len(magic)] == magic:
+            return content_type
+
+    if is_bmp(header):
+        return 'image/bmp'
+    if is_pe(header):
+        return 'application/x-msdownload'
+    if is_mp3_frame(header):
+        return 'audio/mpeg'
+
+    if header[:4] == b'RIFF' and header[8:12] in RIFF_TYPES:
+        return RIFF_TYPES[header[8:12]]
+    if header[4:8] == b'ftyp':
+        return FTYP_TYPES.get(header[8:12], 'video/mp4')
+
+    if b'\x00' in header:
+        return 'application/octet-stream'
+
+    try:
+        # The header may end in the middle of a character, which the
+        # decoder holds back rather than failing on.
+        text = codecs.getincrementaldecoder('utf-8')().decode(header, False)
+    except UnicodeDecodeError:
+        return 'application/octet-stream'
+
+    start = text.lstrip(u'\ufeff \t\r\n')[:32].lower().encode('utf-8')
+    for (marker, content_type) in TEXT_MARKERS:
+        if start.startswith(marker):
+            return content_type
+
+    return 'text/plain'
+
+
+def sniff_file(file_obj):
+    content_type = getattr(file_obj, 'sniffed_type', None)
+    if content_type is None:
+        content_type = file_obj.sniffed_type = sniff(read_header(file_obj))
+    return content_type
+
+
+def matches(content_type, patterns):
+    """Whether a content type matches any of patterns like 'image/*'."""
+
+    return any(fnmatch.fnmatch(content_type, pattern.lower()) for pattern in patterns)
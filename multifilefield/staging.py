@@ -0,0 +1,75 @@
+import os, errno, tempfile
+
+from django.conf import settings
+from django.core.files.move import file_move_safe
+from django.core.files.uploadedfile import UploadedFile
+
+
+
+def get_staging_root():
+    root = getattr(settings, 'MULTIFILEFIELD_STAGING_ROOT', None)
+    if not root:
+        root = os.path.join(tempfile.gettempdir(), 'multifilefield')
+
+    if not os.path.isdir(root):
+        try:
+            os.makedirs(root)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    return root
+
+
+def stage_file(file_obj):
+    """Puts an uploaded file in the staging area so it outlives the
+    request.  Temporary uploads are moved (a rename on the same
+    filesystem), anything else is written out chunk by chunk."""
+
+    ext = os.path.splitext(file_obj.name)[1]
+    fd, path = tempfile.mkstemp(suffix=ext, dir=get_staging_root())
+
+    if hasattr(file_obj, 'temporary_file_path'):
+        os.close(fd)
+        file_move_safe(file_obj.temporary_file_path(), path, allow_overwrite=True)
+    else:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in file_obj.chunks():
+                f.write(chunk)
+
+    return {
+        'path': path,
+        'name': file_obj.name,
+        'content_type': getattr(file_obj, 'content_type', None)}
+
+
+def unstage_file(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+
+class StagedUploadedFile(UploadedFile):
+    """An uploaded file that lives in the staging area.  Like Django's
+    TemporaryUploadedFile it exposes temporary_file_path, so file system
+    storages move it into place rather than copying it."""
+
+    def __init__(self, path, name, content_type=None):
+        self.path = path
+        super(StagedUploadedFile, self).__init__(
+            open(path, 'rb'), name, content_type, os.path.getsize(path))
+
+
+    def temporary_file_path(self):
+        return self.path
+
+
+    def close(self):
+        try:
+            return self.file.close()
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
@@ -0,0 +1,369 @@
+import io, os, gzip, zlib, errno, shutil, struct, tempfile, mimetypes, threading
+
+from django.core.files import File, locks
+from django.core.files.storage import Storage, FileSystemStorage, default_storage
+from django.utils.encoding import force_text
+
+
+COPY_CHUNK_SIZE = 1024 * 1024 * 8
+
+try:
+    FILE_TYPES = (io.FileIO, file)
+except NameError:
+    FILE_TYPES = (io.FileIO,)
+
+
+
+def copy_fd(src_fd, dest_fd, size, offset=0):
+    """Copies size bytes from offset in one file descriptor to another
+    inside the kernel where the platform allows it, with copy_file_range
+    or else sendfile.  Returns False when neither is available or usable."""
+
+    for name in ('copy_file_range', 'sendfile'):
+        copy = getattr(os, name, None)
+        if copy is None:
+            continue
+
+        copied = 0
+        try:
+            while copied < size:
+                count = min(size - copied, COPY_CHUNK_SIZE)
+                if name == 'sendfile':
+                    sent = copy(dest_fd, src_fd, offset + copied, count)
+                else:
+                    sent = copy(src_fd, dest_fd, count, offset + copied, copied)
+                if not sent:
+                    break
+                copied += sent
+        except OSError as e:
+            if copied or e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EXDEV, errno.EOPNOTSUPP, errno.EBADF):
+                raise
+            continue
+
+        if copied == size:
+            return True
+
+    return False
+
+
+def get_source_fd(content):
+    """The descriptor of a file object that reads a plain OS file, or
+    None.  Wrappers that decode or decompress may answer fileno() with the
+    descriptor of a different byte stream, so only the file types that
+    read the descriptor as is qualify."""
+
+    file_obj = getattr(content, 'file', content)
+    raw = getattr(file_obj, 'raw', None) if isinstance(file_obj, (io.BufferedReader, io.BufferedRandom)) else file_obj
+    if not isinstance(raw, FILE_TYPES):
+        return None
+
+    try:
+        return file_obj.fileno()
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+
+
+
+class FastFileSystemStorage(FileSystemStorage):
+    """A FileSystemStorage that moves files already on disk into place
+    the cheapest way it can.
+
+    Temporary uploads are renamed onto the reserved name when they are on
+    the same file system and copied inside the kernel otherwise.  Other
+    plain OS files are copied inside the kernel too, from their current
+    position.
+    In-memory uploads are streamed as usual."""
+
+    def _save(self, name, content):
+        src_path = content.temporary_file_path() if hasattr(content, 'temporary_file_path') else None
+        src_fd = get_source_fd(content) if src_path is None else None
+        if src_path is None and src_fd is None:
+            return super(FastFileSystemStorage, self)._save(name, content)
+
+        full_path = self.path(name)
+        self.make_directory(os.path.dirname(full_path))
+
+        # Reserving the name with O_EXCL keeps get_available_name's
+        # guarantee that two saves never end up with the same file.
+        while True:
+            try:
+                fd = os.open(full_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                name = self.get_available_name(name)
+                full_path = self.path(name)
+            else:
+                break
+
+        try:
+            if src_path is not None:
+                self.move_into(src_path, full_path, fd)
+            else:
+                self.copy_into(content, src_fd, fd)
+        except Exception:
+            os.close(fd)
+            os.remove(full_path)
+            raise
+
+        os.close(fd)
+        if self.file_permissions_mode is not None:
+            os.chmod(full_path, self.file_permissions_mode)
+
+        return force_text(name.replace('\\', '/'))
+
+
+    def make_directory(self, directory):
+        if os.path.isdir(directory):
+            return
+
+        try:
+            if self.directory_permissions_mode is not None:
+                old_umask = os.umask(0)
+                try:
+                    os.makedirs(directory, self.directory_permissions_mode)
+                finally:
+                    os.umask(old_umask)
+            else:
+                os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+
+    def move_into(self, src_path, full_path, fd):
+        """Renames the temporary file over the reserved one, which is
+        atomic and O(1) on the same file system."""
+
+        try:
+            os.rename(src_path, full_path)
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+        with open(src_path, 'rb') as src:
+            self.copy_into(src, src.fileno(), fd)
+
+        try:
+            os.remove(src_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+    def copy_into(self, content, src_fd, fd):
+        # The content is copied from its current position.
+        offset = content.tell()
+        size = max(os.fstat(src_fd).st_size - offset, 0)
+        locks.lock(fd, locks.LOCK_EX)
+        try:
+            if not copy_fd(src_fd, fd, size, offset):
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                content.seek(offset)
+                with os.fdopen(os.dup(fd), 'wb') as dest:
+                    shutil.copyfileobj(getattr(content, 'file', content), dest, COPY_CHUNK_SIZE)
+        finally:
+            locks.unlock(fd)
+
+
+
+GZIP_MARKER = b'multifilefield:'
+
+COMPRESSIBLE_TYPES = (
+    'text/',
+    'application/json',
+    'application/xml',
+    'application/javascript',
+    'application/x-javascript',
+    'application/csv',
+    'application/x-ndjson',
+    'application/sql',
+    'application/x-yaml',
+    'image/svg+xml',
+)
+
+
+
+def read_gzip_size(file_obj):
+    """The original size recorded in the comment of a gzip header written
+    by CompressedStorage, or None for any other file."""
+
+    header = file_obj.read(10)
+    if len(header) < 10 or header[:3] != b'\x1f\x8b\x08':
+        return None
+
+    flags = ord(header[3:4])
+    if flags != 0x10:
+        # We only write a comment, anything else isn't ours.
+        return None
+
+    comment = file_obj.read(len(GZIP_MARKER) + 21).split(b'\0', 1)[0]
+    if not comment.startswith(GZIP_MARKER):
+        return None
+    try:
+        return int(comment[len(GZIP_MARKER):])
+    except ValueError:
+        return None
+
+
+
+class CompressedStorage(Storage):
+    """Wraps another storage and gzips compressible uploads on the way in,
+    so text, csv, logs and the like take a fraction of the space.
+
+    Files are compressed while they stream into a spooled temporary file.
+    Whether a file was compressed, and its original size, are recorded in
+    the gzip header's comment, so opening it streams the original content
+    back and anything else, including gzip files uploaded as they are, is
+    returned untouched.  A file that doesn't shrink below min_ratio is
+    stored raw, and once a content type has shown it doesn't compress
+    (over its first few files) it isn't tried any more.
+
+    Everything else is handed to the wrapped storage."""
+
+    def __init__(self, storage=None, content_types=COMPRESSIBLE_TYPES, min_ratio=0.9, level=6,
+            spool_size=1024 * 1024, min_samples=5):
+        self.storage = storage or default_storage
+        self.content_types = content_types
+        self.min_ratio = min_ratio
+        self.level = level
+        self.spool_size = spool_size
+        self.min_samples = min_samples
+        self.ratios = {}
+        self.lock = threading.Lock()
+
+
+    def __getattr__(self, name):
+        if name == 'storage':
+            raise AttributeError(name)
+        return getattr(self.storage, name)
+
+
+    def get_content_type(self, name, content):
+        return (getattr(content, 'content_type', None) or mimetypes.guess_type(name)[0] or '').lower()
+
+
+    def is_compressible(self, content_type):
+        if not content_type.startswith(self.content_types):
+            return False
+
+        with self.lock:
+            count, raw, compressed = self.ratios.get(content_type, (0, 0, 0))
+        return count < self.min_samples or not raw or compressed <= raw * self.min_ratio
+
+
+    def record_ratio(self, content_type, raw, compressed):
+        with self.lock:
+            count, total_raw, total_compressed = self.ratios.get(content_type, (0, 0, 0))
+            self.ratios[content_type] = (count + 1, total_raw + raw, total_compressed + compressed)
+
+
+    def compress(self, content):
+        """Gzips content into a spooled temporary file.  Returns it along
+        with the original and compressed sizes."""
+
+        spool = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        crc = size = 0
+
+        # The size goes in the header, so it has to be known up front.
+        content_size = content.size
+        spool.write(struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, 0x10, 0, 0, 255))
+        spool.write(GZIP_MARKER + str(content_size).encode('ascii') + b'\0')
+
+        if hasattr(content, 'seek'):
+            content.seek(0)
+        for chunk in content.chunks():
+            crc = zlib.crc32(chunk, crc) & 0xFFFFFFFF
+            size += len(chunk)
+            spool.write(compressor.compress(chunk))
+        spool.write(compressor.flush())
+        spool.write(struct.pack('<II', crc, size & 0xFFFFFFFF))
+
+        if size != content_size:
+            spool.close()
+            raise IOError('%s changed size while it was compressed.' % content.name)
+
+        compressed_size = spool.tell()
+        spool.seek(0)
+        return spool, size, compressed_size
+
+
+    def _save(self, name, content):
+        content_type = self.get_content_type(name, content)
+        if not self.is_compressible(content_type):
+            return self.storage.save(name, content)
+
+        spool, size, compressed_size = self.compress(content)
+        self.record_ratio(content_type, size, compressed_size)
+
+        try:
+            if compressed_size > size * self.min_ratio:
+                content.seek(0)
+                return self.storage.save(name, content)
+            return self.storage.save(name, File(spool, name))
+        finally:
+            spool.close()
+
+
+    def _open(self, name, mode='rb'):
+        file_obj = self.storage.open(name, mode)
+        if 'w' in mode or 'a' in mode or '+' in mode:
+            return file_obj
+
+        size = read_gzip_size(file_obj)
+        file_obj.seek(0)
+        if size is None:
+            return file_obj
+
+        decompressed = File(gzip.GzipFile(fileobj=file_obj, mode='rb'), name)
+        decompressed.size = size
+        return decompressed
+
+
+    def size(self, name):
+        with self.storage.open(name, 'rb') as file_obj:
+            size = read_gzip_size(file_obj)
+        return self.storage.size(name) if size is None else size
+
+
+    def exists(self, name):
+        return self.storage.exists(name)
+
+
+    def delete(self, name):
+        return self.storage.delete(name)
+
+
+    def listdir(self, path):
+        return self.storage.listdir(path)
+
+
+    def is_compressed(self, name):
+        """Whether the file was gzipped on the way in."""
+
+        with self.storage.open(name, 'rb') as file_obj:
+            return read_gzip_size(file_obj) is not None
+
+
+    def url(self, name):
+        """Files it gzipped would be served compressed, so they have no
+        url of their own and go through the download view instead."""
+
+        if self.exists(name) and self.is_compressed(name):
+            raise NotImplementedError('%s is stored compressed, serve it with the download view.' % name)
+        return self.storage.url(name)
+
+
+    def path(self, name):
+        return self.storage.path(name)
+
+
+    def get_valid_name(self, name):
+        return self.storage.get_valid_name(name)
+
+
+    def get_available_name(self, name, max_length=None):
+        return self.storage.get_available_name(name, max_length=max_length)
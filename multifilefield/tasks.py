@@ -0,0 +1,253 @@
+import json, threading, traceback
+
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, transaction
+from django.db.models import F
+from django.utils.module_loading import import_string
+
+from .models import FileTask, UploadedFile
+from .staging import stage_file, unstage_file, StagedUploadedFile
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+
+def get_workers():
+    return getattr(settings, 'MULTIFILEFIELD_WORKERS', 2)
+
+
+def get_timeout():
+    """Seconds without a heartbeat after which a running task is taken
+    to be lost with the process that ran it."""
+
+    return getattr(settings, 'MULTIFILEFIELD_TASK_TIMEOUT', 60 * 60)
+
+
+def get_pool():
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(get_workers())
+    return _pool
+
+
+def get_form_path(form):
+    return '%s.%s' % (form.__class__.__module__, form.__class__.__name__)
+
+
+def get_field_config(field):
+    """ The settings a view may have given the field after the form was
+        constructed, which rebuilding it from the form class loses."""
+
+    config = {'quota_key': field.quota_key or ''}
+    if field.owner is not None:
+        config['owner'] = [ContentType.objects.get_for_model(field.owner).pk, field.owner.pk]
+    return config
+
+
+def get_task_field(task):
+    """ Rebuilds the field a task was recorded for from its form, whose
+        class has to be importable and constructible without arguments,
+        and the settings recorded with the task."""
+
+    if not task.form_path or not task.config:
+        raise ValueError('FileTask %s has no form and field settings to rebuild its field from.' % task.pk)
+
+    config = json.loads(task.config)
+    field = import_string(task.form_path)().fields[task.field_name]
+    field.quota_key = config['quota_key'] or None
+
+    if config.get('owner'):
+        owner_type, owner_id = config['owner']
+        field.owner = ContentType.objects.get_for_id(owner_type).get_object_for_this_type(pk=owner_id)
+        if field.queryset is None:
+            field.queryset = UploadedFile.objects.owned_by(field.owner)
+            field.filefield_name = field.filefield_name or 'upload'
+
+    if field.queryset is not None:
+        # The removed ids were checked against the view's queryset when
+        # the task was recorded.
+        field.queryset = field.queryset.model._default_manager.all()
+
+    return field
+
+
+def enqueue(field, field_name, added, removed, form=None):
+    """ Records the work for a field as a pending FileTask and hands it
+        to the worker pool once the current transaction commits.  Added
+        files are staged first so they outlive the request.
+
+        The pool only saves a round trip to the multifilefield_worker
+        command, which runs whatever is left pending when the process
+        goes away first.  That needs the form the field belongs to.
+
+        With MULTIFILEFIELD_WORKERS = 0 the task runs inline instead,
+        which is mostly useful for tests.
+        """
+
+    if removed and field.queryset is not None:
+        removed = field.queryset.filter(id__in = field.get_file_ids(removed)).values_list('id', flat = True)
+
+    task = FileTask.objects.create(
+        field_name = field_name,
+        form_path = get_form_path(form) if form is not None else '',
+        config = json.dumps(get_field_config(field)),
+        added = json.dumps([stage_file(file_obj) for file_obj in added or []]),
+        removed = json.dumps([str(file_id) for file_id in removed or []]))
+
+    if not get_workers():
+        return run_task(field, task.pk)
+
+    # The worker can only see the task once it is committed.  on_commit
+    # runs the callback straight away outside of a transaction.
+    on_commit = getattr(transaction, 'on_commit', lambda func: func())
+    on_commit(lambda: get_pool().apply_async(run_task_in_worker, (field, task.pk)))
+
+    return task
+
+
+def run_task_in_worker(field, task_id):
+    try:
+        run_task(field, task_id)
+    finally:
+        for connection in connections.all():
+            connection.close()
+
+
+def claim_task(task_id):
+    """ Claiming the task with a conditional update makes sure only one
+        worker runs it."""
+
+    return FileTask.objects.filter(pk = task_id, status = FileTask.PENDING).update(
+        status = FileTask.RUNNING,
+        attempts = F('attempts') + 1,
+        updated_at = datetime.today())
+
+
+
+class Heartbeat(threading.Thread):
+    """ Keeps touching a running task so requeue_stale can tell it from
+        one whose process has gone away."""
+
+    def __init__(self, task_id, interval):
+        super(Heartbeat, self).__init__()
+        self.daemon = True
+        self.task_id = task_id
+        self.interval = interval
+        self.stopped = threading.Event()
+
+
+    def run(self):
+        beaten = False
+        try:
+            while not self.stopped.wait(self.interval):
+                beaten = True
+                FileTask.objects.filter(pk = self.task_id, status = FileTask.RUNNING).update(
+                    updated_at = datetime.today())
+        finally:
+            if beaten:
+                for connection in connections.all():
+                    connection.close()
+
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+
+def unstage_task(task):
+    for item in json.loads(task.added or '[]'):
+        unstage_file(item['path'])
+
+
+def run_task(field, task_id):
+    """ Does the storage and database work of a pending task, with the
+        field that recorded it or else one rebuilt from its form."""
+
+    if not claim_task(task_id):
+        return
+
+    task = FileTask.objects.get(pk = task_id)
+    staged = json.loads(task.added or '[]')
+    removed = json.loads(task.removed or '[]')
+    added = []
+
+    try:
+        if field is None:
+            field = get_task_field(task)
+    except Exception:
+        # Its staged files are kept, the task may be fixed and run again.
+        task.status = FileTask.FAILED
+        task.error = traceback.format_exc()
+        task.save()
+        return task
+
+    heartbeat = Heartbeat(task.pk, get_timeout() / 4.0)
+    heartbeat.start()
+
+    try:
+        added = [StagedUploadedFile(item['path'], item['name'], item['content_type']) for item in staged]
+
+        if removed:
+            field.delete_files(removed)
+
+        if added:
+            field.upload_files(added)
+
+        task.status = FileTask.DONE
+    except Exception:
+        task.status = FileTask.FAILED
+        task.error = traceback.format_exc()
+    finally:
+        heartbeat.stop()
+        for file_obj in added:
+            file_obj.close()
+
+    # Only the run that still holds the claim finishes the task.
+    claimed = FileTask.objects.filter(pk = task.pk, status = FileTask.RUNNING, attempts = task.attempts)
+    if claimed.update(status = task.status, error = task.error, updated_at = datetime.today()):
+        unstage_task(task)
+    return task
+
+
+def run_pending(limit=None):
+    """ Runs pending tasks, oldest first.  Returns how many were run."""
+
+    task_ids = FileTask.objects.filter(status = FileTask.PENDING).order_by('pk').values_list('pk', flat=True)
+    if limit:
+        task_ids = task_ids[:limit]
+
+    return len([task_id for task_id in list(task_ids) if run_task(None, task_id)])
+
+
+def requeue_stale(max_attempts, timeout=None):
+    """ Running tasks are touched by their heartbeat every quarter of
+        MULTIFILEFIELD_TASK_TIMEOUT, so tasks untouched for longer were lost
+        with the process that ran them.  They go back to pending, or fail
+        with their staged files removed once they have been tried
+        max_attempts times.  Returns the number of (requeued, failed)
+        tasks."""
+
+    cutoff = datetime.today() - timedelta(seconds = timeout or get_timeout())
+    requeued = failed = 0
+
+    for task in FileTask.objects.filter(status = FileTask.RUNNING, updated_at__lt = cutoff).order_by('pk'):
+        # Only if nothing has touched the task since it was read.
+        stale = FileTask.objects.filter(pk = task.pk, status = FileTask.RUNNING, updated_at = task.updated_at)
+
+        if task.attempts < max_attempts:
+            requeued += stale.update(status = FileTask.PENDING, updated_at = datetime.today())
+        elif stale.update(status = FileTask.FAILED, error = 'Abandoned after %s attempts.' % task.attempts,
+                updated_at = datetime.today()):
+            unstage_task(task)
+            failed += 1
+
+    return requeued, failed
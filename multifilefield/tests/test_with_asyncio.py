@@ -0,0 +1,185 @@
+import sys, unittest
+
+from django import forms
+from django.test import TransactionTestCase, RequestFactory
+from django.test.utils import override_settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+
+from multifilefield.fields import MultiFileField
+from multifilefield.mixins import MultiFileFieldMixin, FormNotValidException
+from multifilefield.models import UploadedFile
+from multifilefield.tests import *
+
+if sys.version_info >= (3, 6):
+    import asyncio
+
+
+
+class AsyncStorage(TestStorage):
+    """A storage with coroutines, recording the names it was given."""
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncStorage, self).__init__(*args, **kwargs)
+        self.saved = []
+        self.deleted = []
+
+
+    def asave(self, name, content):
+        self.saved.append(name)
+        future = asyncio.Future()
+        future.set_result(self.save(name, content))
+        return future
+
+
+    def adelete(self, name):
+        self.deleted.append(name)
+        future = asyncio.Future()
+        future.set_result(self.delete(name))
+        return future
+
+
+
+class FailingStorage(TestStorage):
+    def _save(self, name, content):
+        if 'broken' in name:
+            raise IOError('No space left')
+        return super(FailingStorage, self)._save(name, content)
+
+
+
+def make_upload(name, content=b'file_content'):
+    return SimpleUploadedFile(name, content, content_type='text/plain')
+
+
+
+@unittest.skipIf(sys.version_info < (3, 6), 'asyncio needs Python 3.6')
+@override_settings(MULTIFILEFIELD_ASYNC_CONCURRENCY=1)
+class AsyncUploadTestCase(TransactionTestCase):
+    """ Let's test that the coroutines store and remove files like their
+    blocking counterparts.  Queries run in other threads, so the rows have
+    to be committed."""
+
+
+    def setUp(self):
+        make_files()
+        self.storage = TestStorage()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+
+    def tearDown(self):
+        self.loop.close()
+        remove_files()
+
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+
+    def make_field(self, **kwargs):
+        return MultiFileField(
+            storage = kwargs.pop('storage', self.storage),
+            queryset = UploadedFile.objects.all(),
+            filefield_name = 'upload',
+            **kwargs)
+
+
+    def test_upload_files(self):
+        """Test that aupload_files stores the files and creates their rows."""
+
+        field = self.make_field()
+        uploaded = self.run_async(field.aupload_files([make_upload('a.txt'), make_upload('b.txt')]))
+
+        self.assertEqual(len(uploaded), 2)
+        self.assertEqual(UploadedFile.objects.filter(filename__in = ['a.txt', 'b.txt']).count(), 2)
+        for uploaded_file in uploaded:
+            self.assertTrue(self.storage.exists(uploaded_file.upload.name))
+
+
+    def test_async_storage(self):
+        """Test that a storage's own coroutines are awaited."""
+
+        storage = AsyncStorage()
+        field = self.make_field(storage = storage)
+
+        uploaded = self.run_async(field.aupload_files([make_upload('a.txt')]))
+        self.assertEqual(len(storage.saved), 1)
+
+        self.run_async(field.adelete_files([uploaded[0].id]))
+        self.assertEqual(storage.deleted, [uploaded[0].upload.name])
+        self.assertFalse(UploadedFile.objects.filter(id = uploaded[0].id).exists())
+
+
+    def test_failed_upload(self):
+        """Test that files saved before a failure are removed again and no
+        rows are created."""
+
+        field = self.make_field(storage = FailingStorage())
+        count = UploadedFile.objects.count()
+
+        with self.assertRaises(IOError):
+            self.run_async(field.aupload_files([make_upload('a.txt'), make_upload('broken.txt')]))
+
+        self.assertEqual(UploadedFile.objects.count(), count)
+        self.assertEqual(os.listdir(TEMP_FILES_DIR), os.listdir(TEST_FILES_DIR))
+
+
+    def test_delete_files(self):
+        """Test that adelete_files removes the rows and the files."""
+
+        field = self.make_field()
+        uploaded = self.run_async(field.aupload_files([make_upload('a.txt')]))
+        name = uploaded[0].upload.name
+
+        deleted = self.run_async(field.adelete_files([uploaded[0].id, 'nope']))
+
+        self.assertEqual([f.id for f in deleted], [uploaded[0].id])
+        self.assertFalse(self.storage.exists(name))
+
+
+    def test_quota(self):
+        """Test that the quota moves with async uploads and deletes."""
+
+        field = self.make_field(quota_key = 'user:1')
+        uploaded = self.run_async(field.aupload_files([make_upload('a.txt', b'12345')]))
+        self.assertEqual((field.get_quota().num_files, field.get_quota().total_size), (1, 5))
+
+        self.run_async(field.adelete_files([uploaded[0].id]))
+        self.assertEqual((field.get_quota().num_files, field.get_quota().total_size), (0, 0))
+
+
+    def test_process_files(self):
+        """Test that aprocess_files processes every field of a form."""
+
+        storage = self.storage
+
+        class TestForm(MultiFileFieldMixin, forms.Form):
+            attachments = MultiFileField(
+                storage = storage,
+                queryset = UploadedFile.objects.all(),
+                filefield_name = 'upload')
+
+        removed = UploadedFile.objects.order_by('id')[0]
+        data = {
+            'attachments_0': make_upload('a.txt'),
+            'attachments_1': (str(removed.id),)
+        }
+
+        request = RequestFactory().post('/fake/', data=data)
+        form = TestForm(request.POST, request.FILES)
+
+        cleaned_data = self.run_async(form.aprocess_files())
+
+        self.assertFalse(UploadedFile.objects.filter(id = removed.id).exists())
+        self.assertTrue(UploadedFile.objects.filter(filename = 'a.txt').exists())
+        self.assertIn('a.txt', [f.basename for f in cleaned_data['attachments']])
+
+
+    def test_invalid_form(self):
+        """Test that an invalid form raises before anything is stored."""
+
+        class TestForm(MultiFileFieldMixin, forms.Form):
+            name = forms.CharField()
+
+        with self.assertRaises(FormNotValidException):
+            self.run_async(TestForm(data = {}).aprocess_files())
@@ -0,0 +1,187 @@
+import base64
+
+from datetime import datetime, timedelta
+
+from django import forms
+from django.core.exceptions import PermissionDenied
+from django.core.files import locks
+from django.core.management import call_command
+from django.test import TestCase, RequestFactory
+from django.test.utils import override_settings
+from django.utils.six import StringIO
+
+from multifilefield.fields import MultiFileField
+from multifilefield.mixins import MultiFileFieldMixin
+from multifilefield.models import UploadedFile, ChunkedUpload
+from multifilefield.views import chunked_upload_create, chunked_upload
+from multifilefield.tests import *
+
+
+
+def allow_all(request):
+    return True
+
+
+
+class LimitedForm(MultiFileFieldMixin, forms.Form):
+    uploads = MultiFileField(
+        max_file_size = 1024,
+        allowed_types = ['text/*'],
+        queryset = UploadedFile.objects.all(),
+        filefield_name='upload')
+
+
+
+@override_settings(ROOT_URLCONF='multifilefield.urls', MULTIFILEFIELD_STAGING_ROOT=TEMP_FILES_DIR,
+    MULTIFILEFIELD_UPLOAD_PERMISSION=allow_all)
+class ChunkedUploadTestCase(TestCase):
+    """ This TestCase is for testing resumable chunked uploads. """
+
+
+    def setUp(self):
+        make_files()
+        self.queryset = UploadedFile.objects.all()
+        self.storage = TestStorage()
+
+        class TestFormWithQueryset(MultiFileFieldMixin, forms.Form):
+            uploads = MultiFileField(
+                storage = self.storage,
+                queryset = self.queryset,
+                filefield_name='upload')
+
+        self.TestFormWithQueryset = TestFormWithQueryset
+        self.factory = RequestFactory()
+
+
+    def create_response(self, length, filetype=b'text/plain', **kwargs):
+        metadata = 'filename %s,filetype %s' % (
+            base64.b64encode(b'chunked.txt').decode('ascii'),
+            base64.b64encode(filetype).decode('ascii'))
+
+        request = self.factory.post('/uploads/',
+            HTTP_UPLOAD_LENGTH=str(length), HTTP_UPLOAD_METADATA=metadata)
+        return chunked_upload_create(request, **kwargs)
+
+
+    def create(self, length):
+        response = self.create_response(length)
+        self.assertEqual(response.status_code, 201)
+
+        return response['Upload-Token']
+
+
+    def patch(self, token, offset, data):
+        request = self.factory.generic('PATCH', '/uploads/%s/' % token, data,
+            content_type='application/offset+octet-stream', HTTP_UPLOAD_OFFSET=str(offset))
+        return chunked_upload(request, token)
+
+
+    def test_resume(self):
+        """Test that chunks are appended at the offset received so far."""
+
+        token = self.create(12)
+
+        response = self.patch(token, 0, b'file_')
+        self.assertEqual(response['Upload-Offset'], '5')
+
+        response = self.patch(token, 0, b'file_')
+        self.assertEqual(response.status_code, 409)
+
+        response = chunked_upload(self.factory.head('/uploads/%s/' % token), token)
+        self.assertEqual(response['Upload-Offset'], '5')
+
+        response = self.patch(token, 5, b'content')
+        self.assertEqual(response['Upload-Offset'], '12')
+
+        upload = ChunkedUpload.objects.get(token=token)
+        self.assertTrue(upload.complete)
+        with open(upload.path, 'rb') as f:
+            self.assertEqual(f.read(), b'file_content')
+
+
+    def test_permission(self):
+        """Test that uploads can't be started unless a permission allows it."""
+
+        with override_settings(MULTIFILEFIELD_UPLOAD_PERMISSION=None):
+            self.assertRaises(PermissionDenied, self.create_response, 12)
+
+        self.assertFalse(ChunkedUpload.objects.exists())
+
+
+    def test_limits(self):
+        """Test that uploads over the default size or a field's limits are
+        refused when they are created."""
+
+        self.assertEqual(self.create_response(2 ** 31).status_code, 413)
+
+        kwargs = {'form_class': LimitedForm, 'field_name': 'uploads'}
+        self.assertEqual(self.create_response(2048, **kwargs).status_code, 413)
+        self.assertEqual(self.create_response(12, b'image/png', **kwargs).status_code, 415)
+
+        kwargs['form_class'] = 'multifilefield.tests.test_with_chunked_uploads.LimitedForm'
+        self.assertEqual(self.create_response(12, **kwargs).status_code, 201)
+
+
+    def test_locked(self):
+        """Test that a PATCH is refused while another one is writing."""
+
+        token = self.create(12)
+        upload = ChunkedUpload.objects.get(token=token)
+
+        with open(upload.path, 'r+b') as f:
+            locks.lock(f, locks.LOCK_EX)
+            response = self.patch(token, 0, b'file_')
+            locks.unlock(f)
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(ChunkedUpload.objects.get(token=token).offset, 0)
+
+        self.assertEqual(self.patch(token, 0, b'file_')['Upload-Offset'], '5')
+
+
+    def test_cleanup(self):
+        """Test that uploads nothing was written to for a while are removed
+        with their staging files."""
+
+        expired = ChunkedUpload.objects.get(token=self.create(12))
+        current = ChunkedUpload.objects.get(token=self.create(12))
+        ChunkedUpload.objects.filter(pk=expired.pk).update(updated_at=datetime.today() - timedelta(days=2))
+
+        call_command('multifilefield_chunked_cleanup', stdout=StringIO())
+
+        self.assertEqual(list(ChunkedUpload.objects.values_list('pk', flat=True)), [current.pk])
+        self.assertFalse(os.path.exists(expired.path))
+        self.assertTrue(os.path.exists(current.path))
+
+
+    def test_with_token(self):
+        """Test form with a request.  Add a completed chunked upload."""
+
+        token = self.create(12)
+        self.patch(token, 0, b'file_content')
+
+        request = self.factory.post('/fake/', data={'uploads_0': token})
+        form = self.TestFormWithQueryset(request.POST, request.FILES)
+
+        if form.is_valid():
+            form.process_files_for('uploads')
+            self.assertEqual(len(form.cleaned_data.get('uploads')), 7)
+            self.assertFalse(ChunkedUpload.objects.filter(token=token).exists())
+        else:
+            self.fail(form.errors)
+
+
+    def test_with_incomplete_token(self):
+        """Test form with a request.  Incomplete uploads are invalid."""
+
+        token = self.create(12)
+        self.patch(token, 0, b'file_')
+
+        request = self.factory.post('/fake/', data={'uploads_0': token})
+        form = self.TestFormWithQueryset(request.POST, request.FILES)
+
+        self.assertFalse(form.is_valid())
+
+
+    def tearDown(self):
+        remove_files()
@@ -0,0 +1,177 @@
+import io, zipfile
+
+from django.test import TestCase, RequestFactory
+from django.core.exceptions import PermissionDenied
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test.utils import override_settings
+from django.utils.http import http_date
+
+from multifilefield.models import UploadedFile
+from multifilefield.fields import MultiFileField
+from multifilefield.storage import CompressedStorage
+from multifilefield.views import download, get_last_modified, offload_response, stream_response
+from multifilefield.zipstream import ZipStream, ZIP_DEFLATED
+from multifilefield.tests import *
+
+
+
+def allow_all(request, uploaded_file):
+    return True
+
+
+
+@override_settings(ROOT_URLCONF='multifilefield.urls', MULTIFILEFIELD_DOWNLOAD_PERMISSION=allow_all)
+class DownloadTestCase(TestCase):
+    """ This TestCase is for testing the download view. """
+
+
+    def setUp(self):
+        make_files()
+        self.uploaded_file = UploadedFile.objects.get(id=1)
+        self.uploaded_file.fill_metadata()
+        self.uploaded_file.save()
+
+        with open(self.uploaded_file.upload.name, 'rb') as f:
+            self.content = f.read()
+
+        self.factory = RequestFactory()
+
+
+    def get(self, **headers):
+        return download(self.factory.get(self.uploaded_file.get_download_url(), **headers), self.uploaded_file.pk)
+
+
+    def test_download(self):
+        """Test that the whole file is streamed with its validators."""
+
+        response = self.get()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response['ETag'], '"%s"' % self.uploaded_file.checksum)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertTrue(self.uploaded_file.basename in response['Content-Disposition'])
+
+
+    def test_permission(self):
+        """Test that downloads are refused unless a permission allows them."""
+
+        with override_settings(MULTIFILEFIELD_DOWNLOAD_PERMISSION=None):
+            self.assertRaises(PermissionDenied, self.get)
+
+        with override_settings(MULTIFILEFIELD_DOWNLOAD_PERMISSION=lambda request, f: f.pk != self.uploaded_file.pk):
+            self.assertRaises(PermissionDenied, self.get)
+
+
+    def test_not_modified(self):
+        """Test that matching validators get a 304."""
+
+        etag = '"%s"' % self.uploaded_file.checksum
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+        since = http_date(get_last_modified(self.uploaded_file))
+        self.assertEqual(self.get(HTTP_IF_MODIFIED_SINCE=since).status_code, 304)
+
+
+    def test_range(self):
+        """Test that a single byte range gets a 206 and a range past the
+        end a 416."""
+
+        response = self.get(HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.content[10:20])
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/%s' % len(self.content))
+
+        response = self.get(HTTP_RANGE='bytes=-5')
+        self.assertEqual(b''.join(response.streaming_content), self.content[-5:])
+
+        response = self.get(HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+        self.assertEqual(self.get(HTTP_RANGE='bytes=%s-' % len(self.content)).status_code, 416)
+
+
+    @override_settings(MULTIFILEFIELD_SENDFILE='nginx', MULTIFILEFIELD_ACCEL_REDIRECT_PREFIX='/protected/')
+    def test_offload(self):
+        """Test that the transfer is handed to the front-end server."""
+
+        response = self.get()
+        self.assertEqual(response['X-Accel-Redirect'], '/protected/%s' % self.uploaded_file.upload.name.lstrip('/'))
+        self.assertEqual(response.content, b'')
+
+
+    @override_settings(MULTIFILEFIELD_SENDFILE='nginx')
+    def test_offload_compressed(self):
+        """Test that files stored gzipped are streamed decompressed rather
+        than offloaded."""
+
+        storage = CompressedStorage(TestStorage())
+        content = b'text content ' * 100
+        name = storage.save('compressed.txt', SimpleUploadedFile('compressed.txt', content, content_type='text/plain'))
+
+        self.uploaded_file.upload.storage = storage
+        self.uploaded_file.upload.name = name
+        self.uploaded_file.size = len(content)
+
+        self.assertEqual(offload_response(self.uploaded_file), None)
+
+        response = stream_response(self.factory.get('/'), self.uploaded_file, '"etag"', None)
+        self.assertEqual(b''.join(response.streaming_content), content)
+
+
+    def read_zip(self, response):
+        return zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+
+
+    def test_zip(self):
+        """Test that the field's files stream as a zip archive, stored or
+        deflated."""
+
+        field = MultiFileField(
+            queryset = UploadedFile.objects.all(),
+            filefield_name='upload')
+
+        for compress in (False, True):
+            archive = self.read_zip(field.get_zip_response(compress=compress))
+            self.assertEqual(archive.testzip(), None)
+            self.assertEqual(len(archive.namelist()), 6)
+
+            info = archive.getinfo(self.uploaded_file.basename)
+            self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED)
+            self.assertEqual(archive.read(info), self.content)
+
+
+    def test_zip_storage(self):
+        """Test that files are read from the field's storage rather than
+        the model field's."""
+
+        field = MultiFileField(
+            storage = TestStorage(),
+            queryset = UploadedFile.objects.filter(filename='stored.txt'),
+            filefield_name='upload')
+
+        uploaded = field.upload_files([SimpleUploadedFile('stored.txt', b'stored content')])
+        self.assertFalse(os.path.isabs(uploaded[0].upload.name))
+
+        archive = self.read_zip(field.get_zip_response())
+        self.assertEqual(archive.read('stored.txt'), b'stored content')
+
+
+    def test_zip_stream(self):
+        """Test unique names and members of unknown size, which get
+        zip64 records."""
+
+        archive = ZipStream(ZIP_DEFLATED, chunk_size=7)
+        files = [(name, lambda: io.BytesIO(b'file_content'), None, None) for name in ('a.txt', 'a.txt', '')]
+        chunks = archive.stream(files)
+        self.assertTrue(next(chunks).startswith(b'PK\x03\x04'))
+
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(ZipStream(ZIP_DEFLATED, chunk_size=7).stream(files))))
+        self.assertEqual(archive.namelist(), ['a.txt', 'a (2).txt', 'file'])
+        self.assertEqual(archive.read('a (2).txt'), b'file_content')
+
+
+    def tearDown(self):
+        remove_files()
@@ -1,11 +1,18 @@
+import copy, threading, time
+
 from datetime import datetime
 from django import forms
 from django.test import TestCase, RequestFactory
+from django.test.utils import override_settings
+from django.core.management import call_command
+from django.utils.six import StringIO
+from django.core.files import locks
 from django.core.files.uploadedfile import SimpleUploadedFile
 
+from multifilefield import manifest
 from multifilefield.fields import MultiFileField, NoFileFieldNameException
 from multifilefield.mixins import MultiFileFieldMixin
-from multifilefield.models import UploadedFile
+from multifilefield.models import UploadedFile, shard_name
 from multifilefield.tests import *
 
 
@@ -31,6 +38,91 @@ class MultiFileFieldFilesTestCase(TestCase):
         self.assertTrue(True)
 
 
+    def test_deepcopy(self):
+        """Test that copies of the field share its files."""
+
+        field = MultiFileField(
+            storage = self.storage,
+            files = self.files)
+
+        copied = copy.deepcopy(field)
+        self.assertTrue(copied.files is field.files)
+        self.assertTrue(copied.choices.files is field.files)
+        self.assertEqual(len(copied.choices), 6)
+
+
+    def test_manifest(self):
+        """Test that files are listed from the manifest, not the directory."""
+
+        field = MultiFileField(
+            storage = self.storage,
+            files = self.files)
+
+        files = field.get_files()
+        self.assertEqual(len(files), 6)
+        self.assertTrue(all(f.closed for f in files))
+
+        shutil.copyfile(os.path.join(TEST_FILES_DIR, 'image_1.jpeg'), os.path.join(TEMP_FILES_DIR, 'unlisted.jpeg'))
+        field.upload_files([SimpleUploadedFile('uploaded_file.jpeg', 'file_content')])
+        field.delete_files(['image_1.jpeg', 'image_2.jpeg'])
+
+        names = [f.name for f in MultiFileField(storage = self.storage, files = self.files).get_files()]
+        self.assertEqual(len(names), 5)
+        self.assertTrue('uploaded_file.jpeg' in names)
+        self.assertFalse('unlisted.jpeg' in names)
+        self.assertFalse('image_1.jpeg' in names)
+
+
+    def test_manifest_compaction(self):
+        """Test that the index isn't rewritten while another process is
+        appending to it, and keeps what was appended."""
+
+        first = manifest.FileManifest(TEMP_FILES_DIR)
+        second = manifest.FileManifest(TEMP_FILES_DIR)
+        self.assertEqual(len(first.names()), 6)
+
+        compact_min, manifest.COMPACT_MIN = manifest.COMPACT_MIN, 0
+        try:
+            with open(first.lock_path, 'ab') as f:
+                # Stands in for another process in the middle of an append.
+                locks.lock(f, locks.LOCK_SH)
+                thread = threading.Thread(target=first._compact)
+                thread.start()
+                time.sleep(0.2)
+                self.assertTrue(thread.is_alive())
+
+                with open(first.path, 'ab') as index:
+                    index.write(b'+appended.jpeg\n')
+                locks.unlock(f)
+            thread.join()
+        finally:
+            manifest.COMPACT_MIN = compact_min
+
+        with open(first.path, 'rb') as index:
+            self.assertEqual(index.read().count(b'\n'), 7)
+        self.assertTrue('appended.jpeg' in second.names())
+
+
+    @override_settings(MULTIFILEFIELD_FANOUT=2)
+    def test_manifest_fanout(self):
+        """Test that sharded files are listed and cleared by basename."""
+
+        call_command('multifilefield_fanout', location=TEMP_FILES_DIR, stdout=StringIO())
+
+        field = MultiFileField(
+            storage = self.storage,
+            files = self.files)
+
+        field.upload_files([SimpleUploadedFile('uploaded_file.jpeg', 'file_content')])
+        names = [f.name for f in field.get_files()]
+        self.assertEqual(len(names), 7)
+        self.assertTrue(shard_name('uploaded_file.jpeg') in names)
+
+        field.delete_files(['image_1.jpeg', 'uploaded_file.jpeg'])
+        self.assertFalse(self.storage.exists(shard_name('image_1.jpeg')))
+        self.assertEqual(len(field.get_files()), 5)
+
+
     def tearDown(self):
         remove_files()
 
@@ -0,0 +1,124 @@
+import json, time
+
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.core.management import call_command, CommandError
+from django.utils.six import StringIO
+
+from multifilefield.manifest import FileManifest
+from multifilefield.models import UploadedFile
+from multifilefield.tests import *
+
+
+
+class GarbageCollectionTestCase(TestCase):
+    """ This TestCase is for testing the orphan garbage collector. """
+
+
+    def setUp(self):
+        make_files()
+
+        self.old = time.time() - 3600
+        self.orphans = [self.touch('a_orphan.txt'), self.touch(os.path.join('ab', 'z_orphan.txt'))]
+        self.recent = self.touch('recent.txt', old=False)
+        self.thumbnail = self.touch('image_1.thumb-64x64.jpeg')
+        self.missing = UploadedFile.objects.create(upload=os.path.join(TEMP_FILES_DIR, 'missing.jpeg'))
+
+
+    def touch(self, name, old=True):
+        path = os.path.join(TEMP_FILES_DIR, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(b'file_content')
+        if old:
+            os.utime(path, (self.old, self.old))
+        return path
+
+
+    def gc(self, **options):
+        options.setdefault('location', TEMP_FILES_DIR)
+        call_command('multifilefield_gc', min_age=60, batch_size=2,
+            stdout=StringIO(), stderr=StringIO(), **options)
+
+
+    def test_dry_run(self):
+        """Test that without --delete files and rows are left alone."""
+
+        self.gc(delete_missing_rows=True)
+
+        self.assertTrue(all(os.path.exists(path) for path in self.orphans))
+        self.assertTrue(UploadedFile.objects.filter(pk=self.missing.pk).exists())
+
+
+    def test_collect(self):
+        """Test that old orphans and rows without a file are deleted, and
+        that referenced, recent and thumbnail files are kept."""
+
+        self.gc(delete=True, delete_missing_rows=True)
+
+        self.assertFalse(any(os.path.exists(path) for path in self.orphans))
+        self.assertTrue(os.path.exists(self.recent))
+        self.assertTrue(os.path.exists(self.thumbnail))
+        self.assertTrue(all(os.path.exists(f.upload.name) for f in UploadedFile.objects.all()))
+        self.assertFalse(UploadedFile.objects.filter(pk=self.missing.pk).exists())
+        self.assertEqual(UploadedFile.objects.count(), 6)
+
+
+    def test_resume(self):
+        """Test that a run resumes after the file its checkpoint names."""
+
+        checkpoint = os.path.join(TEMP_FILES_DIR, '.multifilefield-gc.json')
+        with open(checkpoint, 'w') as f:
+            json.dump({'location': os.path.abspath(TEMP_FILES_DIR), 'phase': 'files', 'last': ['ab']}, f)
+
+        self.gc(delete=True, checkpoint=checkpoint)
+
+        self.assertTrue(os.path.exists(self.orphans[0]))
+        self.assertFalse(os.path.exists(self.orphans[1]))
+        self.assertFalse(os.path.exists(checkpoint))
+
+
+    def test_location(self):
+        """Test that the location is MULTIFILEFIELD_ROOT, and that there
+        is no falling back to the whole of MEDIA_ROOT."""
+
+        with self.assertRaises(CommandError):
+            self.gc(location=None, delete=True)
+        self.assertTrue(all(os.path.exists(path) for path in self.orphans))
+
+        with override_settings(MULTIFILEFIELD_ROOT=TEMP_FILES_DIR):
+            self.gc(location=None, delete=True)
+        self.assertFalse(any(os.path.exists(path) for path in self.orphans))
+
+
+    def test_storage(self):
+        """Test that rows are looked up in their storage, and that rows
+        whose storage keeps them outside the location are left alone."""
+
+        kept = UploadedFile.objects.create(upload='image_1.jpeg')
+        lost = UploadedFile.objects.create(upload='lost.jpeg')
+
+        self.gc(delete=True, delete_missing_rows=True)
+        self.assertEqual(UploadedFile.objects.filter(pk__in=[kept.pk, lost.pk]).count(), 2)
+
+        self.gc(delete=True, delete_missing_rows=True, storage='multifilefield.tests.TestStorage')
+        self.assertTrue(UploadedFile.objects.filter(pk=kept.pk).exists())
+        self.assertFalse(UploadedFile.objects.filter(pk=lost.pk).exists())
+
+
+    def test_manifest(self):
+        """Test that files a manifest lists are kept."""
+
+        listed = self.touch(os.path.join('listed', 'listed.txt'))
+        FileManifest(os.path.dirname(listed)).names()
+        unlisted = self.touch(os.path.join('listed', 'unlisted.txt'))
+
+        self.gc(delete=True)
+
+        self.assertTrue(os.path.exists(listed))
+        self.assertFalse(os.path.exists(unlisted))
+
+
+    def tearDown(self):
+        remove_files()
@@ -0,0 +1,107 @@
+from django import forms
+from django.test import TestCase, RequestFactory
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.http import HttpResponse
+from django.middleware.csrf import CsrfViewMiddleware, _get_new_csrf_token
+
+from multifilefield.fields import MultiFileField
+from multifilefield.handlers import RejectedUploadedFile, limit_uploads
+from multifilefield.mixins import MultiFileFieldMixin
+from multifilefield.models import UploadedFile
+from multifilefield.tests import *
+
+
+
+class FormWithLimitedUploadHandlerTestCase(TestCase):
+    """ This TestCase is for testing limits enforced while streaming. """
+
+
+    def setUp(self):
+        make_files()
+        self.queryset = UploadedFile.objects.all()
+        self.storage = TestStorage()
+
+        class TestFormWithLimits(MultiFileFieldMixin, forms.Form):
+            uploads = MultiFileField(
+                storage = self.storage,
+                queryset = self.queryset,
+                filefield_name='upload',
+                max_file_size = 1024,
+                max_num_files = 2)
+
+        self.TestFormWithLimits = TestFormWithLimits
+        self.factory = RequestFactory()
+
+
+    def test_file_size(self):
+        """Test that an oversized file is discarded but still reported."""
+
+        upload = SimpleUploadedFile('big.txt', 'x' * 100000)
+        request = self.factory.post('/fake/', data={'uploads_0': upload})
+        self.TestFormWithLimits.limit_uploads(request)
+
+        uploaded_file = request.FILES['uploads_0']
+        self.assertTrue(isinstance(uploaded_file, RejectedUploadedFile))
+        self.assertEqual(uploaded_file.size, 100000)
+
+        form = self.TestFormWithLimits(request.POST, request.FILES)
+        self.assertFalse(form.is_valid())
+        self.assertTrue('exceeds maximum upload size' in form.errors['uploads'][0])
+
+
+    def test_max_num_files(self):
+        """Test that files over max_num_files are discarded but counted."""
+
+        uploads = [SimpleUploadedFile('small_%s.txt' % i, 'file_content') for i in range(3)]
+        request = self.factory.post('/fake/', data={'uploads_0': uploads})
+        self.TestFormWithLimits.limit_uploads(request)
+
+        uploaded_files = request.FILES.getlist('uploads_0')
+        self.assertEqual([isinstance(f, RejectedUploadedFile) for f in uploaded_files], [False, False, True])
+
+        form = self.TestFormWithLimits(request.POST, request.FILES)
+        self.assertFalse(form.is_valid())
+        self.assertTrue('(received 3)' in form.errors['uploads'][0])
+
+
+    def test_within_limits(self):
+        """Test that files within the limits are handled as usual."""
+
+        upload = SimpleUploadedFile('small.txt', 'file_content')
+        request = self.factory.post('/fake/', data={'uploads_0': upload})
+        self.TestFormWithLimits.limit_uploads(request)
+
+        form = self.TestFormWithLimits(request.POST, request.FILES)
+        self.assertTrue(form.is_valid())
+
+
+    def test_decorator(self):
+        """Test that the decorator installs the handler in a view behind
+        CsrfViewMiddleware, which still has its token checked."""
+
+        received = []
+
+        @limit_uploads(self.TestFormWithLimits)
+        def view(request):
+            received.append(request.FILES['uploads_0'])
+            return HttpResponse()
+
+        def get_response(request):
+            middleware = CsrfViewMiddleware(lambda request: None)
+            return middleware.process_view(request, view, (), {}) or view(request)
+
+        token = _get_new_csrf_token()
+        upload = SimpleUploadedFile('big.txt', b'x' * 100000)
+        request = self.factory.post('/fake/', data={'uploads_0': upload, 'csrfmiddlewaretoken': token})
+        request.COOKIES['csrftoken'] = token
+
+        self.assertEqual(get_response(request).status_code, 200)
+        self.assertTrue(isinstance(received[0], RejectedUploadedFile))
+
+        request = self.factory.post('/fake/', data={'uploads_0': upload})
+        self.assertEqual(get_response(request).status_code, 403)
+        self.assertEqual(len(received), 1)
+
+
+    def tearDown(self):
+        remove_files()
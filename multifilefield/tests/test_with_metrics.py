@@ -0,0 +1,109 @@
+from django.test import TestCase
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.utils.six import StringIO
+
+from multifilefield import metrics
+from multifilefield.fields import MultiFileField
+from multifilefield.models import UploadedFile
+from multifilefield.signals import timed, NULL_TIMER
+from multifilefield.tests import *
+
+
+
+class MultiFileFieldMetricsTestCase(TestCase):
+    """ Let's test that the phases of processing files are timed."""
+
+
+    def setUp(self):
+        make_files()
+        self.storage = TestStorage()
+        self.field = MultiFileField(
+            storage = self.storage,
+            queryset = UploadedFile.objects.all(),
+            filefield_name='upload')
+
+
+    def test_disabled(self):
+        """Test that nothing is timed without receivers."""
+
+        self.assertTrue(timed(self.field, 'upload') is NULL_TIMER)
+
+
+    def test_aggregator(self):
+        """Test that the aggregator keeps histograms of every phase that
+        the dump command can read."""
+
+        aggregator = metrics.connect(metrics.Aggregator(flush_interval=0))
+        try:
+            self.field.upload_files([SimpleUploadedFile('metrics_%s.txt' % i, b'file_content') for i in range(2)])
+            self.field.delete_files(['1', '2', '3'])
+        finally:
+            metrics.disconnect(aggregator)
+
+        histograms = metrics.get_histograms()
+        self.assertEqual(histograms['upload'].count, 1)
+        self.assertEqual(histograms['upload'].files, 2)
+        self.assertEqual(histograms['upload'].bytes, 2 * len(b'file_content'))
+        self.assertEqual(histograms['storage_save'].count, 2)
+        self.assertEqual(histograms['orm_insert'].count, 2)
+        self.assertEqual(histograms['delete'].files, 3)
+        self.assertEqual(histograms['orm_delete'].files, 3)
+        self.assertEqual(histograms['storage_delete'].files, 3)
+
+        out = StringIO()
+        call_command('multifilefield_metrics', reset=True, stdout=out)
+        self.assertTrue('storage_save' in out.getvalue())
+        self.assertEqual(metrics.get_histograms(), {})
+
+
+    def test_concurrent_flushes(self):
+        """Test that aggregators in different processes add up rather than
+        overwrite each other's timings."""
+
+        metrics.reset_histograms()
+        first, second = metrics.Aggregator(), metrics.Aggregator()
+
+        first.record('upload', 0.004, 1, 10, False)
+        second.record('upload', 0.040, 2, 20, True)
+        second.record('delete', 0.001, 1, 0, False)
+        first.flush()
+        second.flush()
+
+        histograms = metrics.get_histograms()
+        self.assertEqual(histograms['upload'].count, 2)
+        self.assertEqual((histograms['upload'].files, histograms['upload'].bytes), (3, 30))
+        self.assertEqual(histograms['upload'].failed, 1)
+        self.assertEqual(histograms['upload'].max, 40.0)
+        self.assertEqual(histograms['upload'].percentile(0.5), 5)
+        self.assertEqual(histograms['delete'].count, 1)
+
+        metrics.reset_histograms()
+
+
+    def test_statsd_sink(self):
+        """Test that a statsd style client gets timings and counts."""
+
+        class Client(object):
+            def __init__(self):
+                self.calls = []
+
+            def timing(self, name, ms):
+                self.calls.append(('timing', name))
+
+            def incr(self, name, count):
+                self.calls.append(('incr', name, count))
+
+        client = Client()
+        sink = metrics.connect(metrics.StatsdSink(client))
+        try:
+            self.field.upload_files([SimpleUploadedFile('statsd.txt', b'file_content')])
+        finally:
+            metrics.disconnect(sink)
+
+        self.assertTrue(('timing', 'multifilefield.upload') in client.calls)
+        self.assertTrue(('incr', 'multifilefield.upload.files', 1) in client.calls)
+
+
+    def tearDown(self):
+        remove_files()
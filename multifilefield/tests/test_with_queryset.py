@@ -1,11 +1,21 @@
+import copy, json, threading
+
 from datetime import datetime
 from django import forms
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
 from django.test import TestCase, RequestFactory
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.test.utils import override_settings
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.utils.six import StringIO
 
+from multifilefield.caching import get_version
 from multifilefield.fields import MultiFileField, NoFileFieldNameException
 from multifilefield.mixins import MultiFileFieldMixin
-from multifilefield.models import UploadedFile
+from multifilefield.models import UploadedFile, FileTask, FileQuota, shard_name, is_sharded
+from multifilefield.thumbnails import thumbnail_name
+from multifilefield.views import task_status
 from multifilefield.tests import *
 
 
@@ -57,6 +67,465 @@ class MultiFileFieldQuerySetTestCase(TestCase):
         self.assertTrue(True)
 
 
+    def test_lazy_choices(self):
+        """Test that the queryset is only queried when choices are needed."""
+
+        with self.assertNumQueries(0):
+            field = MultiFileField(
+                queryset = self.queryset,
+                filefield_name='upload')
+
+        with self.assertNumQueries(1):
+            field.validate(([], []))
+
+        with self.assertNumQueries(1):
+            choices = list(field.choices)
+            self.assertEqual(len(field.choices), 6)
+            self.assertEqual(field.choices.count(), 6)
+
+        file_id, file_obj = choices[0]
+        self.assertEqual(file_obj.name, UploadedFile.objects.get(id=file_id).upload.name)
+
+
+    def test_deepcopy(self):
+        """Test that a form's copy of the field gets unloaded choices of
+        its own and copies nothing a form may not change."""
+
+        field = MultiFileField(
+            queryset = self.queryset,
+            filefield_name='upload')
+        self.assertEqual(len(field.choices), 6)
+
+        with self.assertNumQueries(0):
+            copied = copy.deepcopy(field)
+
+        UploadedFile.objects.create(upload='added.jpeg')
+        self.assertEqual(len(copied.choices), 7)
+        self.assertEqual(len(field.choices), 6)
+
+        add_files, clear_files = copied.fields
+        self.assertTrue(clear_files.choices is copied.choices)
+        self.assertTrue(clear_files.widget.choices is copied.choices)
+        self.assertEqual(copied.widget.widgets, [add_files.widget, clear_files.widget])
+        self.assertFalse(clear_files.widget is field.fields[1].widget)
+
+        copied.widget.widgets[0].attrs['class'] = 'copied'
+        self.assertFalse('class' in field.fields[0].widget.attrs)
+
+
+    def test_delete_files(self):
+        """Test that deleting files filters bad ids in a single select."""
+
+        field = MultiFileField(
+            storage = self.storage,
+            queryset = self.queryset.filter(id__lte=4),
+            filefield_name='upload')
+
+        deleted = field.delete_files(['1', '2', 'x', '5', '999'])
+
+        self.assertEqual(sorted(f.id for f in deleted), [1, 2])
+        self.assertEqual(UploadedFile.objects.count(), 4)
+        self.assertFalse(any(os.path.exists(f.upload.name) for f in deleted))
+
+
+    def test_bulk_upload(self):
+        """Test that a bulk upload inserts every row in one query."""
+
+        field = MultiFileField(
+            storage = self.storage,
+            queryset = self.queryset,
+            filefield_name='upload',
+            bulk_upload = True)
+
+        uploads = [SimpleUploadedFile('bulk_%s.jpeg' % i, 'file_content') for i in range(3)]
+
+        # A single INSERT wrapped in the atomic block's savepoint.
+        with self.assertNumQueries(3):
+            uploaded_files = field.upload_files(uploads)
+
+        self.assertEqual(len(uploaded_files), 3)
+        self.assertEqual(UploadedFile.objects.count(), 9)
+        self.assertTrue(all(self.storage.exists(f.upload.name) for f in uploaded_files))
+
+
+    def test_bulk_upload_failure(self):
+        """Test that stored files are removed when the insert fails."""
+
+        class FailingField(MultiFileField):
+            def get_file_fields(self, file_obj, filename):
+                if file_obj.name == 'bulk_2.jpeg':
+                    raise ValueError(filename)
+                return super(FailingField, self).get_file_fields(file_obj, filename)
+
+        field = FailingField(
+            storage = self.storage,
+            queryset = self.queryset,
+            filefield_name='upload',
+            bulk_upload = True)
+
+        uploads = [SimpleUploadedFile('bulk_%s.jpeg' % i, 'file_content') for i in range(3)]
+
+        self.assertRaises(ValueError, field.upload_files, uploads)
+        self.assertEqual(UploadedFile.objects.count(), 6)
+        self.assertFalse(any(self.storage.exists(name) for name in ('bulk_0.jpeg', 'bulk_1.jpeg', 'bulk_2.jpeg')))
+
+
+    def test_concurrent_upload(self):
+        """Test that concurrent uploads keep the order of the files."""
+
+        field = MultiFileField(
+            storage = self.storage,
+            queryset = self.queryset,
+            filefield_name='upload',
+            upload_concurrency = 3)
+
+        uploads = [SimpleUploadedFile('concurrent_%s.jpeg' % i, 'file_content') for i in range(5)]
+        uploaded_files = field.upload_files(uploads)
+
+        self.assertEqual([f.upload.name for f in uploaded_files], ['concurrent_%s.jpeg' % i for i in range(5)])
+        self.assertEqual(UploadedFile.objects.count(), 11)
+
+
+    def test_concurrent_upload_failure(self):
+        """Test that the first failing file's error is raised and the
+        other saved files are removed."""
+
+        class FailingStorage(TestStorage):
+            def _save(self, name, content):
+                if name in ('concurrent_1.jpeg', 'concurrent_3.jpeg'):
+                    raise IOError(name)
+                return super(FailingStorage, self)._save(name, content)
+
+        field = MultiFileField(
+            storage = FailingStorage(),
+            queryset = self.queryset,
+            filefield_name='upload',
+            upload_concurrency = 3)
+
+        uploads = [SimpleUploadedFile('concurrent_%s.jpeg' % i, 'file_content') for i in range(5)]
+
+        with self.assertRaises(IOError) as context:
+            field.upload_files(uploads)
+
+        self.assertEqual(str(context.exception), 'concurrent_1.jpeg')
+        self.assertEqual(UploadedFile.objects.count(), 6)
+        self.assertFalse(any(self.storage.exists(f.name) for f in uploads))
+
+
+    def test_deduplicate(self):
+        """Test that identical uploads share one stored file, which is
+        only deleted along with its last row."""
+
+        field = MultiFileField(
+            storage = self.storage,
+            queryset = self.queryset,
+            filefield_name='upload',
+            deduplicate = True)
+
+        first, second = field.upload_files([
+            SimpleUploadedFile('first.txt', 'file_content'),
+            SimpleUploadedFile('second.txt', 'file_content')])
+
+        self.assertEqual(first.upload.name, second.upload.name)
+        self.assertEqual(first.checksum, second.checksum)
+        self.assertEqual(len(first.checksum), 64)
+        self.assertEqual((first.basename, second.basename), ('first.txt', 'second.txt'))
+
+        field.delete_files([first.id])
+        self.assertTrue(self.storage.exists(second.upload.name))
+
+        field.delete_files([second.id])
+        self.assertFalse(self.storage.exists(second.upload.name))
+
+
+    @override_settings(TEMPLATES=[{
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'APP_DIRS': True}])
+    def test_deduplicate_labels(self):
+        """Test that the clear list shows deduplicated files by the name
+        they were uploaded with rather than their checksum."""
+
+        field = MultiFileField(
+            storage = self.storage,
+            queryset = self.queryset,
+            filefield_name='upload',
+            deduplicate = True)
+
+        uploaded_file, = field.upload_files([SimpleUploadedFile('report.txt', b'file_content')])
+        field.fields[1].widget.choices = field.make_choices_from_arguments()
+        html = field.fields[1].widget.render('uploads_1', None, {'id': 'id_uploads_1'})
+
+        self.assertTrue('">report.txt' in html)
+        self.assertFalse('">%s' % uploaded_file.upload.name in html)
+
+
+    def test_upload_metadata(self):
+        """Test that the file name, size, content type and checksum are
+        stored at upload time."""
+
+        field = MultiFileField(
+            storage = self.storage,
+            queryset = self.queryset,
+            filefield_name='upload')
+
+        upload = SimpleUploadedFile('metadata.txt', b'file_content', content_type='text/plain')
+        uploaded_file, = field.upload_files([upload])
+        uploaded_file = UploadedFile.objects.get(id=uploaded_file.id)
+
+        self.assertEqual(uploaded_file.basename, 'metadata.txt')
+        self.assertEqual(uploaded_file.size, len(b'file_content'))
+        self.assertEqual(uploaded_file.content_type, 'text/plain')
+        self.assertEqual(len(uploaded_file.checksum), 64)
+
+
+    def test_backfill(self):
+        """Test that the backfill command fills in the metadata of
+        existing rows in batches."""
+
+        call_command('multifilefield_backfill', batch_size=4, stdout=StringIO())
+
+        for uploaded_file in UploadedFile.objects.all():
+            self.assertEqual(uploaded_file.filename, os.path.basename(uploaded_file.upload.name))
+            self.assertEqual(uploaded_file.size, os.path.getsize(uploaded_file.upload.name))
+            self.assertTrue(uploaded_file.content_type)
+            self.assertEqual(len(uploaded_file.checksum), 64)
+
+
+    @override_settings(MULTIFILEFIELD_FANOUT=2)
+    def test_fanout(self):
+        """Test that uploads are stored two directories down and that the
+        fanout command moves existing files there."""
+
+        field = MultiFileField(
+            storage = self.storage,
+            queryset = self.queryset,
+            filefield_name='upload')
+
+        uploaded_file, = field.upload_files([SimpleUploadedFile('fanout.jpeg', b'file_content')])
+        self.assertEqual(uploaded_file.upload.name, shard_name('fanout.jpeg'))
+        self.assertEqual(len(uploaded_file.upload.name.split('/')), 3)
+        self.assertTrue(self.storage.exists(uploaded_file.upload.name))
+
+        call_command('multifilefield_fanout', batch_size=4, stdout=StringIO())
+
+        for uploaded_file in UploadedFile.objects.all():
+            self.assertTrue(is_sharded(uploaded_file.upload.name))
+            self.assertTrue(os.path.exists(self.storage.path(uploaded_file.upload.name)))
+        self.assertFalse(os.path.exists(os.path.join(TEMP_FILES_DIR, 'image_1.jpeg')))
+
+
+    def test_is_sharded(self):
+        """Test that owner directories aren't taken for shard directories."""
+
+        name = shard_name('fanout.jpeg', 2)
+        self.assertTrue(is_sharded(name, 2))
+        self.assertTrue(is_sharded(os.path.join('12', '34', name), 2))
+        self.assertFalse(is_sharded(os.path.join('12', '34', 'fanout.jpeg'), 2))
+        self.assertFalse(is_sharded('fanout.jpeg', 2))
+
+
+    def test_fanout_storage(self):
+        """Test that the fanout command finds files in the given storage
+        and moves their thumbnails along."""
+
+        field = MultiFileField(
+            storage = self.storage,
+            queryset = self.queryset,
+            filefield_name='upload')
+
+        uploaded_file, = field.upload_files([SimpleUploadedFile('fanout.jpeg', b'file_content')])
+        thumbnail = thumbnail_name('fanout.jpeg', (32, 32))
+        with open(self.storage.path(thumbnail), 'wb') as f:
+            f.write(b'thumbnail')
+
+        with override_settings(MULTIFILEFIELD_FANOUT=2):
+            call_command('multifilefield_fanout', storage='multifilefield.tests.TestStorage', stdout=StringIO())
+
+        name = UploadedFile.objects.get(pk=uploaded_file.pk).upload.name
+        self.assertEqual(name, shard_name('fanout.jpeg', 2))
+        self.assertTrue(self.storage.exists(name))
+        self.assertTrue(self.storage.exists(thumbnail_name(name, (32, 32))))
+        self.assertFalse(self.storage.exists(thumbnail))
+
+
+    def test_fanout_deduplicated(self):
+        """Test that every row sharing a deduplicated file moves with it."""
+
+        field = MultiFileField(
+            storage = self.storage,
+            queryset = self.queryset,
+            filefield_name='upload',
+            deduplicate = True)
+
+        first, second = field.upload_files([
+            SimpleUploadedFile('first.txt', b'file_content'),
+            SimpleUploadedFile('second.txt', b'file_content')])
+        version = get_version()
+
+        with override_settings(MULTIFILEFIELD_FANOUT=2):
+            call_command('multifilefield_fanout', storage='multifilefield.tests.TestStorage', stdout=StringIO())
+
+        names = set(UploadedFile.objects.filter(pk__in=[first.pk, second.pk]).values_list('upload', flat=True))
+        self.assertEqual(names, set([shard_name(first.upload.name, 2)]))
+        self.assertTrue(self.storage.exists(names.pop()))
+        self.assertFalse(self.storage.exists(first.upload.name))
+        self.assertNotEqual(get_version(), version)
+
+
+    def test_max_num_total(self):
+        """Test that the total number of files is enforced."""
+
+        field = MultiFileField(
+            queryset = self.queryset,
+            filefield_name='upload',
+            max_num_total = 7)
+
+        field.validate(([SimpleUploadedFile('one.txt', b'x')], []))
+        self.assertRaises(ValidationError, field.validate,
+            ([SimpleUploadedFile('%s.txt' % i, b'x') for i in range(2)], []))
+
+
+    def test_quota(self):
+        """Test that the quota counters follow uploads and deletes, and
+        are checked with a single query."""
+
+        field = MultiFileField(
+            storage = self.storage,
+            queryset = self.queryset,
+            filefield_name='upload',
+            quota_key = 'owner:1',
+            max_num_total = 3,
+            max_total_size = 30)
+
+        uploaded_files = field.upload_files([SimpleUploadedFile('quota_%s.txt' % i, b'0123456789') for i in range(2)])
+        quota = FileQuota.objects.get(key='owner:1')
+        self.assertEqual((quota.num_files, quota.total_size), (2, 20))
+        self.assertEqual(UploadedFile.objects.filter(quota_key='owner:1').count(), 2)
+
+        with self.assertNumQueries(1):
+            field.validate(([SimpleUploadedFile('more.txt', b'0123456789')], []))
+
+        self.assertRaises(ValidationError, field.validate, ([SimpleUploadedFile('big.txt', b'x' * 11)], []))
+        self.assertRaises(ValidationError, field.validate,
+            ([SimpleUploadedFile('%s.txt' % i, b'x') for i in range(2)], []))
+
+        field.delete_files([uploaded_files[0].id])
+        quota = FileQuota.objects.get(key='owner:1')
+        self.assertEqual((quota.num_files, quota.total_size), (1, 10))
+
+
+    def test_quota_other_rows(self):
+        """Test that deleting rows of another key, or of none, leaves the
+        quota alone."""
+
+        field = MultiFileField(
+            storage = self.storage,
+            queryset = self.queryset,
+            filefield_name='upload',
+            quota_key = 'k')
+
+        uploaded_file, = field.upload_files([SimpleUploadedFile('keyed.txt', b'0123456789')])
+        other = UploadedFile.objects.create(upload='other.txt', size=5, quota_key='other')
+        legacy = UploadedFile.objects.get(id=1)
+        legacy.size = 7
+        legacy.save()
+
+        field.delete_files([legacy.id, other.id])
+        quota = FileQuota.objects.get(key='k')
+        self.assertEqual((quota.num_files, quota.total_size), (1, 10))
+
+        field.delete_files([uploaded_file.id])
+        quota = FileQuota.objects.get(key='k')
+        self.assertEqual((quota.num_files, quota.total_size), (0, 0))
+
+
+    def test_quota_repair(self):
+        """Test that the repair command recomputes the counters."""
+
+        field = MultiFileField(
+            storage = self.storage,
+            queryset = self.queryset,
+            filefield_name='upload',
+            quota_key = 'owner:1')
+
+        field.upload_files([SimpleUploadedFile('quota.txt', b'0123456789')])
+        FileQuota.objects.filter(key='owner:1').update(num_files=5, total_size=0)
+        FileQuota.objects.create(key='owner:2', num_files=3, total_size=100)
+
+        call_command('multifilefield_quota_repair', batch_size=1, stdout=StringIO())
+
+        self.assertEqual(FileQuota.objects.filter(key='owner:1', num_files=1, total_size=10).count(), 1)
+        self.assertEqual(FileQuota.objects.filter(key='owner:2', num_files=0, total_size=0).count(), 1)
+
+
+    def test_owner(self):
+        """Test that a field given an owner lists and creates only that
+        owner's files, below the owner's directory."""
+
+        owner, other = FileTask.objects.create(field_name='a'), FileTask.objects.create(field_name='b')
+
+        field = MultiFileField(storage = self.storage, owner = owner)
+        uploaded_file, = field.upload_files([SimpleUploadedFile('owned.txt', b'file_content')])
+        MultiFileField(storage = self.storage, owner = other).upload_files([SimpleUploadedFile('other.txt', b'x')])
+
+        self.assertEqual(uploaded_file.owner, owner)
+        self.assertTrue(uploaded_file.upload.name.startswith(os.path.join(str(uploaded_file.owner_type_id), str(owner.pk))))
+
+        field = MultiFileField(storage = self.storage, owner = owner)
+        self.assertEqual([file_id for (file_id, file_obj) in field.choices], [uploaded_file.id])
+        self.assertEqual(list(UploadedFile.objects.owned_by(other).values_list('filename', flat=True)), ['other.txt'])
+
+
+    def test_owner_concurrent(self):
+        """Test that the owner's content type is looked up once, before
+        concurrent saves start, rather than on the pool threads."""
+
+        owner = FileTask.objects.create(field_name='a')
+        field = MultiFileField(storage = self.storage, owner = owner, upload_concurrency = 3)
+
+        threads = []
+        get_for_model = ContentType.objects.get_for_model
+        def record(*args, **kwargs):
+            threads.append(threading.current_thread())
+            return get_for_model(*args, **kwargs)
+
+        ContentType.objects.get_for_model = record
+        try:
+            uploaded_files = field.upload_files([SimpleUploadedFile('owned_%s.txt' % i, b'file_content') for i in range(3)])
+        finally:
+            del ContentType.objects.get_for_model
+
+        self.assertEqual(threads, [threading.current_thread()])
+        self.assertEqual(set(f.owner for f in uploaded_files), set([owner]))
+
+
+    @override_settings(TEMPLATES=[{
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'APP_DIRS': True}])
+    def test_render_cache(self):
+        """Test that the clear list renders from cache until an
+        UploadedFile changes."""
+
+        field = MultiFileField(
+            queryset = self.queryset,
+            filefield_name='upload',
+            render_cache_timeout = 60)
+
+        widget = field.fields[1].widget
+        html = widget.render('uploads_1', None, {'id': 'id_uploads_1'})
+        self.assertEqual(html.count('type="checkbox"'), 6)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(widget.render('uploads_1', None, {'id': 'id_uploads_1'}), html)
+
+        UploadedFile.objects.get(id=1).delete()
+
+        widget.choices = field.make_choices_from_arguments()
+        with self.assertNumQueries(1):
+            html = widget.render('uploads_1', None, {'id': 'id_uploads_1'})
+        self.assertEqual(html.count('type="checkbox"'), 5)
+
+
     def tearDown(self):
         remove_files()
 
@@ -157,5 +626,36 @@ class FormWithMultiFileFieldQuerySetTestCase(TestCase):
             self.fail(form.errors)
 
 
+    @override_settings(MULTIFILEFIELD_WORKERS=0)
+    def test_with_queryset_deferred(self):
+        """Test form with a request.  Add new file and clear four files
+        in a deferred task."""
+
+        upload = SimpleUploadedFile('uploaded_file.jpeg',
+            'file_content', content_type='image/jpeg')
+
+        data = {
+            'uploads_0': upload,
+            'uploads_1': ('1', '2', '3', '4',)
+        }
+
+        request = self.factory.post('/fake/', data=data)
+        form = self.TestFormWithQueryset(request.POST, request.FILES)
+
+        if form.is_valid():
+            task = form.process_files_for('uploads', defer=True)
+            self.assertTrue(isinstance(form.cleaned_data.get('uploads'), FileTask))
+            self.assertEqual(UploadedFile.objects.count(), 3)
+            self.assertFalse(any(os.path.exists(item['path']) for item in json.loads(task.added)))
+
+            self.assertRaises(PermissionDenied, task_status, self.factory.get('/fake/'), task.pk)
+
+            with override_settings(MULTIFILEFIELD_TASK_PERMISSION=lambda request, task: True):
+                response = task_status(self.factory.get('/fake/'), task.pk)
+            self.assertEqual(json.loads(response.content.decode('utf-8'))['status'], FileTask.DONE)
+        else:
+            self.fail(form.errors)
+
+
     def tearDown(self):
         remove_files()
@@ -0,0 +1,106 @@
+import struct, tempfile
+
+from django import forms
+from django.test import TestCase, RequestFactory
+from django.core.files.uploadedfile import SimpleUploadedFile
+
+from multifilefield.fields import MultiFileField
+from multifilefield.mixins import MultiFileFieldMixin
+from multifilefield.models import UploadedFile
+from multifilefield.sniffing import HEADER_SIZE, read_header, sniff
+from multifilefield.staging import StagedUploadedFile
+from multifilefield.tests import *
+
+
+
+class FormWithAllowedTypesTestCase(TestCase):
+    """ This TestCase is for testing the content type checks. """
+
+
+    def setUp(self):
+        make_files()
+
+        with open(os.path.join(TEST_FILES_DIR, 'image_1.jpeg'), 'rb') as f:
+            self.jpeg = f.read()
+
+        class TestFormWithTypes(MultiFileFieldMixin, forms.Form):
+            uploads = MultiFileField(
+                storage = TestStorage(),
+                queryset = UploadedFile.objects.all(),
+                filefield_name='upload',
+                allowed_types = ['image/*', 'application/pdf'],
+                denied_types = ['image/svg+xml'])
+
+        self.TestFormWithTypes = TestFormWithTypes
+        self.factory = RequestFactory()
+
+
+    def post(self, *uploads):
+        request = self.factory.post('/fake/', data={'uploads_0': list(uploads)})
+        return self.TestFormWithTypes(request.POST, request.FILES)
+
+
+    def test_allowed(self):
+        """Test that files are judged by their content, not their name."""
+
+        form = self.post(
+            SimpleUploadedFile('photo.txt', self.jpeg, content_type='text/plain'),
+            SimpleUploadedFile('doc.pdf', b'%PDF-1.4 rest', content_type='application/pdf'))
+        self.assertTrue(form.is_valid(), form.errors)
+
+
+    def test_denied(self):
+        """Test that disguised and denied types are refused."""
+
+        executable = b'MZ\x90\x00' + b'\x00' * 56 + struct.pack('<I', 64) + b'PE\x00\x00'
+        form = self.post(SimpleUploadedFile('photo.jpeg', executable, content_type='image/jpeg'))
+        self.assertFalse(form.is_valid())
+        self.assertTrue('application/x-msdownload' in str(form.errors))
+
+        form = self.post(SimpleUploadedFile('icon.jpeg', b'<svg xmlns="http://www.w3.org/2000/svg"/>'))
+        self.assertFalse(form.is_valid())
+
+
+    def test_short_signatures(self):
+        """Test that text starting with the bytes of a short signature isn't
+        taken for a bitmap, an executable or an mp3."""
+
+        self.assertEqual(sniff(b'BMW,320i,2019,blue\nAudi,A4,2020,red\n'), 'text/plain')
+        self.assertEqual(sniff(b'MZ Corp quarterly report\n'), 'text/plain')
+        self.assertEqual(sniff(b'\xff\xfb\xf0\x00' + b'\x00' * 16), 'application/octet-stream')
+
+        bitmap = b'BM' + struct.pack('<IHHI', 70, 0, 0, 54) + struct.pack('<I', 40) + b'\x00' * 48
+        self.assertEqual(sniff(bitmap), 'image/bmp')
+        self.assertEqual(sniff(b'\xff\xfb\x90\x64' + b'\x00' * 16), 'audio/mpeg')
+
+
+    def test_truncated_text(self):
+        """Test that text whose header ends in the middle of a character
+        is still taken for text."""
+
+        text = (u'\u4e2d\u6587' * 700).encode('utf-8')
+        for size in (HEADER_SIZE, HEADER_SIZE + 1, HEADER_SIZE + 2):
+            self.assertEqual(sniff(text[:size]), 'text/plain')
+
+        self.assertEqual(sniff(text[:HEADER_SIZE - 1] + b'\xff'), 'application/octet-stream')
+
+
+    def test_read_header(self):
+        """Test that only the header is read, mapped for files on disk and
+        peeked at otherwise."""
+
+        upload = SimpleUploadedFile('photo.jpeg', self.jpeg)
+        upload.seek(10)
+        self.assertEqual(read_header(upload, 16), self.jpeg[:16])
+        self.assertEqual(upload.tell(), 10)
+
+        fd, path = tempfile.mkstemp(dir=TEMP_FILES_DIR)
+        os.write(fd, self.jpeg)
+        os.close(fd)
+        staged = StagedUploadedFile(path, 'photo.jpeg')
+        self.assertEqual(sniff(read_header(staged)), 'image/jpeg')
+        staged.close()
+
+
+    def tearDown(self):
+        remove_files()
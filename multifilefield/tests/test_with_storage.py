@@ -0,0 +1,196 @@
+import tempfile
+
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.core.files import File
+from django.core.files.uploadedfile import SimpleUploadedFile
+
+from multifilefield.fields import MultiFileField
+from multifilefield.models import UploadedFile
+from multifilefield.staging import StagedUploadedFile
+from multifilefield.storage import FastFileSystemStorage, CompressedStorage, copy_fd
+from multifilefield.tests import *
+
+
+
+class FastFileSystemStorageTestCase(TestCase):
+    """ Let's test that files on disk are moved into place."""
+
+
+    def setUp(self):
+        make_files()
+        self.storage = FastFileSystemStorage(location=TEMP_FILES_DIR)
+
+
+    def make_staged(self, name, content=b'file_content'):
+        fd, path = tempfile.mkstemp(dir=TEMP_FILES_DIR)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        return StagedUploadedFile(path, name)
+
+
+    def test_move_temporary_file(self):
+        """Test that a temporary upload is renamed into place, under a
+        new name when the name is taken."""
+
+        staged = self.make_staged('image_1.jpeg')
+        inode = os.stat(staged.path).st_ino
+
+        name = self.storage.save('image_1.jpeg', staged)
+        staged.close()
+
+        self.assertNotEqual(name, 'image_1.jpeg')
+        self.assertFalse(os.path.exists(staged.path))
+        self.assertEqual(os.stat(self.storage.path(name)).st_ino, inode)
+        with self.storage.open(name) as f:
+            self.assertEqual(f.read(), b'file_content')
+
+
+    def test_copy_file(self):
+        """Test that a file on disk is copied and left where it was."""
+
+        src = os.path.join(TEMP_FILES_DIR, 'image_1.jpeg')
+        with open(src, 'rb') as f:
+            name = self.storage.save('copied.jpeg', File(f))
+
+        self.assertTrue(os.path.exists(src))
+        with open(src, 'rb') as f, self.storage.open(name) as g:
+            self.assertEqual(f.read(), g.read())
+
+
+    def test_copy_from_position(self):
+        """Test that a file is copied from its current position."""
+
+        src = os.path.join(TEMP_FILES_DIR, 'image_1.jpeg')
+        with open(src, 'rb') as f:
+            content = f.read()
+            f.seek(100)
+            name = self.storage.save('partial.jpeg', File(f))
+
+        with self.storage.open(name) as f:
+            self.assertEqual(f.read(), content[100:])
+
+
+    def test_copy_wrapped(self):
+        """Test that a wrapper around a file, whose descriptor holds other
+        bytes than it reads, is streamed rather than copied."""
+
+        compressed = CompressedStorage(self.storage)
+        content = b'0123456789' * 3000
+        name = compressed.save('plain.txt', SimpleUploadedFile('plain.txt', content, content_type='text/plain'))
+        self.assertTrue(self.storage.size(name) < len(content))
+
+        with compressed.open(name) as f:
+            copied = self.storage.save('copied.txt', f)
+
+        with self.storage.open(copied) as f:
+            self.assertEqual(f.read(), content)
+
+
+    def test_copy_fd(self):
+        """Test the kernel copy, where the platform has one."""
+
+        src = os.path.join(TEMP_FILES_DIR, 'image_1.jpeg')
+        dest = os.path.join(TEMP_FILES_DIR, 'copy.jpeg')
+        size = os.path.getsize(src)
+
+        with open(src, 'rb') as f, open(dest, 'wb') as g:
+            copied = copy_fd(f.fileno(), g.fileno(), size)
+
+        if copied:
+            self.assertEqual(os.path.getsize(dest), size)
+
+
+    def test_field_upload(self):
+        """Test that in-memory uploads still stream through the field."""
+
+        field = MultiFileField(
+            storage = self.storage,
+            queryset = UploadedFile.objects.all(),
+            filefield_name='upload')
+
+        staged = self.make_staged('staged.txt')
+        uploaded = field.upload_files([SimpleUploadedFile('memory.txt', b'file_content'), staged])
+        staged.close()
+
+        self.assertEqual([f.upload.name for f in uploaded], ['memory.txt', 'staged.txt'])
+        self.assertEqual(uploaded[0].checksum, uploaded[1].checksum)
+        self.assertTrue(all(self.storage.exists(f.upload.name) for f in uploaded))
+
+
+    def tearDown(self):
+        remove_files()
+
+
+
+class CompressedStorageTestCase(TestCase):
+    """ Let's test that compressible files are stored compressed."""
+
+
+    def setUp(self):
+        make_files()
+        self.raw_storage = TestStorage()
+        self.storage = CompressedStorage(self.raw_storage, min_samples=2)
+
+
+    def test_compressed(self):
+        """Test that a csv is gzipped at rest and read back as it was."""
+
+        content = b''.join(('%s,name,value\n' % i).encode('ascii') for i in range(2000))
+        field = MultiFileField(
+            storage = self.storage,
+            queryset = UploadedFile.objects.all(),
+            filefield_name='upload')
+
+        uploaded_file, = field.upload_files([SimpleUploadedFile('export.csv', content, content_type='text/csv')])
+        name = uploaded_file.upload.name
+
+        self.assertEqual(uploaded_file.size, len(content))
+        self.assertTrue(self.raw_storage.size(name) < len(content) / 5)
+        self.assertEqual(self.storage.size(name), len(content))
+        with self.storage.open(name) as f:
+            self.assertEqual(f.read(), content)
+
+
+    @override_settings(ROOT_URLCONF='multifilefield.urls', TEMPLATES=[{
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'APP_DIRS': True}])
+    def test_url(self):
+        """Test that gzipped files have no url of their own and are linked
+        to the download view instead."""
+
+        field = MultiFileField(
+            storage = self.storage,
+            queryset = UploadedFile.objects.all(),
+            filefield_name='upload')
+
+        uploaded_file, = field.upload_files([SimpleUploadedFile('export.csv', b'1,name,value\n' * 2000, content_type='text/csv')])
+        self.assertRaises(NotImplementedError, self.storage.url, uploaded_file.upload.name)
+        self.assertEqual(self.storage.url('image_1.jpeg'), '/files/image_1.jpeg')
+
+        html = field.fields[1].widget.render('uploads_1', None, {'id': 'id_uploads_1'})
+        self.assertTrue('href="%s"' % uploaded_file.get_download_url() in html)
+        self.assertFalse(self.raw_storage.url(uploaded_file.upload.name) in html)
+
+
+    def test_skipped(self):
+        """Test that other files are stored raw, gzip uploads included, and
+        that a content type that doesn't compress isn't tried again."""
+
+        image = os.path.join(TEMP_FILES_DIR, 'image_1.jpeg')
+        with open(image, 'rb') as f:
+            name = self.storage.save('copy.jpeg', File(f))
+        self.assertEqual(self.raw_storage.size(name), os.path.getsize(image))
+
+        gzipped = self.storage.save('upload.txt.gz', SimpleUploadedFile('upload.txt.gz', b'\x1f\x8b\x08\x00rest'))
+        with self.storage.open(gzipped) as f:
+            self.assertEqual(f.read(), b'\x1f\x8b\x08\x00rest')
+
+        for i in range(3):
+            name = self.storage.save('random.txt', SimpleUploadedFile('random.txt', os.urandom(4096)))
+            self.assertEqual(self.raw_storage.size(name), 4096)
+        self.assertEqual(self.storage.ratios['text/plain'][0], 2)
+
+
+    def tearDown(self):
+        remove_files()
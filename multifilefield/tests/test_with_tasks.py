@@ -0,0 +1,203 @@
+import sys, json, time, unittest
+
+from datetime import datetime, timedelta
+from django import forms
+from django.db import connection, transaction
+from django.db.models import F
+from django.test import TransactionTestCase, RequestFactory
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.utils.six import StringIO
+
+from multifilefield.fields import MultiFileField
+from multifilefield.mixins import MultiFileFieldMixin
+from multifilefield.models import UploadedFile, FileTask, FileQuota
+from multifilefield.staging import stage_file
+from multifilefield import tasks
+from multifilefield.tasks import get_form_path
+from multifilefield.tests import *
+
+
+
+class TaskForm(MultiFileFieldMixin, forms.Form):
+    uploads = MultiFileField(
+        storage = TestStorage(),
+        queryset = UploadedFile.objects.all(),
+        filefield_name = 'upload')
+
+
+
+class InlinePool(object):
+    def apply_async(self, func, args):
+        func(*args)
+
+
+
+class LostPool(object):
+    """Stands in for a process that goes away before running the task."""
+
+    def apply_async(self, func, args):
+        pass
+
+
+
+class DeferredTaskTestCase(TransactionTestCase):
+    """ Let's test that deferred work runs on the pool once committed, and
+    that the worker command picks up whatever a process left behind.
+    Workers use their own connections, so rows have to be committed."""
+
+
+    def setUp(self):
+        make_files()
+
+
+    def make_task(self, name='staged.txt', **kwargs):
+        kwargs.setdefault('form_path', get_form_path(TaskForm()))
+        kwargs.setdefault('config', json.dumps({'quota_key': ''}))
+        staged = stage_file(SimpleUploadedFile(name, b'file_content'))
+        task = FileTask.objects.create(field_name='uploads', added=json.dumps([staged]), removed='[]', **kwargs)
+        return task, staged['path']
+
+
+    def worker(self, **options):
+        call_command('multifilefield_worker', once=True, stdout=StringIO(), **options)
+
+
+    def process(self, **field_kwargs):
+        ids = [str(pk) for pk in UploadedFile.objects.order_by('pk').values_list('pk', flat=True)[:2]]
+        data = {
+            'uploads_0': SimpleUploadedFile('pooled.txt', b'file_content'),
+            'uploads_1': ids
+        }
+        request = RequestFactory().post('/fake/', data=data)
+        form = TaskForm(request.POST, request.FILES)
+        for (name, value) in field_kwargs.items():
+            setattr(form.fields['uploads'], name, value)
+        self.assertTrue(form.is_valid(), form.errors)
+
+        task = form.process_files_for('uploads', defer=True)
+        self.assertEqual(task.form_path, get_form_path(form))
+        return task, ids
+
+
+    def assertDone(self, task, ids):
+        task = FileTask.objects.get(pk=task.pk)
+        self.assertEqual(task.status, FileTask.DONE, task.error)
+        self.assertTrue(UploadedFile.objects.filter(filename='pooled.txt').exists())
+        self.assertFalse(UploadedFile.objects.filter(id__in=ids).exists())
+        self.assertFalse(any(os.path.exists(item['path']) for item in json.loads(task.added)))
+
+
+    def test_on_commit(self):
+        """Test that a deferred task is handed to the pool once the
+        transaction that recorded it commits, and not before."""
+
+        pool, tasks._pool = tasks._pool, InlinePool()
+        try:
+            with transaction.atomic():
+                task, ids = self.process()
+                self.assertEqual(FileTask.objects.get(pk=task.pk).status, FileTask.PENDING)
+        finally:
+            tasks._pool = pool
+
+        self.assertDone(task, ids)
+
+
+    @unittest.skipIf(sys.version_info < (3,) and connection.vendor == 'sqlite',
+        'Threads only share an in-memory sqlite database on Python 3')
+    def test_pool(self):
+        """Test that a deferred task runs on the pool's threads."""
+
+        task, ids = self.process()
+
+        for i in range(100):
+            if FileTask.objects.filter(pk=task.pk, status__in=[FileTask.DONE, FileTask.FAILED]).exists():
+                break
+            time.sleep(0.05)
+
+        self.assertDone(task, ids)
+
+
+    def test_worker(self):
+        """Test that the worker rebuilds the field from the form and runs
+        pending tasks, and fails tasks it can't rebuild."""
+
+        task, path = self.make_task()
+        orphan, orphan_path = self.make_task('orphan.txt', form_path='')
+
+        self.worker()
+
+        task = FileTask.objects.get(pk=task.pk)
+        self.assertEqual((task.status, task.attempts), (FileTask.DONE, 1))
+        self.assertTrue(UploadedFile.objects.filter(filename='staged.txt').exists())
+        self.assertFalse(os.path.exists(path))
+
+        self.assertEqual(FileTask.objects.get(pk=orphan.pk).status, FileTask.FAILED)
+        self.assertTrue(os.path.exists(orphan_path))
+
+
+    def test_worker_config(self):
+        """Test that the worker gives the rebuilt field the owner and quota
+        key the view set, and only removes files the view's queryset had."""
+
+        owner = UploadedFile.objects.order_by('pk')[0]
+        queryset = UploadedFile.objects.filter(pk__gt=owner.pk)
+
+        pool, tasks._pool = tasks._pool, LostPool()
+        try:
+            task, ids = self.process(owner=owner, quota_key='user:1', queryset=queryset)
+        finally:
+            tasks._pool = pool
+
+        self.worker()
+
+        self.assertDone(task, ids[1:])
+        self.assertTrue(UploadedFile.objects.filter(id=owner.pk).exists())
+
+        uploaded_file = UploadedFile.objects.get(filename='pooled.txt')
+        self.assertEqual((uploaded_file.owner_id, uploaded_file.quota_key), (owner.pk, 'user:1'))
+        self.assertEqual(FileQuota.objects.get(key='user:1').num_files, 1)
+
+
+    def test_lost_claim(self):
+        """Test that a failed run whose task was claimed again in the
+        meantime neither finishes it nor removes its staged files."""
+
+        task, path = self.make_task()
+        field = TaskForm().fields['uploads']
+
+        def reclaim(files):
+            FileTask.objects.filter(pk=task.pk).update(attempts=F('attempts') + 1)
+            raise IOError('Storage went away.')
+
+        field.upload_files = reclaim
+        tasks.run_task(field, task.pk)
+
+        self.assertEqual(FileTask.objects.get(pk=task.pk).status, FileTask.RUNNING)
+        self.assertTrue(os.path.exists(path))
+
+
+    def test_stale(self):
+        """Test that tasks lost while running are retried, and given up on
+        with their staged files removed after max_attempts."""
+
+        retried, retried_path = self.make_task('retried.txt')
+        abandoned, abandoned_path = self.make_task('abandoned.txt')
+
+        old = datetime.today() - timedelta(hours=2)
+        FileTask.objects.filter(pk=retried.pk).update(status=FileTask.RUNNING, attempts=1, updated_at=old)
+        FileTask.objects.filter(pk=abandoned.pk).update(status=FileTask.RUNNING, attempts=3, updated_at=old)
+
+        self.worker(max_attempts=3)
+
+        retried = FileTask.objects.get(pk=retried.pk)
+        self.assertEqual((retried.status, retried.attempts), (FileTask.DONE, 2))
+        self.assertTrue(UploadedFile.objects.filter(filename='retried.txt').exists())
+
+        self.assertEqual(FileTask.objects.get(pk=abandoned.pk).status, FileTask.FAILED)
+        self.assertFalse(os.path.exists(abandoned_path))
+        self.assertFalse(UploadedFile.objects.filter(filename='abandoned.txt').exists())
+
+
+    def tearDown(self):
+        remove_files()
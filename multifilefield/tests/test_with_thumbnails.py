@@ -0,0 +1,92 @@
+import time
+
+from unittest import skipIf
+from django.test import TestCase
+
+from multifilefield import thumbnails
+from multifilefield.manifest import StoredFile
+from multifilefield.widgets import ClearFilesWidget
+from multifilefield.tests import *
+
+
+
+class ThumbnailTestCase(TestCase):
+    """ This TestCase is for testing thumbnails in the clear files list. """
+
+
+    def setUp(self):
+        make_files()
+        self.storage = TestStorage()
+
+
+    def test_thumbnail_name(self):
+        """Test that thumbnails are named after the original and size."""
+
+        self.assertEqual(thumbnails.thumbnail_name('a/image_1.JPEG', (64, 48)), 'a/image_1.thumb-64x48.jpeg')
+        self.assertTrue(thumbnails.is_thumbnail('a/image_1.thumb-64x48.jpeg'))
+        self.assertFalse(thumbnails.is_thumbnail('a/image_1.jpeg'))
+
+
+    def test_no_thumbnail_size(self):
+        """Test that thumbnails are off by default."""
+
+        widget = ClearFilesWidget(choices=[('image_1.jpeg', StoredFile(self.storage, 'image_1.jpeg'))])
+        context = widget.get_context('uploads_1', None, {})
+
+        self.assertEqual(context['choices'][0][2], None)
+
+
+    @skipIf(thumbnails.Image is None, 'PIL is not installed')
+    def test_thumbnail(self):
+        """Test that the thumbnail is made in the background and then
+        reused."""
+
+        widget = ClearFilesWidget(
+            thumbnail_size = (32, 32),
+            storage = self.storage,
+            choices = [('image_1.jpeg', StoredFile(self.storage, 'image_1.jpeg'))])
+
+        self.assertEqual(widget.get_context('uploads_1', None, {})['choices'][0][2], None)
+
+        name = thumbnails.thumbnail_name('image_1.jpeg', (32, 32))
+        for i in range(100):
+            if self.storage.exists(name):
+                break
+            time.sleep(0.05)
+
+        self.assertEqual(widget.get_context('uploads_1', None, {})['choices'][0][2], self.storage.url(name))
+
+        image = thumbnails.Image.open(self.storage.path(name))
+        self.assertTrue(max(image.size) <= 32)
+
+
+    @skipIf(thumbnails.Image is None, 'PIL is not installed')
+    def test_no_thumbnail(self):
+        """Test that vector images aren't tried and that images that fail
+        end up without a thumbnail rather than pending."""
+
+        for name in ('icon.svg', 'broken.jpeg'):
+            with open(os.path.join(TEMP_FILES_DIR, name), 'wb') as f:
+                f.write(b'<svg xmlns="http://www.w3.org/2000/svg"/>')
+
+        self.assertEqual(thumbnails.get_thumbnail(self.storage, 'icon.svg', (32, 32)), (None, False))
+        self.assertEqual(thumbnails.get_thumbnail(self.storage, 'broken.jpeg', (32, 32)), (None, True))
+
+        dest = self.storage.path(thumbnails.thumbnail_name('broken.jpeg', (32, 32)))
+        for i in range(100):
+            if dest in thumbnails._failed:
+                break
+            time.sleep(0.05)
+
+        widget = ClearFilesWidget(
+            thumbnail_size = (32, 32),
+            storage = self.storage,
+            choices = [(name, StoredFile(self.storage, name)) for name in ('icon.svg', 'broken.jpeg')])
+
+        self.assertEqual([choice[2] for choice in widget.get_context('uploads_1', None, {})['choices']], [None, None])
+        self.assertFalse(widget.thumbnails_pending)
+        self.assertFalse(self.storage.exists(thumbnails.thumbnail_name('broken.jpeg', (32, 32))))
+
+
+    def tearDown(self):
+        remove_files()
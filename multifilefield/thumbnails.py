@@ -0,0 +1,122 @@
+import os, six, mimetypes, threading
+
+from multiprocessing import Pool
+
+from django.conf import settings
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+THUMBNAIL_MARK = '.thumb-'
+
+_pool = None
+_pool_lock = threading.Lock()
+_pending = set()
+_failed = set()
+
+
+
+def thumbnail_name(name, size):
+    """The thumbnail is stored next to the original under a name derived
+    from the original's name and the thumbnail size."""
+
+    root, ext = os.path.splitext(name)
+    return '%s%s%sx%s%s' % (root, THUMBNAIL_MARK, size[0], size[1], ext.lower())
+
+
+def is_thumbnail(name):
+    return THUMBNAIL_MARK in os.path.basename(name)
+
+
+def is_image(name):
+    """Whether the name is that of an image PIL can read, which leaves
+    out vector images like svg."""
+
+    content_type = mimetypes.guess_type(name)[0]
+    if not content_type or not content_type.startswith('image/'):
+        return False
+
+    Image.init()
+    return os.path.splitext(name)[1].lower() in Image.EXTENSION
+
+
+def make_thumbnail(src, dest, size):
+    """Runs in the process pool, so it only deals with paths.  Returns
+    None when the image can't be read or written."""
+
+    tmp_path = '%s.%s.tmp' % (dest, os.getpid())
+    try:
+        image = Image.open(src)
+        image.thumbnail(size)
+        image.save(tmp_path, format=image.format)
+        os.rename(tmp_path, dest)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None
+
+    return dest
+
+
+def get_pool():
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = Pool(getattr(settings, 'MULTIFILEFIELD_THUMBNAIL_WORKERS', 1))
+    return _pool
+
+
+def schedule_thumbnail(src, dest, size):
+    """Makes the thumbnail on the process pool.  Returns False when it
+    failed before, as images that fail aren't retried on every render."""
+
+    with _pool_lock:
+        if dest in _failed:
+            return False
+        if dest in _pending:
+            return True
+        _pending.add(dest)
+
+    def done(result):
+        with _pool_lock:
+            _pending.discard(dest)
+            if result is None:
+                _failed.add(dest)
+
+    kwargs = {'callback': done}
+    if not six.PY2:
+        kwargs['error_callback'] = lambda error: done(None)
+
+    get_pool().apply_async(make_thumbnail, (src, dest, size), **kwargs)
+    return True
+
+
+def get_thumbnail(storage, name, size):
+    """Returns the url of an image's thumbnail and whether it is still
+    being made.  If it hasn't been made yet it is generated on the
+    process pool and no url is returned for now, so the request never
+    waits on it.  Thumbnails are only made for storages with local paths,
+    and only when PIL is available."""
+
+    if Image is None or not name or not is_image(name):
+        return None, False
+
+    thumb = thumbnail_name(name, size)
+    if storage.exists(thumb):
+        return storage.url(thumb), False
+
+    try:
+        src = storage.path(name)
+        dest = storage.path(thumb)
+    except NotImplementedError:
+        return None, False
+
+    return None, schedule_thumbnail(src, dest, size)
+
+
+def get_thumbnail_url(storage, name, size):
+    return get_thumbnail(storage, name, size)[0]
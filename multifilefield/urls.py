@@ -0,0 +1,11 @@
+from django.conf.urls import url
+
+from . import views
+
+
+urlpatterns = [
+    url(r'^tasks/(?P<pk>\d+)/$', views.task_status, name='multifilefield-task-status'),
+    url(r'^uploads/$', views.chunked_upload_create, name='multifilefield-chunked-upload-create'),
+    url(r'^uploads/(?P<token>[0-9a-f]{32})/$', views.chunked_upload, name='multifilefield-chunked-upload'),
+    url(r'^files/(?P<pk>\d+)/$', views.download, name='multifilefield-download'),
+]
@@ -0,0 +1,410 @@
+import os, re, json, time, base64, hashlib, calendar
+
+from datetime import datetime
+
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.core.files import locks
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseNotModified, FileResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.encoding import force_bytes
+from django.utils.http import http_date, parse_http_date_safe, urlquote
+from django.utils.module_loading import import_string
+from django.views.decorators.http import require_http_methods
+
+from .models import FileTask, ChunkedUpload, UploadedFile
+from .sniffing import matches
+from .storage import CompressedStorage
+from .zipstream import ZipStream, ZIP_STORED, ZIP_DEFLATED
+
+try:
+    from django.urls import reverse
+except ImportError:
+    from django.core.urlresolvers import reverse
+
+
+TUS_VERSION = '1.0.0'
+CHUNK_SIZE = 64 * 2 ** 10
+CHUNKED_MAX_SIZE = 2 ** 30
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+
+def has_permission(setting_name, *args):
+    """ Calls the permission in a setting, a callable or the dotted path
+        of one, with args.  Without the setting nothing is allowed."""
+
+    permission = getattr(settings, setting_name, None)
+    if permission is None:
+        return False
+    if not callable(permission):
+        permission = import_string(permission)
+    return permission(*args)
+
+
+def task_status(request, pk):
+    """ Reports the status of a deferred FileTask as json, for views
+        that poll after process_files_for(defer=True).  The pks are
+        sequential, so MULTIFILEFIELD_TASK_PERMISSION, taking the request
+        and the task, has to allow it."""
+
+    task = get_object_or_404(FileTask, pk=pk)
+    if not has_permission('MULTIFILEFIELD_TASK_PERMISSION', request, task):
+        raise PermissionDenied
+
+    data = {'id': task.pk, 'status': task.status}
+
+    return HttpResponse(json.dumps(data), content_type='application/json')
+
+
+def tus_response(status=204, **headers):
+    response = HttpResponse(status=status)
+    response['Tus-Resumable'] = TUS_VERSION
+    response['Cache-Control'] = 'no-store'
+    for (header, value) in headers.items():
+        response[header.replace('_', '-')] = str(value)
+    return response
+
+
+def parse_upload_metadata(header):
+    metadata = {}
+    for pair in header.split(','):
+        parts = pair.strip().split(' ', 1)
+        if parts[0]:
+            value = parts[1] if len(parts) > 1 else ''
+            metadata[parts[0]] = base64.b64decode(value).decode('utf-8')
+    return metadata
+
+
+def can_upload(request):
+    """ MULTIFILEFIELD_UPLOAD_PERMISSION is a callable, or the dotted path
+        of one, taking the request.  Without it no chunked upload can be
+        started, as each one takes up disk space until it expires."""
+
+    return has_permission('MULTIFILEFIELD_UPLOAD_PERMISSION', request)
+
+
+def check_upload(length, content_type, form_class=None, field_name=None):
+    """ The status an upload of length bytes is refused with, or None.
+        With a form_class (or its dotted path) and field_name the limits of
+        that MultiFileField apply as well.  The content type is what the
+        client claims; the file is sniffed again when the form is cleaned."""
+
+    max_size = getattr(settings, 'MULTIFILEFIELD_CHUNKED_MAX_SIZE', CHUNKED_MAX_SIZE)
+    if length < 0 or (max_size and length > max_size):
+        return 413
+
+    if form_class is None:
+        return None
+
+    if not isinstance(form_class, type):
+        form_class = import_string(form_class)
+    add_files = form_class.base_fields[field_name].fields[0]
+
+    if add_files.max_file_size and length > add_files.max_file_size:
+        return 413
+
+    content_type = content_type.lower()
+    allowed = not add_files.allowed_types or matches(content_type, add_files.allowed_types)
+    if not allowed or (add_files.denied_types and matches(content_type, add_files.denied_types)):
+        return 415
+
+
+@require_http_methods(['OPTIONS', 'POST'])
+def chunked_upload_create(request, form_class=None, field_name=None):
+    """ Starts a resumable upload, following the tus 1.0 creation
+        extension.  The client sends Upload-Length and optionally the
+        filename and filetype in Upload-Metadata, and gets the upload's
+        url back in Location.
+
+        Pass form_class and field_name as extra url kwargs to hold uploads
+        to a field's limits."""
+
+    if request.method == 'OPTIONS':
+        return tus_response(Tus_Version=TUS_VERSION, Tus_Extension='creation')
+
+    if not can_upload(request):
+        raise PermissionDenied
+
+    try:
+        length = int(request.META['HTTP_UPLOAD_LENGTH'])
+        metadata = parse_upload_metadata(request.META.get('HTTP_UPLOAD_METADATA', ''))
+    except (KeyError, ValueError, TypeError):
+        return tus_response(400)
+
+    status = check_upload(length, metadata.get('filetype', ''), form_class, field_name)
+    if status:
+        return tus_response(status)
+
+    upload = ChunkedUpload.objects.create(
+        name = os.path.basename(metadata.get('filename', '')) or 'upload',
+        content_type = metadata.get('filetype', ''),
+        length = length)
+
+    open(upload.path, 'wb').close()
+
+    location = request.build_absolute_uri(reverse('multifilefield-chunked-upload', args=[upload.token]))
+    return tus_response(201, Location=location, Upload_Token=upload.token)
+
+
+@transaction.non_atomic_requests
+@require_http_methods(['HEAD', 'PATCH'])
+def chunked_upload(request, token):
+    """ HEAD reports how much of the upload has been received.  PATCH
+        writes the request body to the staging file at Upload-Offset,
+        which has to match what was received so far.  Whatever arrives
+        before a dropped connection is kept, so the client can resume from
+        the offset a following HEAD reports.
+
+        Writers are kept apart by a lock on the staging file rather than
+        on the row, so no transaction stays open while the body streams
+        in.  A PATCH that finds the file locked gets a 409."""
+
+    upload = get_object_or_404(ChunkedUpload, token=token)
+
+    if request.method == 'HEAD':
+        return tus_response(200, Upload_Offset=upload.offset, Upload_Length=upload.length)
+
+    if request.META.get('CONTENT_TYPE') != 'application/offset+octet-stream':
+        return tus_response(415)
+
+    try:
+        offset = int(request.META['HTTP_UPLOAD_OFFSET'])
+    except (KeyError, ValueError, TypeError):
+        return tus_response(400)
+
+    if offset != upload.offset:
+        return tus_response(409, Upload_Offset=upload.offset)
+
+    with open(upload.path, 'r+b') as f:
+        try:
+            locks.lock(f, locks.LOCK_EX | locks.LOCK_NB)
+        except (IOError, OSError):
+            return tus_response(409, Upload_Offset=upload.offset)
+
+        try:
+            # Another PATCH may have moved the offset before we got the lock.
+            received = get_object_or_404(ChunkedUpload.objects.values_list('offset', flat=True), pk=upload.pk)
+            if received != offset:
+                return tus_response(409, Upload_Offset=received)
+
+            f.seek(offset)
+            try:
+                while received < upload.length:
+                    chunk = request.read(min(CHUNK_SIZE, upload.length - received))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    received += len(chunk)
+            except IOError:
+                # The client went away, keep what has arrived.
+                pass
+            f.flush()
+
+            ChunkedUpload.objects.filter(pk=upload.pk, offset=offset).update(
+                offset = received,
+                updated_at = datetime.today())
+        finally:
+            locks.unlock(f)
+
+    return tus_response(204, Upload_Offset=received)
+
+
+def get_etag(uploaded_file):
+    if uploaded_file.checksum:
+        return '"%s"' % uploaded_file.checksum
+
+    digest = hashlib.md5(force_bytes('%s|%s|%s' % (
+        uploaded_file.upload.name, uploaded_file.size, uploaded_file.updated_at))).hexdigest()
+    return '"%s"' % digest
+
+
+def get_last_modified(uploaded_file):
+    updated_at = uploaded_file.updated_at
+    if updated_at is None:
+        return None
+    if updated_at.tzinfo is not None:
+        return calendar.timegm(updated_at.utctimetuple())
+    return int(time.mktime(updated_at.timetuple()))
+
+
+def is_not_modified(request, etag, last_modified):
+    """ If-None-Match takes precedence over If-Modified-Since, as in
+        RFC 7232."""
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        # Weak comparison, W/ prefixes are ignored.
+        return '*' in tags or etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return bool(if_modified_since and last_modified and last_modified <= if_modified_since)
+
+
+def parse_range(header, size):
+    """ The (start, end) of a single byte range, inclusive.  None for
+        anything we don't serve partially (no header, several ranges),
+        ValueError when the range can't be satisfied."""
+
+    match = RANGE_RE.match(header or '')
+    if not match:
+        return None
+
+    first, last = match.groups()
+    if not first and not last:
+        return None
+
+    if not first:
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+
+    if size == 0 or start >= size or start > end:
+        raise ValueError(header)
+
+    return start, end
+
+
+def read_range(file_obj, start, end):
+    try:
+        file_obj.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = file_obj.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        file_obj.close()
+
+
+def is_compressed(storage, name):
+    return isinstance(storage, CompressedStorage) and storage.is_compressed(name)
+
+
+def offload_response(uploaded_file):
+    """ Hands the transfer to the front-end server when
+        MULTIFILEFIELD_SENDFILE is 'nginx' (X-Accel-Redirect below
+        MULTIFILEFIELD_ACCEL_REDIRECT_PREFIX) or 'apache' (X-Sendfile),
+        which then also deals with ranges.  Files CompressedStorage
+        gzipped are streamed instead, as the server would send them
+        compressed."""
+
+    backend = getattr(settings, 'MULTIFILEFIELD_SENDFILE', None)
+    if not backend:
+        return None
+
+    name = uploaded_file.upload.name
+    if is_compressed(uploaded_file.upload.storage, name):
+        return None
+
+    response = HttpResponse(content_type=uploaded_file.content_type or 'application/octet-stream')
+    if backend == 'nginx':
+        prefix = getattr(settings, 'MULTIFILEFIELD_ACCEL_REDIRECT_PREFIX', '/protected/')
+        response['X-Accel-Redirect'] = urlquote('%s/%s' % (prefix.rstrip('/'), name.lstrip('/')))
+    elif backend == 'apache':
+        response['X-Sendfile'] = uploaded_file.upload.storage.path(name)
+    else:
+        raise ValueError('Unknown MULTIFILEFIELD_SENDFILE %r.' % backend)
+
+    return response
+
+
+def can_download(request, uploaded_file):
+    """ MULTIFILEFIELD_DOWNLOAD_PERMISSION is a callable, or the dotted
+        path of one, taking the request and the file.  Without it nothing
+        can be downloaded, as the urls only take a sequential pk."""
+
+    return has_permission('MULTIFILEFIELD_DOWNLOAD_PERMISSION', request, uploaded_file)
+
+
+def stream_response(request, uploaded_file, etag, last_modified):
+    storage = uploaded_file.upload.storage
+    name = uploaded_file.upload.name
+    content_type = uploaded_file.content_type or 'application/octet-stream'
+    size = uploaded_file.size if uploaded_file.size is not None else storage.size(name)
+
+    # A range only applies while the file is still the one the client has.
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range and if_range != etag and parse_http_date_safe(if_range) != last_modified:
+        byte_range = None
+    else:
+        try:
+            byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%s' % size
+            return response
+
+    if byte_range is None:
+        response = FileResponse(storage.open(name, 'rb'), content_type=content_type)
+        response['Content-Length'] = size
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(read_range(storage.open(name, 'rb'), start, end),
+            status=206, content_type=content_type)
+        response['Content-Range'] = 'bytes %s-%s/%s' % (start, end, size)
+        response['Content-Length'] = end - start + 1
+
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+@require_http_methods(['GET', 'HEAD'])
+def download(request, pk):
+    """ Serves an UploadedFile.  The ETag comes from the checksum and
+        Last-Modified from updated_at, so a conditional request that
+        matches costs a 304 without touching storage.  The transfer is
+        offloaded to the front-end server when configured, otherwise the
+        file is streamed with support for a single byte range.  Requests
+        MULTIFILEFIELD_DOWNLOAD_PERMISSION doesn't allow get a 403."""
+
+    uploaded_file = get_object_or_404(UploadedFile, pk=pk)
+    if not can_download(request, uploaded_file):
+        raise PermissionDenied
+
+    etag = get_etag(uploaded_file)
+    last_modified = get_last_modified(uploaded_file)
+
+    if is_not_modified(request, etag, last_modified):
+        response = HttpResponseNotModified()
+    else:
+        response = offload_response(uploaded_file) or stream_response(request, uploaded_file, etag, last_modified)
+
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified)
+    if response.status_code != 304:
+        response['Content-Disposition'] = "attachment; filename*=UTF-8''%s" % urlquote(uploaded_file.basename)
+
+    return response
+
+
+def zip_response(queryset, filefield_name='upload', filename='files.zip', compress=False, storage=None):
+    """ Streams the files of a queryset (ie: the one a MultiFileField was
+        given) as a zip archive.  Rows are fetched with iterator() and
+        each file is only opened when the archive reaches it and read a
+        chunk at a time, so memory stays flat however big the archive.
+        Files are stored as is unless compress is set.  They are opened
+        from storage, or else the model field's storage."""
+
+    def files():
+        for obj in queryset.iterator():
+            field_file = getattr(obj, filefield_name)
+            updated_at = getattr(obj, 'updated_at', None) or getattr(obj, 'created_at', None)
+
+            yield (
+                getattr(obj, 'basename', None) or os.path.basename(field_file.name),
+                lambda name=field_file.name, storage=storage or field_file.storage: storage.open(name, 'rb'),
+                getattr(obj, 'size', None),
+                updated_at.timetuple()[:6] if updated_at else None)
+
+    archive = ZipStream(ZIP_DEFLATED if compress else ZIP_STORED)
+    response = StreamingHttpResponse(archive.stream(files()), content_type='application/zip')
+    response['Content-Disposition'] = "attachment; filename*=UTF-8''%s" % urlquote(filename)
+
+    return response
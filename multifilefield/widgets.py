@@ -1,6 +1,16 @@
 import six, copy, floppyforms as forms
 
 from itertools import chain
+from django.utils.safestring import mark_safe
+
+try:
+    from django.urls import NoReverseMatch
+except ImportError:
+    from django.core.urlresolvers import NoReverseMatch
+
+from . import caching
+from .models import UploadedFile
+from .thumbnails import get_thumbnail
 
 
 class MultiFileWidget(forms.MultiWidget):
@@ -39,6 +49,14 @@ class AddFilesWidget(forms.FileInput):
                 if value:
                     values = [value]
 
+        # Tokens of completed chunked uploads are posted as plain values.
+        if data:
+            if hasattr(data, 'getlist'):
+                tokens = data.getlist(name)
+            else:
+                tokens = [data.get(name, None)]
+            values = values + [t for t in tokens if t and isinstance(t, six.string_types)]
+
         return values
 
 
@@ -46,12 +64,96 @@ class AddFilesWidget(forms.FileInput):
 class ClearFilesWidget(forms.CheckboxSelectMultiple):
     template_name = 'floppyforms/clear-files.html'
 
+    def __init__(self, *args, **kwargs):
+        self.thumbnail_size = kwargs.pop('thumbnail_size', None)
+        self.storage = kwargs.pop('storage', None)
+        self.cache_timeout = kwargs.pop('cache_timeout', None)
+        self.thumbnails_pending = False
+        super(ClearFilesWidget, self).__init__(*args, **kwargs)
+
+
+    def get_thumbnail_url(self, file_obj):
+        storage = self.storage or getattr(file_obj, 'storage', None)
+        if not self.thumbnail_size or storage is None:
+            return None
+
+        url, pending = get_thumbnail(storage, file_obj.name, self.thumbnail_size)
+        if pending:
+            self.thumbnails_pending = True
+        return url
+
+
+    def get_download_url(self, choice_id, file_obj):
+        """The file's url, or the download view's for files the storage
+        has no url for, like those CompressedStorage gzipped."""
+
+        storage = self.storage or getattr(file_obj, 'storage', None)
+        if storage is None:
+            return None
+
+        try:
+            return storage.url(file_obj.name)
+        except NotImplementedError:
+            pass
+
+        queryset = getattr(self.choices, 'queryset', None)
+        if queryset is None or not issubclass(queryset.model, UploadedFile):
+            return None
+
+        try:
+            return UploadedFile(pk = choice_id).get_download_url()
+        except NoReverseMatch:
+            return None
+
+
+    def get_cache_key(self, name, value, attrs):
+        cache_key = getattr(self.choices, 'cache_key', None)
+        choices_key = cache_key() if self.cache_timeout and cache_key else None
+        if choices_key is None:
+            return None
+
+        if not hasattr(value, '__iter__') or isinstance(value, six.string_types):
+            value = [value]
+
+        return caching.make_key(
+            caching.get_version(),
+            choices_key,
+            self.template_name,
+            self.thumbnail_size,
+            name,
+            sorted(six.text_type(v) for v in value if v is not None),
+            sorted((attrs or {}).items()),
+            sorted(self.attrs.items()))
+
+
+    def render(self, name, value, attrs=None, **kwargs):
+        """With a cache_timeout the rendered list is kept in the cache,
+        keyed on the choices and a version stamp that changes whenever an
+        UploadedFile is saved or deleted.  Lists still waiting on
+        thumbnails aren't cached."""
+
+        key = self.get_cache_key(name, value, attrs) if not kwargs else None
+        if key is None:
+            return super(ClearFilesWidget, self).render(name, value, attrs, **kwargs)
+
+        html = caching.get_fragment(key)
+        if html is None:
+            self.thumbnails_pending = False
+            html = super(ClearFilesWidget, self).render(name, value, attrs)
+            if not self.thumbnails_pending:
+                caching.set_fragment(key, html, self.cache_timeout)
+
+        return mark_safe(html)
+
+
     def get_context(self, name, value, attrs=None):
         if not hasattr(value, '__iter__') or isinstance(value, six.string_types):
             value = [value]
 
         context = super(ClearFilesWidget, self).get_context(name, value, attrs)
         context['attrs']['multiple'] = 'multiple'
-        context['choices'] = self.choices
+        context['choices'] = [
+            (choice_id, file_obj, self.get_thumbnail_url(file_obj), self.get_download_url(choice_id, file_obj))
+            for (choice_id, file_obj) in self.choices]
 
         return context
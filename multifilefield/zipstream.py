@@ -0,0 +1,201 @@
+import os, time, zlib, struct
+
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_FILECOUNT_LIMIT = 0xFFFF
+CHUNK_SIZE = 64 * 2 ** 10
+
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+
+
+class ZipEntry(object):
+    """The bookkeeping of one member, kept for the central directory."""
+
+    def __init__(self, name, date_time, method, offset, zip64):
+        self.name = name.encode('utf-8')
+        self.date_time = date_time
+        self.method = method
+        self.offset = offset
+        self.zip64 = zip64
+        self.crc = 0
+        self.compressed_size = 0
+        self.size = 0
+
+
+    @property
+    def version(self):
+        return 45 if self.zip64 else 20
+
+
+    def dos_time(self):
+        year, month, day, hour, minute, second = self.date_time[:6]
+        if year < 1980:
+            year, month, day, hour, minute, second = 1980, 1, 1, 0, 0, 0
+        return (
+            hour << 11 | minute << 5 | second // 2,
+            (year - 1980) << 9 | month << 5 | day)
+
+
+    def local_header(self):
+        # Sizes and crc follow the data in a descriptor, so the header
+        # can go out before the file has been read.
+        dostime, dosdate = self.dos_time()
+        extra = b''
+        sizes = 0
+        if self.zip64:
+            extra = struct.pack('<HHQQ', 0x0001, 16, 0, 0)
+            sizes = ZIP64_LIMIT
+
+        return struct.pack('<IHHHHHIIIHH',
+            0x04034b50, self.version, FLAG_DATA_DESCRIPTOR | FLAG_UTF8, self.method,
+            dostime, dosdate, 0, sizes, sizes, len(self.name), len(extra)) + self.name + extra
+
+
+    def data_descriptor(self):
+        if self.zip64:
+            return struct.pack('<IIQQ', 0x08074b50, self.crc, self.compressed_size, self.size)
+        return struct.pack('<IIII', 0x08074b50, self.crc, self.compressed_size, self.size)
+
+
+    def central_header(self):
+        dostime, dosdate = self.dos_time()
+
+        values = []
+        size, compressed_size, offset = self.size, self.compressed_size, self.offset
+        if size >= ZIP64_LIMIT:
+            values.append(size)
+            size = ZIP64_LIMIT
+        if compressed_size >= ZIP64_LIMIT:
+            values.append(compressed_size)
+            compressed_size = ZIP64_LIMIT
+        if offset >= ZIP64_LIMIT:
+            values.append(offset)
+            offset = ZIP64_LIMIT
+
+        extra = b''
+        if values:
+            extra = struct.pack('<HH%sQ' % len(values), 0x0001, 8 * len(values), *values)
+
+        version = 45 if (values or self.zip64) else 20
+        return struct.pack('<IHHHHHHIIIHHHHHII',
+            0x02014b50, 3 << 8 | version, version, FLAG_DATA_DESCRIPTOR | FLAG_UTF8, self.method,
+            dostime, dosdate, self.crc, compressed_size, size,
+            len(self.name), len(extra), 0, 0, 0, 0o100644 << 16, offset) + self.name + extra
+
+
+
+class ZipStream(object):
+    """Writes a zip archive as an iterator of byte strings.
+
+    Members are read a chunk at a time as the archive is consumed, so the
+    memory used doesn't depend on the size of the archive and the first
+    bytes are ready before any file has been opened.  Members are stored
+    as is, or deflated with compression=ZIP_DEFLATED.  Zip64 records are
+    written where sizes or offsets need them."""
+
+    def __init__(self, compression=ZIP_STORED, chunk_size=CHUNK_SIZE):
+        if compression not in (ZIP_STORED, ZIP_DEFLATED):
+            raise ValueError('Unsupported compression %r.' % compression)
+
+        self.compression = compression
+        self.chunk_size = chunk_size
+        self.entries = []
+        self.offset = 0
+        self.names = set()
+
+
+    def unique_name(self, name):
+        name = name.replace('\\', '/').lstrip('/') or 'file'
+        root, ext = os.path.splitext(name)
+        candidate, i = name, 1
+        while candidate in self.names:
+            i += 1
+            candidate = '%s (%s)%s' % (root, i, ext)
+        self.names.add(candidate)
+        return candidate
+
+
+    def write_file(self, name, open_file, size=None, date_time=None):
+        """Yields a member: the local header, the data and the descriptor.
+        open_file is only called when the member is reached."""
+
+        # Without a known size the member may turn out to need zip64.
+        zip64 = size is None or size >= ZIP64_LIMIT - (ZIP64_LIMIT >> 10)
+        entry = ZipEntry(self.unique_name(name), date_time or time.localtime()[:6],
+            self.compression, self.offset, zip64)
+
+        yield self.emit(entry.local_header())
+
+        compressor = None
+        if self.compression == ZIP_DEFLATED:
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+
+        file_obj = open_file()
+        try:
+            while True:
+                chunk = file_obj.read(self.chunk_size)
+                if not chunk:
+                    break
+                entry.crc = zlib.crc32(chunk, entry.crc) & 0xFFFFFFFF
+                entry.size += len(chunk)
+                if compressor is not None:
+                    chunk = compressor.compress(chunk)
+                if chunk:
+                    entry.compressed_size += len(chunk)
+                    yield self.emit(chunk)
+        finally:
+            file_obj.close()
+
+        if compressor is not None:
+            chunk = compressor.flush()
+            entry.compressed_size += len(chunk)
+            yield self.emit(chunk)
+
+        if not entry.zip64 and max(entry.size, entry.compressed_size) >= ZIP64_LIMIT:
+            raise ValueError('%s is larger than its size said.' % name)
+
+        yield self.emit(entry.data_descriptor())
+        self.entries.append(entry)
+
+
+    def emit(self, data):
+        self.offset += len(data)
+        return data
+
+
+    def close(self):
+        """Yields the central directory and the end records."""
+
+        start = self.offset
+        for entry in self.entries:
+            yield self.emit(entry.central_header())
+        size = self.offset - start
+
+        count = len(self.entries)
+        if count >= ZIP_FILECOUNT_LIMIT or start >= ZIP64_LIMIT or size >= ZIP64_LIMIT:
+            zip64_offset = self.offset
+            yield self.emit(struct.pack('<IQHHIIQQQQ',
+                0x06064b50, 44, 45, 45, 0, 0, count, count, size, start))
+            yield self.emit(struct.pack('<IIQI', 0x07064b50, 0, zip64_offset, 1))
+
+        yield self.emit(struct.pack('<IHHHHIIH',
+            0x06054b50, 0, 0, min(count, ZIP_FILECOUNT_LIMIT), min(count, ZIP_FILECOUNT_LIMIT),
+            min(size, ZIP64_LIMIT), min(start, ZIP64_LIMIT), 0))
+
+
+    def stream(self, files):
+        """Yields the whole archive for an iterable of (name, open_file,
+        size, date_time) tuples."""
+
+        for (name, open_file, size, date_time) in files:
+            for chunk in self.write_file(name, open_file, size, date_time):
+                if chunk:
+                    yield chunk
+
+        for chunk in self.close():
+            yield chunk
@@ -30,6 +30,7 @@ class TestCommand(Command):
                 }
             },
             INSTALLED_APPS = (
+                'django.contrib.contenttypes',
                 'floppyforms',
                 'multifilefield',
             )